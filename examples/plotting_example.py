@@ -16,6 +16,9 @@ particles = 1
 time, traps, trajectories = plt.read_file(path, particles)
 averaging_time = 0.1
 
+# Calibrate all particles at once
+ks, phis, drifts = cal.calibrate_many(time, trajectories, averaging_time)
+
 for i in range(particles):
     data = trajectories[:, i*2:(i+1)*2]
     trap = traps[:, i*3:(i+1)*3]
@@ -26,7 +29,7 @@ for i in range(particles):
     # Example of using potential plot
     plt.potential_plot(time, data, averaging_time)
     # Calculate forces
-    k_estimated, phi_estimated, center_estimated = cal.calibrate(time, data, averaging_time)
+    k_estimated = tuple(ks[i])
     f,m = forcecalc.force_calculation(time, data, trap, k_estimated, 300)
     # Plot force
     plt.force_plot(time,f)
\ No newline at end of file
@@ -0,0 +1,479 @@
+"""
+Performance benchmarks
+
+Each benchmark function returns a dictionary of measured values, so results
+can be compared between versions. Run this module as a script to execute
+all benchmarks, results are written to a JSON file if its name is given as
+the first argument:
+
+    $ python -m tweezer.benchmark results.json
+
+Use compare_results to find regressions between two result files.
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import json
+import platform
+import tempfile
+import time as _time
+
+import numpy as np
+import numba as nb
+from scipy.spatial import cKDTree
+
+import tweezer.synth_active_trajectory as sat
+import tweezer.synth_multi_trajectory as smt
+import tweezer.brownian as brownian
+import tweezer.tracking as tracking
+
+#: SAT2 parameters used by the simulation benchmarks
+SAT_PARAMETERS = dict(dt=0.005, trap_kx=2.5e-6, trap_ky=0.5e-6, trap_xfreq=2, trap_yfreq=1,
+                      trap_xamp=1e-6, trap_yamp=1e-6, bead_radius=0.5e-6, eta=9.7e-4, temp=300, motion_type=1)
+
+def _timeit(func, *args, **kwargs):
+    """Returns execution time of func(*args, **kwargs) in seconds."""
+    t0 = _time.perf_counter()
+    func(*args, **kwargs)
+    return _time.perf_counter() - t0
+
+def benchmark_sat(num_points=2000, repeat=3):
+    """Compares the pure-Python SAT2 against the compiled simulate function.
+
+    Parameters
+    ----------
+    num_points : int
+        # of data points to generate
+    repeat : int
+        compiled simulation is timed this many times, best time is used
+
+    Returns
+    -------
+    results : dict
+        execution times [s], simulated steps per second and speed-up
+    """
+    p = SAT_PARAMETERS
+    args = (num_points, p["dt"], p["trap_kx"], p["trap_ky"], p["trap_xfreq"], p["trap_yfreq"],
+            p["trap_xamp"], p["trap_yamp"], p["bead_radius"], p["eta"], p["temp"], p["motion_type"])
+
+    fd, file_name = tempfile.mkstemp(suffix=".dat")
+    os.close(fd)
+    try:
+        t_python = _timeit(sat.SAT2, file_name, *args)
+    finally:
+        os.remove(file_name)
+
+    sat.simulate(10, *args[1:]) #compile
+    t_compiled = min(_timeit(sat.simulate, *args) for i in range(repeat))
+
+    steps = num_points*p["dt"]/sat.DT_INTERNAL
+    return {"num_points": num_points,
+            "sat2_time": t_python,
+            "simulate_time": t_compiled,
+            "simulate_steps_per_second": steps/t_compiled,
+            "speedup": t_python/t_compiled}
+
+def benchmark_integrators(num_points=100000, repeat=3):
+    """Compares the Euler and exact integrators of the simulate function.
+
+    Parameters
+    ----------
+    num_points : int
+        # of data points to generate
+    repeat : int
+        each integrator is timed this many times, best time is used
+
+    Returns
+    -------
+    results : dict
+        execution times [s] and speed-up of the exact integrator
+    """
+    kwargs = dict(SAT_PARAMETERS)
+    results = {"num_points": num_points}
+    for integrator in sat.INTEGRATORS:
+        sat.simulate(10, integrator=integrator, **kwargs) #compile
+        results[integrator + "_time"] = min(_timeit(sat.simulate, num_points, integrator=integrator, **kwargs)
+                                            for i in range(repeat))
+    results["speedup"] = results["euler_time"]/results["exact_time"]
+    return results
+
+def benchmark_ensemble(num_points=10000, beads=(1, 10, 100), integrator="exact"):
+    """Measures simulation time per trace of simulate_ensemble for different
+    numbers of beads.
+
+    Parameters
+    ----------
+    num_points : int
+        # of data points to generate for each bead
+    beads : sequence of ints
+        ensemble sizes to measure
+    integrator : str
+        integrator used by the simulation
+
+    Returns
+    -------
+    results : dict
+        time per trace [s] for each ensemble size
+    """
+    kwargs = dict(SAT_PARAMETERS)
+    sat.simulate_ensemble(10, integrator=integrator, **kwargs) #compile
+    results = {"num_points": num_points, "integrator": integrator}
+    for m in beads:
+        kwargs["trap_kx"] = np.linspace(1e-6, 5e-6, m)
+        results["time_per_trace_{}".format(m)] = _timeit(sat.simulate_ensemble, num_points, integrator=integrator, **kwargs)/m
+    return results
+
+def benchmark_multi(beads=(100, 400, 1600), num_points=10, hydrodynamics="rpy"):
+    """Measures simulation time per bead of simulate_multi for beads in
+    traps on a square grid with 3um spacing.
+
+    Parameters
+    ----------
+    beads : sequence of ints
+        numbers of beads to measure
+    num_points : int
+        # of data points to generate
+    hydrodynamics : str
+        hydrodynamic model
+
+    Returns
+    -------
+    results : dict
+        time per bead [s] for each number of beads
+    """
+    results = {"num_points": num_points, "hydrodynamics": hydrodynamics}
+    for n in beads:
+        side = int(np.ceil(np.sqrt(n)))
+        traps = np.stack(np.meshgrid(np.arange(side), np.arange(side)), axis=-1).reshape(-1, 2)[:n]*3e-6
+        kwargs = dict(trap_k=1e-6, bead_radius=0.5e-6, eta=1e-3, hydrodynamics=hydrodynamics, cutoff=10e-6)
+        smt.simulate_multi(2, 1e-3, traps, **kwargs) #compile
+        results["time_per_bead_{}".format(n)] = _timeit(smt.simulate_multi, num_points, 1e-3, traps, **kwargs)/n
+    return results
+
+def benchmark_brownian_walk(n=2000, particles=(10, 1000, 10000), block=256):
+    """Measures time per particle step of the per-frame brownian_walk iterator
+    and of brownian_walk_blocks.
+
+    Parameters
+    ----------
+    n : int
+        # of steps to calculate
+    particles : sequence of ints
+        numbers of particles to measure
+    block : int
+        block size
+
+    Returns
+    -------
+    results : dict
+        time per particle step [s] for each number of particles
+    """
+    def consume(iterator):
+        for x in iterator:
+            pass
+
+    results = {"n": n, "block": block}
+    consume(brownian.brownian_walk(np.zeros((1, 2)), 2)) #compile
+    for m in particles:
+        x0 = np.random.rand(m, 2)*256
+        results["walk_time_per_step_{}".format(m)] = _timeit(consume, brownian.brownian_walk(x0, n, block=block))/(n*m)
+        results["blocks_time_per_step_{}".format(m)] = _timeit(consume, brownian.brownian_walk_blocks(x0, n, block=block))/(n*m)
+    return results
+
+def benchmark_draw_psf(particles=5000, shape=(512, 512), sigmas=(1, 2, 4), repeat=5):
+    """Measures rendering time of brownian.draw_psf for different psf widths.
+
+    Parameters
+    ----------
+    particles : int
+        # of particles drawn to the image
+    shape : (int, int)
+        image shape
+    sigmas : sequence of floats
+        psf widths to measure
+    repeat : int
+        each measurement is repeated this many times, best time is used
+
+    Returns
+    -------
+    results : dict
+        time per particle [s] for each psf width
+    """
+    points = np.random.rand(particles, 2)*np.array(shape)
+    im = np.zeros(shape, "uint8")
+    results = {"particles": particles}
+    for sigma in sigmas:
+        results["time_per_particle_sigma_{}".format(sigma)] = min(_timeit(brownian.draw_psf, im, points, 30, sigma)
+                                                                  for i in range(repeat))/particles
+    return results
+
+def benchmark_render_frames(frames=256, particles=1000, shape=(256, 256), sigma=2):
+    """Compares rendering of a block of frames with render_frames (camera
+    model without and with noise) against frame by frame rendering with
+    particles_video and against uint8 rendering with draw_psf_frames.
+
+    Parameters
+    ----------
+    frames : int
+        # of frames
+    particles : int
+        # of particles in each frame
+    shape : (int, int)
+        frame shape
+    sigma : float
+        psf width
+
+    Returns
+    -------
+    results : dict
+        times per frame [s]
+    """
+    points = np.random.rand(frames, particles, 2)*np.array(shape)
+    noise = dict(background=10, shot_noise=True, read_noise=2.)
+    brownian.render_frames(points[:2], shape, sigma=sigma) #compile
+    brownian.draw_psf_frames(np.zeros((2,) + shape, "uint8"), points[:2], 30, sigma)
+    t_video = _timeit(list, brownian.particles_video(points, shape, sigma=sigma))
+    t_block = _timeit(brownian.render_frames, points, shape, sigma=sigma)
+    t_noise = _timeit(brownian.render_frames, points, shape, sigma=sigma, **noise)
+    t_uint8 = _timeit(brownian.draw_psf_frames, np.zeros((frames,) + shape, "uint8"), points, 30, sigma)
+    return {"frames": frames, "particles": particles,
+            "particles_video_time_per_frame": t_video/frames,
+            "render_frames_time_per_frame": t_block/frames,
+            "render_frames_noise_time_per_frame": t_noise/frames,
+            "draw_psf_frames_time_per_frame": t_uint8/frames}
+
+def _match(features, points, max_distance):
+    """Matches located features to ground-truth points of shape (frames, 
+    particles, 2). Each point is matched to at most one feature, the nearest 
+    one within max_distance.
+    
+    Returns localization errors of matched features, # of missed points and
+    # of false detections."""
+    errors = []
+    missed = 0
+    false = 0
+    frame = features["frame"]
+    bounds = np.searchsorted(frame, np.arange(len(points) + 1))
+    for k, truth in enumerate(points):
+        f = features[bounds[k]:bounds[k+1]]
+        located = np.stack((f["x"], f["y"]), axis = -1)
+        #failed fits may have non-finite positions, these are false detections
+        located = located[np.isfinite(located).all(axis = 1)]
+        d, i = cKDTree(truth).query(located, distance_upper_bound = max_distance)
+        ok = np.isfinite(d)
+        #the nearest of features that found the same point is the match
+        order = np.argsort(d[ok])
+        index, first = np.unique(i[ok][order], return_index = True)
+        errors.append(d[ok][order][first])
+        missed += len(truth) - len(index)
+        false += len(f) - len(index)
+    return np.concatenate(errors), missed, false
+
+def benchmark_tracking(nframes=256, shapes=((256, 256), (512, 512)), particles=(10, 100), sigmas=(1.5, 2.5),
+                       intensities=(30, 100), background=10, read_noise=2., delta=1., radius=3, 
+                       trackers=("centroid", "gaussian"), seed=0):
+    """Measures throughput and accuracy of particle localization on videos of
+    brownian particles with known positions, for all combinations of frame 
+    shape, # of particles, psf width and intensity.
+    
+    Videos are created with brownian.brownian_particles and 
+    brownian.particles_video with shot noise and read noise. The "centroid" 
+    tracker is tracking.locate_video and the "gaussian" tracker is 
+    tracking.locate_video with gaussian fits. The threshold is half of the 
+    intensity above the background.
+
+    Parameters
+    ----------
+    nframes : int
+        # of frames of each video
+    shapes : sequence of (int, int)
+        frame shapes
+    particles : sequence of ints
+        numbers of particles
+    sigmas : sequence of floats
+        psf widths
+    intensities : sequence of floats
+        peak intensities of particles
+    background : float
+        background intensity
+    read_noise : float
+        standard deviation of camera read noise
+    delta : float
+        step variance of particles
+    radius : int
+        window radius of tracking.locate_video
+    trackers : sequence of str
+        trackers to measure
+    seed : int
+        seed of the random number generators
+
+    Returns
+    -------
+    results : dict
+        list of runs, each with parameters, frames per second, localization 
+        RMSE [px] and fractions of missed points and false detections
+    """
+    camera = dict(background=background, read_noise=read_noise, shot_noise=True, frame_dtype="uint16")
+    options = {"centroid": {}, "gaussian": {"fit": True}}
+    frames = brownian.render_frames(np.full((2, 1, 2), 8.), (16, 16), intensity=100, sigma=2, **camera)
+    for tracker in trackers:
+        tracking.locate_video(frames, 50., radius, **options[tracker]) #compile
+    runs = []
+    for shape in shapes:
+        for n in particles:
+            for sigma in sigmas:
+                for intensity in intensities:
+                    np.random.seed(seed)
+                    brownian.seed(seed)
+                    points = np.array(list(brownian.brownian_particles(nframes, shape, n, delta)))
+                    frames = np.array(list(brownian.particles_video(points, shape, intensity=intensity, sigma=sigma, **camera)))
+                    for tracker in trackers:
+                        t0 = _time.perf_counter()
+                        features = tracking.locate_video(frames, background + intensity/2., radius, **options[tracker])
+                        t = _time.perf_counter() - t0
+                        errors, missed, false = _match(features, points, radius)
+                        runs.append({"tracker": tracker, "shape": list(shape), "particles": n, "sigma": sigma, 
+                                     "intensity": intensity, "frames_per_second": nframes/t, 
+                                     "rmse": float(np.sqrt(np.mean(errors**2))) if len(errors) else float("nan"),
+                                     "missed": missed/points[:,:,0].size, "false": false/points[:,:,0].size})
+    return {"nframes": nframes, "background": background, "read_noise": read_noise, "runs": runs}
+
+def benchmark_correlation_tracker(nframes=256, beads=(1, 4, 16), rois=(16, 32), sigma=2, intensity=100, 
+                                  repeat=200, seed=0):
+    """Measures per-frame latency, block throughput and accuracy of 
+    tracking.CorrelationTracker on videos of beads in optical traps.
+
+    Parameters
+    ----------
+    nframes : int
+        # of frames of each video
+    beads : sequence of ints
+        numbers of trapped beads, traps are on a square grid with 32 px spacing
+    rois : sequence of ints
+        ROI sizes
+    sigma : float
+        psf width
+    intensity : float
+        peak intensity of beads
+    repeat : int
+        # of single frames tracked to measure the latency
+    seed : int
+        seed of the random number generators
+
+    Returns
+    -------
+    results : dict
+        list of runs, each with the time to track a single frame [s], the 
+        time per frame when tracking all frames as one block [s] and 
+        the localization RMSE [px]
+    """
+    runs = []
+    for n in beads:
+        side = int(np.ceil(np.sqrt(n)))
+        traps = (np.stack(np.meshgrid(np.arange(side), np.arange(side)), axis=-1).reshape(-1, 2)[:n] + 1)*32.
+        shape = (side + 1)*32, (side + 1)*32
+        np.random.seed(seed)
+        brownian.seed(seed)
+        frames, positions = next(brownian.trapped_beads_video(nframes, 1e-3, traps, 1e-6, shape=shape, 
+                                                              intensity=intensity, sigma=sigma, block=nframes, 
+                                                              frame_dtype="uint16"))
+        for roi in rois:
+            tracker = tracking.CorrelationTracker(tracking.gaussian_reference((roi, roi), sigma), traps)
+            tracker.track(frames[0]) #compile
+            t0 = _time.perf_counter()
+            for i in range(repeat):
+                tracker.track(frames[i % nframes])
+            t_frame = (_time.perf_counter() - t0)/repeat
+            tracker.track(frames)
+            t_block = _timeit(tracker.track, frames)/nframes
+            errors = tracker.track(frames).reshape(nframes, n, 2) - positions
+            runs.append({"beads": n, "roi": roi, "frame_time": t_frame, "block_frame_time": t_block,
+                         "rmse": float(np.sqrt((errors**2).sum(-1).mean()))})
+    return {"nframes": nframes, "fft_backend": tracking.FFT_BACKEND, "runs": runs}
+
+def environment():
+    """Returns versions of python and of the libraries used by the benchmarks."""
+    return {"python": platform.python_version(), "platform": platform.platform(), 
+            "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "numpy": np.__version__, "numba": nb.__version__, "time": _time.strftime("%Y-%m-%d %H:%M:%S")}
+
+def write_results(results, file_name):
+    """Writes a dictionary of benchmark results to a JSON file, together with
+    the environment, see environment."""
+    with open(file_name, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=1)
+
+def read_results(file_name):
+    """Reads benchmark results written by write_results."""
+    with open(file_name) as f:
+        return json.load(f)["results"]
+
+#: measured values where larger is better, matched by the end of their names
+HIGHER_IS_BETTER = ("per_second", "speedup")
+
+#: measured values where smaller is better: times, errors and failure rates
+LOWER_IS_BETTER = ("time", "rmse", "missed", "false")
+
+def _direction(key):
+    #1 if larger values are better, -1 if smaller values are better, 0 if not a measurement
+    name = key.rsplit("/", 1)[-1]
+    if name.endswith(HIGHER_IS_BETTER):
+        return 1
+    if name.endswith(LOWER_IS_BETTER) or name.startswith("time_per"):
+        return -1
+    return 0
+
+def _flatten(results, prefix=""):
+    #flat dictionary of values, runs of a list are keyed by their parameters
+    out = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            out.update(_flatten(value, prefix + "/" + str(key)))
+    elif isinstance(results, list):
+        for run in results:
+            name = ",".join("{}={}".format(k, v) for k, v in sorted(run.items()) if not _direction(k))
+            out.update(_flatten({k: v for k, v in run.items() if _direction(k)}, prefix + "[" + name + "]"))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        out[prefix] = results
+    return out
+
+def compare_results(old, new, tolerance=0.2):
+    """Compares two sets of benchmark results and returns measurements that 
+    are worse in new results by more than a relative tolerance.
+
+    Parameters
+    ----------
+    old, new : dict
+        Benchmark results, e.g. from read_results
+    tolerance : float
+        Allowed relative change
+
+    Returns
+    -------
+    regressions : dict
+        (old, new) values of regressed measurements, keyed by their path in
+        the results
+    """
+    old, new = _flatten(old), _flatten(new)
+    regressions = {}
+    for key in sorted(set(old) & set(new)):
+        a, b = old[key], new[key]
+        direction = _direction(key)
+        if direction > 0:
+            worse = b < a*(1 - tolerance)
+        else:
+            worse = direction < 0 and b > a*(1 + tolerance)
+        if worse:
+            regressions[key] = (a, b)
+    return regressions
+
+if __name__ == "__main__":
+    results = {}
+    for benchmark in (benchmark_sat, benchmark_integrators, benchmark_ensemble, benchmark_multi,
+                      benchmark_brownian_walk, benchmark_draw_psf, benchmark_render_frames, benchmark_tracking,
+                      benchmark_correlation_tracker):
+        results[benchmark.__name__] = benchmark()
+        print(benchmark.__name__, results[benchmark.__name__])
+    if len(sys.argv) > 1:
+        write_results(results, sys.argv[1])
@@ -11,36 +11,43 @@ image at the calculated particle positions.
 The frame grabber is done using iterators to reduce memory requirements. You can
 analyze video frame by frame with minimal memory requirement, or read the whole
 video first to memory.
+
+Compiled kernels are built on first use for the requested floating point 
+precision (float32 or float64) and target (cpu or parallel), see get_kernels. 
+Defaults are set in the configuration, see conf.set_precision and 
+conf.set_target.
 """
 from __future__ import absolute_import, print_function, division
 
 import numpy as np
 import numba as nb
 import math
+import types
 
-PARALLEL = False #set to True if you want to compile for parallel 
-SINGLE_PRECISION = False #set this to True if you want to calculate in single precision
+import scipy.constants
 
-TARGET = "parallel" if PARALLEL == True else "cpu"
+from tweezer.conf import TweezerConfig, NUMBA_CACHE, configure_numba_cache
+from tweezer.video import create_video, open_video
 
-if SINGLE_PRECISION:
-    F = nb.float32
-    I = nb.int32
-    
-    FDTYPE = np.float32
-    IDTYPE = np.int32
-    
-else:
-    F = nb.float64
-    I = nb.int64
-    
-    FDTYPE = np.float64
-    IDTYPE = np.int64
+PRECISIONS = ("single", "double")
+TARGETS = ("cpu", "parallel")
+
+#: float dtypes of the supported precisions
+DTYPES = {"single" : np.dtype(np.float32), "double" : np.dtype(np.float64)}
     
 U8 = nb.uint8 #imaging is done in 8bit mode... 
- 
-@nb.vectorize([F(F,F,F)], target = TARGET)
-def mirror(x,x0,x1):
+U16 = nb.uint16 #or in 16bit mode with the camera model
+
+#: keyword arguments of the camera model, see render_frames
+CAMERA_PARAMETERS = ("background", "read_noise", "shot_noise", "gain", "frame_dtype")
+
+GAUSSN = 1/np.sqrt(2*np.pi)
+
+# Kernel implementations. Helper functions are compiled lazily, kernels are 
+# compiled by _build_kernels for each precision and target, see get_kernels.
+
+@nb.jit(nopython = True, cache = NUMBA_CACHE)
+def _mirror(x,x0,x1):
     """transforms coordinate x by flooring in the interval of [x0,x1]
     It performs x0 + (x-x0)%(x1-x0)"""
     #return x0 + (x-x0)%(x1-x0)
@@ -58,30 +65,388 @@ def mirror(x,x0,x1):
         else:
             return x
                           
-@nb.vectorize([F(F,F,F)], target = TARGET)        
-def make_step(x,scale, velocity):
+@nb.jit(nopython = True, cache = NUMBA_CACHE)
+def _make_step(x,scale, velocity):
     """Performs random particle step from a given initial position x."""
     return x + np.random.randn()*scale + velocity   
 
-def brownian_walk(x0, n = 1024, shape = (256,256), delta = 1, dt = 1, velocity = 0.):
-    """Returns an brownian walk iterator.
+def _psf_gauss(x,x0,y,y0,sigma,intensity):
+    """Gaussian point-spread function. This is used to calculate pixel value
+    for a given pixel coordinate x,y and particle position x0,y0."""
+    return intensity*math.exp(-0.5*((x-x0)**2+(y-y0)**2)/(sigma**2))
+
+@nb.jit(nopython = True, cache = NUMBA_CACHE)
+def _draw_points(im, points, intensity):
+    """Draws pixels to image from a given points array"""
+    data = points
+    particles = len(data)
+    for j in range(particles):
+        im[int(data[j,0]),int(data[j,1])] = im[int(data[j,0]),int(data[j,1])] + intensity 
+    return im   
+
+@nb.jit(nopython = True, cache = NUMBA_CACHE)
+def _psf_profile(out, x0, start, sigma):
+    """Fills out with a one-dimensional gaussian profile at pixel coordinates
+    start, start+1,... for a particle at position x0."""
+    for i in range(len(out)):
+        out[i] = math.exp(-0.5*((start + i - x0)/sigma)**2)
+
+@nb.jit(nopython = True, cache = NUMBA_CACHE)
+def _wrap_index(i, n):
+    """Wraps pixel index i into the [0,n) interval (periodic boundary)."""
+    # slightly faster implementation of flooring
+    if i >= n:
+        return i - n
+    elif i < 0:
+        return n + i
+    else:
+        return i
+
+@nb.jit(nopython = True, cache = NUMBA_CACHE)
+def _draw_psf(im, points, intensity, sigma):
+    """Draws psf to image from a given points array.
+    
+    Gaussian psf is separable, so only two one-dimensional profiles are computed
+    for each particle and pixel values are their outer product."""
+    height, width = im.shape
+    particles = len(points)
+    size = int(round(3*sigma))
+    profile = np.empty((2, 2*size+1), points.dtype)
+    for k in range(particles):
+        h0,w0  = points[k,0], points[k,1]
+        h,w = int(h0), int(w0) 
+        _psf_profile(profile[0], h0, h-size, sigma)
+        _psf_profile(profile[1], w0, w-size, sigma)
+        for i0 in range(2*size+1):
+            i = _wrap_index(h-size+i0, height)
+            pi = intensity*profile[0,i0]
+            for j0 in range(2*size+1):
+                j = _wrap_index(w-size+j0, width)
+                p = U8(pi*profile[1,j0])
+                im[i,j] = im[i,j] + p
+    return im  
+
+@nb.jit(nopython = True, cache = NUMBA_CACHE)
+def _add_psf(im, points, intensity, sigma):
+    """Adds psf of all points to a float image, see _draw_psf."""
+    height, width = im.shape
+    size = int(round(3*sigma))
+    profile = np.empty((2, 2*size+1), points.dtype)
+    for k in range(len(points)):
+        h0,w0  = points[k,0], points[k,1]
+        h,w = int(h0), int(w0) 
+        _psf_profile(profile[0], h0, h-size, sigma)
+        _psf_profile(profile[1], w0, w-size, sigma)
+        for i0 in range(2*size+1):
+            i = _wrap_index(h-size+i0, height)
+            pi = intensity*profile[0,i0]
+            for j0 in range(2*size+1):
+                j = _wrap_index(w-size+j0, width)
+                im[i,j] += pi*profile[1,j0]
+    return im  
+
+@nb.jit(nopython = True, cache = NUMBA_CACHE)
+def _expose(frame, signal, background, gain, read_noise, shot_noise, max_value):
+    """Converts signal to camera counts. Adds background, shot noise (poisson 
+    noise of signal/gain electrons) and gaussian read noise and saturates 
+    values to the [0, max_value] interval. Signal is reset to zero, so it can
+    be reused for the next frame."""
+    height, width = frame.shape
+    for i in range(height):
+        for j in range(width):
+            value = signal[i,j] + background[i,j]
+            signal[i,j] = 0
+            if shot_noise and value > 0:
+                value = np.random.poisson(value/gain)*gain
+            if read_noise > 0:
+                value += np.random.randn()*read_noise
+            if value <= 0:
+                frame[i,j] = 0
+            elif value >= max_value:
+                frame[i,j] = max_value
+            else:
+                frame[i,j] = math.floor(value + 0.5)
+
+def _camera_frames(frames, points, intensity, sigma, background, gain, read_noise, shot_noise, max_value, chunks):
+    """Renders a block of frames with the camera model, points[k] are drawn 
+    to frames[k]. Psf is drawn if sigma > 0, else points are drawn.
+    
+    Frames are split into chunks (one for each thread), each chunk allocates
+    a single signal buffer. With noise, the generator of the thread that renders 
+    frame k is seeded with base + k, where base is drawn from the calling 
+    thread's generator, so noise does not depend on the target or the number
+    of threads."""
+    n, height, width = frames.shape
+    noise = shot_noise or read_noise > 0
+    base = np.random.randint(0, 2**31) if noise else 0
+    chunks = max(1, min(n, chunks))
+    for c in nb.prange(chunks):
+        signal = np.zeros((height, width), points.dtype)
+        for k in range(c, n, chunks):
+            if noise:
+                np.random.seed(base + k)
+            if sigma > 0:
+                _add_psf(signal, points[k], intensity, sigma)
+            else:
+                _draw_points(signal, points[k], intensity)
+            _expose(frames[k], signal, background, gain, read_noise, shot_noise, max_value)
+    if noise:
+        #the calling thread's state must not depend on which frames it rendered
+        np.random.seed(base + len(frames))
+    return frames
+
+@nb.jit(nopython = True, cache = NUMBA_CACHE)
+def _draw_steps(steps):
+    """Fills steps with normal random numbers from the calling thread's generator."""
+    n, m, xy = steps.shape
+    for k in range(n):
+        for j in range(m):
+            for l in range(xy):
+                steps[k,j,l] = np.random.randn()
+
+def _walk_block(out, x, scale, velocity, shape, steps):
+    """Fills out with len(out) consecutive positions of a brownian walk.
+    Random steps are drawn to the steps buffer (of at least the shape of out) 
+    before the particles are walked in parallel, so the walk depends only on 
+    the calling thread's generator, see seed."""
+    zero = shape[0]*0
+    _draw_steps(steps[:out.shape[0]])
+    for j in nb.prange(out.shape[1]):
+        for k in range(out.shape[0]):
+            for l in range(2):
+                out[k,j,l] = x[j,l]
+                x[j,l] = _mirror(x[j,l] + steps[k,j,l]*scale + velocity[j,l], zero, shape[l])
+
+def _trap_walk_block(out, x, trap, decay, std, steps):
+    """Fills out with len(out) consecutive positions of beads in harmonic traps.
+    The exact (Ornstein-Uhlenbeck) propagator over one frame is used, with trap
+    positions trap[k] held fixed during the step from frame k to k+1. Random 
+    steps are drawn as in _walk_block."""
+    _draw_steps(steps[:out.shape[0]])
+    for j in nb.prange(out.shape[1]):
+        for k in range(out.shape[0]):
+            for l in range(2):
+                out[k,j,l] = x[j,l]
+                x[j,l] = trap[k,j,l] + (x[j,l] - trap[k,j,l])*decay[j,l] + std[j,l]*steps[k,j,l]
+
+def _draw_psf_frames(frames, points, intensity, sigma):
+    """Draws psf to a block of frames, points[k] are drawn to frames[k]."""
+    for k in nb.prange(len(frames)):
+        _draw_psf(frames[k], points[k], intensity, sigma)
+    return frames
+
+def _draw_points_frames(frames, points, intensity):
+    """Draws pixels to a block of frames, points[k] are drawn to frames[k]."""
+    for k in nb.prange(len(frames)):
+        _draw_points(frames[k], points[k], intensity)
+    return frames
+
+def _variant(func, target):
+    """Returns a copy of a python function, renamed for the given target. 
+    Numba's on-disk cache does not distinguish compile options, so each target
+    must be compiled from a function with a different name."""
+    if isinstance(func, nb.core.registry.CPUDispatcher):
+        func = func.py_func
+    name = "{}_{}".format(func.__name__, target)
+    f = types.FunctionType(func.__code__, func.__globals__, name, func.__defaults__, func.__closure__)
+    f.__qualname__ = name
+    f.__doc__ = func.__doc__
+    return f
+
+class Kernels(object):
+    """Compiled kernels of a given precision and target, see get_kernels."""
+    def __init__(self, precision, target):
+        self.precision = precision
+        self.target = target
+        self.dtype = DTYPES[precision]
+        
+    def __repr__(self):
+        return "Kernels({!r}, {!r})".format(self.precision, self.target)
+
+def _build_kernels(precision, target):
+    """Compiles (or loads from cache) all kernels for a given precision and target."""
+    if precision == "single":
+        F = nb.float32
+        I = nb.int32
+    else:
+        F = nb.float64
+        I = nb.int64
+    parallel = target == "parallel"
+    #numba may have reset the cache folder since import
+    configure_numba_cache()
+    
+    def jit(func, signatures, parallel = parallel):
+        return nb.jit(signatures, nopython = True, parallel = parallel, cache = NUMBA_CACHE)(_variant(func, target))
+    
+    def vectorize(func, signatures):
+        return nb.vectorize(signatures, target = target, cache = NUMBA_CACHE)(_variant(func, "ufunc_" + target))
+    
+    k = Kernels(precision, target)
+    k.mirror = vectorize(_mirror, [F(F,F,F)])
+    k.make_step = vectorize(_make_step, [F(F,F,F)])
+    k.psf_gauss = jit(_psf_gauss, [U8(I,F,I,F,F,U8)], parallel = False)
+    k.psf_profile = jit(_psf_profile, [(F[:],F,I,F)], parallel = False)
+    k.draw_points = jit(_draw_points, [U8[:,:](U8[:,:],F[:,:],U8)], parallel = False)
+    k.draw_psf = jit(_draw_psf, [U8[:,:](U8[:,:],F[:,:],U8,F)], parallel = False)
+    k.walk_block = jit(_walk_block, [(F[:,:,:],F[:,:],F,F[:,:],F[:],nb.float64[:,:,:])])
+    k.trap_walk_block = jit(_trap_walk_block, [(F[:,:,:],F[:,:],F[:,:,:],F[:,:],F[:,:],nb.float64[:,:,:])])
+    k.draw_psf_frames = jit(_draw_psf_frames, [U8[:,:,:](U8[:,:,:],F[:,:,:],U8,F)])
+    k.draw_points_frames = jit(_draw_points_frames, [U8[:,:,:](U8[:,:,:],F[:,:,:],U8)])
+    k.camera_frames = jit(_camera_frames, [U[:,:,:](U[:,:,:],F[:,:,:],F,F,F[:,:],F,F,nb.boolean,F,I) for U in (U8, U16)])
+    return k
+
+_KERNELS = {}
+
+def get_dtype(dtype = None):
+    """Returns float dtype for computation. If dtype is not given, the dtype
+    of the configured precision is returned, see conf.set_precision."""
+    if dtype is None:
+        return DTYPES[TweezerConfig.precision]
+    dtype = np.dtype(dtype)
+    if dtype not in DTYPES.values():
+        raise ValueError("Unsupported dtype {}".format(dtype))
+    return dtype
+    
+def _array_dtype(x, dtype = None):
+    #dtype of x if it is a supported float array, else default dtype
+    if dtype is None and isinstance(x, np.ndarray) and x.dtype in DTYPES.values():
+        return x.dtype
+    return get_dtype(dtype)
+
+def get_kernels(dtype = None, target = None):
+    """Returns compiled kernels for a given dtype and target.
+    
+    Kernels are compiled on first request and cached, so different variants
+    can be used in the same process.
+    
+    Parameters
+    ----------
+    dtype : dtype, optional
+        Either float32 or float64. Defaults to the configured precision, 
+        see conf.set_precision.
+    target : str, optional
+        Either "cpu" or "parallel". Defaults to the configured target,
+        see conf.set_target.
+        
+    Returns
+    -------
+    kernels : Kernels
+        Object holding compiled mirror, make_step, walk_block, trap_walk_block, psf_gauss, 
+        draw_points, draw_psf, draw_points_frames, draw_psf_frames and 
+        camera_frames functions.
+    """
+    dtype = get_dtype(dtype)
+    precision = "single" if dtype == np.float32 else "double"
+    target = TweezerConfig.target if target is None else target
+    if target not in TARGETS:
+        raise ValueError("Unsupported target {}".format(target))
+    try:
+        return _KERNELS[precision, target]
+    except KeyError:
+        kernels = _build_kernels(precision, target)
+        _KERNELS[precision, target] = kernels
+        return kernels
+
+def warmup(dtypes = None, targets = None):
+    """Compiles, or loads from the on-disk cache (see conf.NUMBA_CACHE), kernels 
+    for all given dtypes and targets, so that later calls start without delay.
+    
+    Parameters
+    ----------
+    dtypes : sequence of dtypes, optional
+        Defaults to the configured precision only.
+    targets : sequence of str, optional
+        Defaults to the configured target only.
+        
+    Returns
+    -------
+    kernels : list of Kernels
+        Compiled kernels, see get_kernels
+    """
+    dtypes = [None] if dtypes is None else dtypes
+    targets = [None] if targets is None else targets
+    seed.compile((nb.int64,))
+    return [get_kernels(dtype, target) for dtype in dtypes for target in targets]
+
+def mirror(x,x0,x1, target = None):
+    """transforms coordinate x by flooring in the interval of [x0,x1]
+    It performs x0 + (x-x0)%(x1-x0)"""
+    return get_kernels(_array_dtype(x), target).mirror(x,x0,x1)
+
+def make_step(x,scale, velocity, target = None):
+    """Performs random particle step from a given initial position x."""
+    return get_kernels(_array_dtype(x), target).make_step(x,scale, velocity)
+
+@nb.jit(nopython = True, cache = NUMBA_CACHE)
+def seed(value):
+    """Seeds the random generator used by the compiled functions.
+    
+    Numba keeps a separate generator for each thread and this seeds the 
+    calling thread's one only. Walks and rendered frames are reproducible 
+    with both targets, because their kernels draw from the calling thread 
+    (noise of frame k is seeded from it, see render_frames). The make_step 
+    ufunc with the "parallel" target draws from worker threads and is not 
+    reproducible."""
+    np.random.seed(value)
+
+def walk_block(out, x, scale, velocity, shape, target = None, steps = None):
+    """Fills out with len(out) consecutive positions of a brownian walk.
+    
+    The first position is x, and x is updated in place to the position 
+    that follows the last one, so that the walk can be continued. Random 
+    steps are drawn to steps, a float64 buffer of at least the shape of out,
+    which can be reused between calls. It is allocated if not given."""
+    if steps is None:
+        steps = np.empty(out.shape, np.float64)
+    return get_kernels(out.dtype, target).walk_block(out, x, scale, velocity, shape, steps)
+
+def brownian_walk_blocks(x0, n = 1024, shape = (256,256), delta = 1, dt = 1, velocity = 0., block = 256,
+                         dtype = None, target = None):
+    """Returns an iterator over blocks of a brownian walk.
      
-    Given the initial coordinate x0, it callculates next n coordinates."""             
+    Given the initial coordinate x0, it callculates next n coordinates, block 
+    coordinates at a time. Each block is a new array of shape (block, particles, 2), 
+    the last one can be shorter. Computation is done in the given dtype 
+    (dtype of x0 by default) with kernels compiled for the given target, see 
+    get_kernels."""
     particles, xy = x0.shape
+    dtype = _array_dtype(x0, dtype)
+    kernels = get_kernels(dtype, target)
     scale=delta*np.sqrt(dt)
-    x = x0
-    x = np.asarray(x, FDTYPE)
-    velocity = np.asarray(velocity, FDTYPE)/dt
-    scale = np.asarray(scale, FDTYPE)
+    x = np.array(x0, dtype)
+    velocity = np.array(np.broadcast_to(np.asarray(velocity)/dt, x.shape), dtype)
+    scale = dtype.type(scale)
+    shape = np.asarray(shape,dtype)
+    #random steps buffer, reused for all blocks
+    steps = np.empty((min(block, n), particles, xy), np.float64)
     
-    x1, x2 = 0, np.asarray(shape,FDTYPE)
+    for i in range(0, n, block):
+        out = np.empty((min(block, n - i), particles, xy), dtype)
+        kernels.walk_block(out, x, scale, velocity, shape, steps)
+        yield out
 
-    for i in range(n):
-        yield x
-        x = make_step(x,scale, velocity)
-        x = mirror(x,x1,x2)
+def brownian_walk(x0, n = 1024, shape = (256,256), delta = 1, dt = 1, velocity = 0., block = 256,
+                  dtype = None, target = None):
+    """Returns an brownian walk iterator.
+     
+    Given the initial coordinate x0, it callculates next n coordinates. 
+    Coordinates are computed in blocks, see brownian_walk_blocks."""             
+    for data in brownian_walk_blocks(x0, n, shape, delta, dt, velocity, block, dtype, target):
+        for x in data:
+            yield x
         
-def brownian_particles(n = 500, shape = (256,256),particles = 10,delta = 1, dt = 1,velocity = 0.):
+def brownian_particles_blocks(n = 500, shape = (256,256),particles = 10,delta = 1, dt = 1,velocity = 0., block = 256,
+                              dtype = None, target = None):
+    """Creates coordinates of multiple brownian particles in blocks of shape 
+    (block, particles, 2). See brownian_particles for parameters."""
+    x0 = np.asarray(np.random.rand(particles,2)*np.array(shape),get_dtype(dtype))
+    v0 = np.zeros_like(x0)
+    v0[:,0] = velocity
+    for data in brownian_walk_blocks(x0,n,shape,delta,dt,v0,block,target = target):
+        yield data
+
+def brownian_particles(n = 500, shape = (256,256),particles = 10,delta = 1, dt = 1,velocity = 0.,
+                       dtype = None, target = None):
     """Creates coordinates of multiple brownian particles.
     
     Parameters
@@ -98,78 +463,213 @@ def brownian_particles(n = 500, shape = (256,256),particles = 10,delta = 1, dt =
         Time resolution
     velocity : float
         Velocity in pixel units (when dt = 1) 
+    dtype : dtype, optional
+        Float dtype of the computation, see get_kernels
+    target : str, optional
+        Target of the compiled kernels, see get_kernels
     """
-    x0 = np.asarray(np.random.rand(particles,2)*np.array(shape),FDTYPE)
-    v0 = np.zeros_like(x0)
-    v0[:,0] = velocity
-    for data in brownian_walk(x0,n,shape,delta,dt,v0):
-        yield data
+    for block in brownian_particles_blocks(n,shape,particles,delta,dt,velocity,dtype = dtype,target = target):
+        for data in block:
+            yield data
              
-GAUSSN = 1/np.sqrt(2*np.pi)
+def trapped_beads_blocks(nframes, dt, trap_positions, trap_k, bead_radius = 0.5e-6, eta = 9.7e-4, temp = 293., 
+                         pixel_size = 0.1e-6, block = 256, dtype = None, target = None):
+    """Creates positions of beads confined in harmonic optical traps, in blocks
+    of shape (block, beads, 2). The last block can be shorter.
+    
+    Initial bead positions are drawn from the equilibrium distribution.
+    
+    Parameters
+    ----------
+    nframes : int
+        Number of frames to calculate
+    dt : float
+        Time between frames [s]
+    trap_positions : array_like
+        Trap positions in pixel units of shape (beads, 2), or (nframes, beads, 2)
+        for moving traps
+    trap_k : float or array_like
+        Trap stiffness [N/m], a scalar, or of shape (beads,) or (beads, 2) for 
+        different stiffnesses in x and y directions
+    bead_radius : float
+        Radius of the beads [m]
+    eta : float
+        Viscosity of the medium [Pa s]
+    temp : float
+        Temperature [K]
+    pixel_size : float
+        Pixel size [m]
+    block : int
+        Block size
+    dtype : dtype, optional
+        Float dtype of the computation, see get_kernels
+    target : str, optional
+        Target of the compiled kernels, see get_kernels
+    """
+    dtype = get_dtype(dtype)
+    kernels = get_kernels(dtype, target)
+    traps = np.asarray(trap_positions, dtype)
+    if traps.ndim == 2:
+        traps = traps[None]
+    beads = traps.shape[1]
+    if traps.ndim != 3 or traps.shape[2] != 2 or len(traps) not in (1, nframes):
+        raise ValueError("Trap positions must have shape (beads, 2) or (nframes, beads, 2)")
+    trap_k = np.asarray(trap_k, float)
+    if trap_k.ndim == 1:
+        trap_k = trap_k[:,None]
+    trap_k = np.broadcast_to(trap_k, (beads, 2))
+    
+    gamma = 6*np.pi*eta*bead_radius
+    kBT = scipy.constants.Boltzmann*temp
+    decay = np.exp(-trap_k*dt/gamma)
+    #equilibrium standard deviation in pixel units
+    sigma0 = np.sqrt(kBT/trap_k)/pixel_size
+    std = np.array(sigma0*np.sqrt(1 - decay**2), dtype)
+    decay = np.array(decay, dtype)
+    
+    x = np.array(traps[0] + sigma0*np.random.randn(beads, 2), dtype)
+    steps = np.empty((min(block, nframes), beads, 2), np.float64)
+    for i in range(0, nframes, block):
+        n = min(block, nframes - i)
+        trap = np.array(np.broadcast_to(traps[i:i+n] if len(traps) > 1 else traps, (n, beads, 2)))
+        out = np.empty((n, beads, 2), dtype)
+        kernels.trap_walk_block(out, x, trap, decay, std, steps)
+        yield out
 
-@nb.jit([U8(I,F,I,F,F,U8)],nopython = True)
-def psf_gauss(x,x0,y,y0,sigma,intensity):
+def trapped_beads_video(nframes, dt, trap_positions, trap_k, bead_radius = 0.5e-6, eta = 9.7e-4, temp = 293., 
+                        pixel_size = 0.1e-6, shape = (256,256), intensity = 30, sigma = 2, **kw):
+    """Returns an iterator over blocks of a video of beads in harmonic optical 
+    traps, together with ground-truth bead positions.
+    
+    See trapped_beads_blocks for simulation parameters and render_frames for 
+    camera parameters. 
+    
+    Yields
+    ------
+    frames : ndarray
+        Block of frames of shape (block,) + shape
+    positions : ndarray
+        Bead positions in pixel units of shape (block, beads, 2). Multiply
+        by pixel_size*1e6 to get positions in micrometers, as used by
+        calibration.calibrate.
+        
+    Examples
+    --------
+    >>> video = trapped_beads_video(1000, 1e-3, [[64,64],[64,128]], 1e-6)
+    >>> frames, positions = next(video)
+    """
+    camera = _pop_camera(kw)
+    for positions in trapped_beads_blocks(nframes, dt, trap_positions, trap_k, bead_radius, eta, temp, pixel_size, **kw):
+        frames = render_frames(positions, shape, intensity = intensity, sigma = sigma, target = kw.get("target"), **camera)
+        yield frames, positions
+
+def psf_gauss(x,x0,y,y0,sigma,intensity, dtype = None):
     """Gaussian point-spread function. This is used to calculate pixel value
     for a given pixel coordinate x,y and particle position x0,y0."""
-    return intensity*math.exp(-0.5*((x-x0)**2+(y-y0)**2)/(sigma**2))
-                 
-@nb.jit(["uint8[:,:],float64[:,:],uint8"], nopython = True)                
+    return get_kernels(dtype).psf_gauss(x,x0,y,y0,sigma,intensity)
+
 def draw_points(im, points, intensity):
     """Draws pixels to image from a given points array"""
-    data = points
-    particles = len(data)
-    for j in range(particles):
-        im[int(data[j,0]),int(data[j,1])] = im[int(data[j,0]),int(data[j,1])] + intensity 
-    return im   
-        
-@nb.jit([U8[:,:](U8[:,:],F[:,:],U8,F)], nopython = True, parallel = PARALLEL)                
+    return get_kernels(points.dtype).draw_points(im, points, intensity)
+
 def draw_psf(im, points, intensity, sigma):
-    """Draws psf to image from a given points array"""
-    height, width = im.shape
-    particles = len(points)
-    size = int(round(3*sigma))
-    for k in nb.prange(particles):
-        h0,w0  = points[k,0], points[k,1]
-        h,w = int(h0), int(w0) 
-        for i0 in range(h-size,h+size+1):
-            for j0 in range(w -size, w+size+1):
-                p = psf_gauss(i0,h0,j0,w0,sigma,intensity)
-                #j = j0 % width
-                #i = i0 % height
-                
-                # slightly faster implementation of flooring
-                if j0 >= width:
-                    j= j0 - width
-                elif j0 < 0:
-                    j = width + j0
-                else:
-                    j = j0
-                if i0>= height:
-                    i = i0 - height
-                elif i0 < 0:
-                    i = height + i0
-                else:
-                    i = i0
-                im[i,j] = im[i,j] + p
-    return im  
- 
-def particles_video(particles, shape = (512,512),
-                 background = 0, intensity = 10, sigma = None):
-    """Creates brownian particles video"""
-        
-    background = np.zeros(shape = shape,dtype = "uint8") + background
-    height, width = shape
+    """Draws psf to image from a given points array.
+    
+    Gaussian psf is separable, so only two one-dimensional profiles are computed
+    for each particle and pixel values are their outer product. The product 
+    can differ from psf_gauss in the last bits, so when truncated to uint8, 
+    a particle's contribution to a pixel can differ by one from psf_gauss. 
+    Particles are drawn sequentially, because their psfs overlap, use 
+    draw_psf_frames to render multiple frames in parallel."""
+    return get_kernels(points.dtype).draw_psf(im, points, intensity, sigma)
 
-    def get_frame(data):
-        im = background.copy()
-        if sigma is None:
-            im = draw_points(im, data, intensity)
-        else:
-            im = draw_psf(im, data, intensity, sigma)
-        return im
+def draw_psf_frames(frames, points, intensity, sigma, target = None):
+    """Draws psf to a block of frames, points[k] are drawn to frames[k].
+    With the parallel target, each frame is drawn by a single thread, so 
+    frames are rendered in parallel without data races."""
+    return get_kernels(points.dtype, target).draw_psf_frames(frames, points, intensity, sigma)
+
+def draw_points_frames(frames, points, intensity, target = None):
+    """Draws pixels to a block of frames, points[k] are drawn to frames[k]."""
+    return get_kernels(points.dtype, target).draw_points_frames(frames, points, intensity)
+
+def render_frames(points, shape = (512,512), background = 0, intensity = 10, sigma = None, out = None,
+                  dtype = None, target = None, read_noise = 0., shot_noise = False, gain = 1., 
+                  frame_dtype = "uint8"):
+    """Renders a block of frames from a block of particle positions.
+    
+    Frames are rendered with a camera model in a single compiled pass: 
+    particle signals are accumulated in float, background and noise are added
+    and values are rounded and saturated to the range of the frame dtype.
+    
+    Parameters
+    ----------
+    points : ndarray
+        Particle positions of shape (frames, particles, 2)
+    shape : (int,int)
+        Frame shape
+    background : float or ndarray
+        Background value or image
+    intensity : float
+        Particle intensity (peak value of the psf)
+    sigma : float, optional
+        Psf width. If not set, particles are drawn as points.
+    out : ndarray, optional
+        Output array of shape (frames,) + shape and uint8 or uint16 dtype
+    dtype : dtype, optional
+        Float dtype of the computation, defaults to the dtype of points, 
+        see get_kernels
+    target : str, optional
+        Target of the compiled kernels, see get_kernels
+    read_noise : float
+        Standard deviation of gaussian read noise
+    shot_noise : bool
+        If set, poisson noise of signal/gain electrons is added
+    gain : float
+        Pixel value of a single electron, used for shot noise
+    frame_dtype : dtype
+        Frame dtype, uint8 or uint16, used if out is not given
+    
+    Returns
+    -------
+    frames : ndarray
+        Rendered frames of shape (frames,) + shape
         
-    for i,data in enumerate(particles):
-        yield get_frame(data)
+    Notes
+    -----
+    With noise, the random generator is reseeded for each frame from a value
+    drawn from the calling thread's generator, so frames are the same for 
+    both targets after seed.
+    """
+    dtype = _array_dtype(points, dtype)
+    points = np.asarray(points, dtype)
+    if out is None:
+        out = np.empty((len(points),) + tuple(shape), frame_dtype)
+    max_value = np.iinfo(out.dtype).max
+    background = np.array(np.broadcast_to(np.asarray(background, dtype), out.shape[1:]))
+    sigma = 0. if sigma is None else sigma
+    kernels = get_kernels(dtype, target)
+    chunks = nb.get_num_threads() if kernels.target == "parallel" else 1
+    return kernels.camera_frames(out, points, intensity, sigma, background, 
+                                 gain, read_noise, bool(shot_noise), max_value, chunks)
+
+def particles_video_blocks(blocks, shape = (512,512), background = 0, intensity = 10, sigma = None, 
+                           target = None, **camera):
+    """Creates brownian particles video in blocks of frames, one block for each
+    block of particle positions, see brownian_particles_blocks. With the 
+    parallel target, frames of each block are rendered in parallel. See 
+    render_frames for camera parameters."""
+    for points in blocks:
+        yield render_frames(points, shape, background, intensity, sigma, target = target, **camera)
+
+def particles_video(particles, shape = (512,512), background = 0, intensity = 10, sigma = None, **camera):
+    """Creates brownian particles video. See render_frames for camera parameters."""
+    for data in particles:
+        yield render_frames(np.asarray(data)[None], shape, background, intensity, sigma, **camera)[0]
+
+def _pop_camera(kw):
+    #removes camera parameters from keyword arguments 
+    return {name : kw.pop(name) for name in CAMERA_PARAMETERS if name in kw}
 
 def test_plot(n = 5000, particles = 2):
     """Brownian particles usage example. Track 2 particles"""
@@ -199,15 +699,48 @@ def test_plot(n = 5000, particles = 2):
 
 
 def frame_grabber(nframes, shape = (256,256), intensity = 30, sigma = 2, **kw):
+    """Returns an iterator over frames of a brownian particles video. Frames 
+    are rendered in parallel in blocks, see brownian_particles_blocks and 
+    render_frames for additional keyword arguments."""
+    camera = _pop_camera(kw)
+    kw["n"] = nframes
+    kw["shape"] = shape
+    p = brownian_particles_blocks(**kw) 
+    for frames in particles_video_blocks(p, shape = shape, sigma = sigma, intensity = intensity, 
+                                         target = kw.get("target"), **camera):
+        for frame in frames:
+            yield frame
+
+def particles_video_file(file_name, nframes, shape = (256,256), intensity = 30, sigma = 2, fmt = None, **kw):
+    """Renders brownian particles video directly into a memory-mapped video 
+    file, so videos larger than memory can be created. 
+    
+    Frames are rendered in blocks, see brownian_particles_blocks and 
+    render_frames for additional keyword arguments and video.create_video for 
+    the file format.
+    
+    Returns
+    -------
+    video : VideoFile
+        Rendered video, opened for reading
+    """
+    camera = _pop_camera(kw)
+    frame_dtype = camera.pop("frame_dtype", "uint8")
     kw["n"] = nframes
     kw["shape"] = shape
-    p = brownian_particles(**kw) 
-    return particles_video(p, shape = shape, sigma = sigma, intensity = intensity) 
+    with create_video(file_name, nframes, shape, frame_dtype, fmt) as video:
+        i = 0
+        for points in brownian_particles_blocks(**kw):
+            render_frames(points, shape, intensity = intensity, sigma = sigma, 
+                          out = video[i:i+len(points)], target = kw.get("target"), **camera)
+            i += len(points)
+        fmt = video.fmt
+    return open_video(file_name, fmt = fmt)
 
 if __name__ == "__main__":
-    video = frame_grabber(1024, dt = 0.1) #this is an iterator
+    #video is rendered to a memory-mapped file, so it is not held in memory
+    video = particles_video_file("brownian_video.npy", 1024, dt = 0.1) 
     import viewer
-    video = list(video) #lets read it into memort by creating a list
     v1 = viewer.VideoViewer(video) 
     v1.show()
     test_plot()
\ No newline at end of file
@@ -1,10 +1,17 @@
 import numpy as np
 import scipy.constants
+import scipy.fft
+import scipy.optimize
 
 import matplotlib.pyplot as plt
 
+from tweezer.conf import TweezerConfig, CALIBRATION_MODES, calibration_mode_index
+
 KB = scipy.constants.Boltzmann
 
+# number of data values welch_psd transforms at once, 2**21 float64 values are 16 MB
+WELCH_CHUNK_SIZE = 2**21
+
 def subtract_moving_average(time, data, averaging_time):
     """Subtracts moving average from data.
 
@@ -13,13 +20,17 @@ def subtract_moving_average(time, data, averaging_time):
     and subtracts it from data.
     The data is shortened to the valid range, so there are no data 
     boundary effects.
+    The moving average is computed from a cumulative sum, so its cost 
+    does not depend on averaging_time, and all columns of data are 
+    averaged at once.
 
     Parameters
     ----------
     time : array_like
         time coordinates
     data : array_like
-        data to subtract moving average from
+        data to subtract moving average from, of shape (N,) or (N, k)
+        for k columns
     averaging_time :
         averaging time interval
 
@@ -56,9 +67,16 @@ def subtract_moving_average(time, data, averaging_time):
     elif n > len(data)/2.:
         raise ValueError("Too long averaging time.")
 
-    moving_average = np.convolve(data, np.ones(((int)(2*n),))/(float)(2*n), mode = 'valid')
-    new_data = data[n:-n+1] - moving_average
-    new_time = time[n:-n+1]
+    data = np.asarray(data)
+    # sums of data relative to the first point, this reduces rounding errors
+    offset = data[0]
+    cumsum = np.zeros((len(data) + 1,) + data.shape[1:])
+    np.cumsum(data - offset, axis=0, out=cumsum[1:])
+    moving_average = cumsum[2*n:] - cumsum[:-2*n]
+    moving_average /= 2*n
+    moving_average += offset
+    new_data = data[n:len(data)-n+1] - moving_average
+    new_time = time[n:len(time)-n+1]
 
     return new_data, moving_average, new_time
 
@@ -118,12 +136,167 @@ def center_and_rotate(xdata, ydata):
     return rotate(center(xdata), center(ydata))
 
 
-def calibrate(time, data, averaging_time=1., temp=293.):
+def welch_psd(data, dt, segment=4096, chunk_size=WELCH_CHUNK_SIZE):
+    """Computes one-sided power spectral density with Welch's method.
+
+    Data is split into segments of length segment with 50% overlap, each 
+    segment is subtracted its mean and multiplied by a Hann window. Spectra 
+    of segments are averaged. Segments of groups of columns are transformed
+    in chunks of about chunk_size values, so memory use does not depend on 
+    the length or the number of columns of data.
+
+    Parameters
+    ----------
+    data : array_like
+        data of shape (N,) or (N, k) for k signals
+    dt : float
+        time interval between data points
+    segment : int
+        segment length
+    chunk_size : int
+        number of values transformed at once, at least one segment of one
+        column is transformed at a time
+
+    Returns
+    -------
+    f : ndarray
+        frequencies of shape (segment//2 + 1,)
+    psd : ndarray
+        power spectral density of shape (segment//2 + 1,) or 
+        (segment//2 + 1, k) in data units squared per Hz
+
+    Raises
+    ------
+    ValueError
+        if data is shorter than segment.
+    """
+    data = np.asarray(data, dtype=float)
+    squeeze = data.ndim == 1
+    if squeeze:
+        data = data[:, None]
+    if len(data) < segment:
+        raise ValueError("Data is shorter than segment.")
+
+    step = segment//2
+    nsegments = (len(data) - segment)//step + 1
+    # periodic Hann window
+    window = 0.5 - 0.5*np.cos(2*np.pi*np.arange(segment)/segment)
+    # a view of shape (nsegments, k, segment), segments are not copied
+    segments = np.lib.stride_tricks.sliding_window_view(data, segment, axis=0)[::step]
+    psd = np.zeros((segment//2 + 1, data.shape[1]))
+    columns = max(1, chunk_size//segment)
+    chunk = max(1, chunk_size//(segment*min(columns, data.shape[1])))
+    for j in range(0, data.shape[1], columns):
+        for i in range(0, nsegments, chunk):
+            x = segments[i:i + chunk, j:j + columns]
+            x = (x - x.mean(axis=-1, keepdims=True))*window
+            spectrum = scipy.fft.rfft(x, axis=-1, overwrite_x=True)
+            psd[:, j:j + columns] += (spectrum.real**2 + spectrum.imag**2).sum(axis=0).T
+
+    psd *= dt/(window**2).sum()/nsegments
+    # one-sided density, zero and Nyquist frequency are not doubled
+    psd[1:(segment + 1)//2] *= 2
+    f = np.fft.rfftfreq(segment, dt)
+    return f, psd[:, 0] if squeeze else psd
+
+
+def aliased_lorentzian(f, fc, variance, dt):
+    """One-sided power spectral density of positions of a bead in a harmonic
+    trap, sampled at time interval dt.
+
+    The aliased Lorentzian is the exact spectrum of the sampled
+    Ornstein-Uhlenbeck process. For f << 1/dt it is the Lorentzian
+    D/(pi**2 (fc**2 + f**2)), where D = 2 pi fc variance.
+
+    Parameters
+    ----------
+    f : array_like
+        frequencies
+    fc : float
+        corner frequency
+    variance : float
+        variance of positions
+    dt : float
+        time interval between data points
+
+    Returns
+    -------
+    psd : ndarray
+        power spectral density in units of variance per Hz
+    """
+    c = np.exp(-2*np.pi*fc*dt)
+    return 2*variance*(1 - c**2)*dt/(1 + c**2 - 2*c*np.cos(2*np.pi*np.asarray(f)*dt))
+
+
+def fit_psd(f, psd, dt, fmin=None, fmax=None):
+    """Fits aliased Lorentzian to power spectral density.
+
+    Relative residuals psd/model - 1 are minimized, because the error of 
+    Welch-averaged spectra is proportional to the spectrum.
+
+    Parameters
+    ----------
+    f : array_like
+        frequencies
+    psd : array_like
+        one-sided power spectral density, see welch_psd
+    dt : float
+        time interval between data points
+    fmin, fmax : float, optional
+        fitted frequency range, zero frequency is always excluded
+
+    Returns
+    -------
+    fc : float
+        corner frequency
+    variance : float
+        variance of positions
+
+    Raises
+    ------
+    ValueError
+        if there are fewer than three points in the frequency range.
+    """
+    f, psd = np.asarray(f), np.asarray(psd)
+    mask = f > 0
+    if fmin is not None:
+        mask &= f >= fmin
+    if fmax is not None:
+        mask &= f <= fmax
+    f, psd = f[mask], psd[mask]
+    if len(f) < 3:
+        raise ValueError("Too few points in the frequency range.")
+
+    # initial corner frequency where the spectrum drops to half of its low-frequency value
+    below = psd < psd[:3].mean()/2.
+    fc = f[np.argmax(below)] if below.any() else f[-1]
+    variance = np.pi*fc*psd[:3].mean()/2.
+
+    def residuals(p):
+        return psd/aliased_lorentzian(f, np.exp(p[0]), np.exp(p[1]), dt) - 1
+
+    result = scipy.optimize.least_squares(residuals, np.log([fc, variance]))
+    fc, variance = np.exp(result.x)
+    return fc, variance
+
+
+def calibrate(time, data, averaging_time=1., temp=293., mode=None, bead_radius=0.5e-6, eta=9.7e-4, segment=4096):
     """Calibrates tweezer.
 
     Subtracts moving average from xdata and ydata,
     centers xdata and ydata and rotates positions so that k_x < k_y.
-    Computes k_x and k_y from variances.
+    Computes k_x and k_y from variances ("equipartition" mode) or from
+    Lorentzian fits of power spectra ("psd" mode).
+
+    In "psd" mode, stiffness is k = 2 pi gamma fc, where fc is the corner
+    frequency and gamma = 6 pi eta bead_radius is the Stokes drag, so it does 
+    not depend on detector calibration. Spectra are fitted above frequency 
+    2/averaging_time, where the moving average does not distort them.
+
+    Spectra are computed in chunks, see welch_psd, but drift removal and 
+    rotation work on the whole trace and the moving average is returned, so
+    memory use grows with the length of data: a few float arrays of the 
+    data shape are held at a time.
 
     Parameters
     ----------
@@ -135,6 +308,15 @@ def calibrate(time, data, averaging_time=1., temp=293.):
         averaging time interval
     temp : float
         temperature in kelvins
+    mode : str or int, optional
+        calibration mode, a name or index of conf.CALIBRATION_MODES, defaults 
+        to the [calibration] mode setting
+    bead_radius : float
+        radius of the bead [m], used in "psd" mode
+    eta : float
+        viscosity of the medium [Pa s], used in "psd" mode
+    segment : int
+        segment length of Welch-averaged spectra, see welch_psd
 
     Returns
     -------
@@ -150,13 +332,106 @@ def calibrate(time, data, averaging_time=1., temp=293.):
     TODO
 
     """
+    mode = _calibration_mode(mode)
     data = np.array(data)
-    x, x_average = subtract_moving_average(time, data[:, 0], averaging_time)[:2]
-    y, y_average = subtract_moving_average(time, data[:, 1], averaging_time)[:2]
-    trajectory, phi, var = center_and_rotate(x, y)
-    ks = KB*temp/var*1e12
+    new_data, average = subtract_moving_average(time, data[:, :2], averaging_time)[:2]
+    trajectory, phi, var = center_and_rotate(new_data[:, 0], new_data[:, 1])
+    if mode == "equipartition":
+        ks = KB*temp/var*1e12
+    else:
+        ks = _psd_stiffness(time, trajectory, averaging_time, bead_radius, eta, segment)
+
+    return tuple(ks), phi, average.T
+
 
-    return tuple(ks), phi, np.array([x_average, y_average])
+def _calibration_mode(mode):
+    """Returns calibration mode name of mode index or name, defaults to the
+    configured mode."""
+    if mode is None:
+        mode = TweezerConfig.calibration_mode
+    return CALIBRATION_MODES[calibration_mode_index(mode)]
+
+
+def _psd_stiffness(time, trajectory, averaging_time, bead_radius, eta, segment):
+    """Computes stiffnesses from power spectra of all columns of a centered 
+    and rotated trajectory, see calibrate."""
+    dt = (time[-1] - time[0])/(len(time) - 1)
+    f, psd = welch_psd(trajectory, dt, min(segment, len(trajectory)))
+    fc = np.array([fit_psd(f, column, dt, fmin=2./averaging_time)[0] for column in psd.T])
+    return 2*np.pi*6*np.pi*eta*bead_radius*fc
+
+
+def calibrate_many(time, data, averaging_time=1., temp=293., mode=None, bead_radius=0.5e-6, eta=9.7e-4, 
+                   segment=4096):
+    """Calibrates tweezer for multiple beads at once.
+
+    Same as calling calibrate for each bead, but drift removal, centering,
+    covariance matrices and their diagonalization are computed for all beads
+    at once, so calibrating many beads costs about the same as one bead.
+
+    Parameters
+    ----------
+    time : array_like
+        time coordinates
+    data : ndarray_like
+        x-coordinates and y-coordinates of P beads of shape (N, 2P): columns
+        2*i and 2*i+1 are x and y of the i-th bead, e.g. the trajectories 
+        returned by plotting.read_file or tracking.trajectories. Data must not
+        contain nan values.
+    averaging_time : float
+        averaging time interval
+    temp : float
+        temperature in kelvins
+    mode : str or int, optional
+        calibration mode, see calibrate
+    bead_radius : float
+        radius of the beads [m], used in "psd" mode
+    eta : float
+        viscosity of the medium [Pa s], used in "psd" mode
+    segment : int
+        segment length of Welch-averaged spectra, see welch_psd
+
+    Returns
+    -------
+    ks : ndarray
+        trap stiffnesses [N/m] of shape (P, 2), k_x < k_y for each bead
+    phi : ndarray
+        angles in anticlockwise direction by which positions were rotated, of 
+        shape (P,)
+    drift : ndarray
+        moving averages of x and y coordinates of shape (P, 2, M), where M is
+        the length of averaged data
+
+    Raises
+    ------
+    ValueError
+        if data does not have an even number of columns.
+    """
+    mode = _calibration_mode(mode)
+    data = np.asarray(data, dtype=float)
+    if data.ndim != 2 or data.shape[1] % 2:
+        raise ValueError("Data must have 2P columns.")
+    new_data, average = subtract_moving_average(time, data, averaging_time)[:2]
+    # batched 2x2 covariance matrices of centered x and y of all beads
+    m = len(new_data)
+    mean = new_data.mean(axis=0)
+    x, y = new_data[:, 0::2], new_data[:, 1::2]
+    cov = np.empty((len(mean)//2, 2, 2))
+    cov[:, 0, 0] = np.einsum("mp,mp->p", x, x) - m*mean[0::2]**2
+    cov[:, 1, 1] = np.einsum("mp,mp->p", y, y) - m*mean[1::2]**2
+    cov[:, 0, 1] = cov[:, 1, 0] = np.einsum("mp,mp->p", x, y) - m*mean[0::2]*mean[1::2]
+    cov /= m - 1
+    var, vec = np.linalg.eigh(cov)
+    phi = -np.arctan(vec[:, 1, 1]/vec[:, 0, 1])
+    if mode == "equipartition":
+        ks = KB*temp/var[:, ::-1]*1e12
+    else:
+        c, s = np.cos(phi), np.sin(phi)
+        x, y = x - mean[0::2], y - mean[1::2]
+        trajectory = np.stack((c*x - s*y, c*y + s*x), axis=-1).reshape(m, -1)
+        ks = _psd_stiffness(time, trajectory, averaging_time, bead_radius, eta, segment).reshape(-1, 2)
+    drift = average.T.reshape(-1, 2, len(average))
+    return ks, phi, drift
   
 def potential(time, data, averaging_time=1., temp=293.):
     """Calculates the potential.
@@ -191,9 +466,9 @@ def potential(time, data, averaging_time=1., temp=293.):
 
     """
     data = np.array(data)
-    x = subtract_moving_average(time, data[:, 0], averaging_time)[0]
-    y = subtract_moving_average(time, data[:, 1], averaging_time)[0]
-    trajectory, phi, var = center_and_rotate(x, y)
+    new_data = subtract_moving_average(time, data[:, :2], averaging_time)[0]
+    x = new_data[:, 0]
+    trajectory, phi, var = center_and_rotate(x, new_data[:, 1])
     
     positions = [0, 0]
     potential_values = [0, 0]
@@ -2,7 +2,7 @@
 Configuration and constants
 """
 from __future__ import absolute_import, print_function, division
-import os, warnings, shutil
+import os, warnings, shutil, operator
 
 try:
     from configparser import ConfigParser
@@ -67,6 +67,26 @@ def _readconfig(func, section, name, default):
         return func(section, name)
     except:
         return default
+
+#: if set, compiled numba kernels are cached on disk in NUMBA_CACHE_DIR
+NUMBA_CACHE = _readconfig(config.getboolean, "numba", "cache", True)
+
+#NUMBA_CACHE_DIR environment variable takes precedence over the default folder
+NUMBA_CACHE_DIR = os.environ.get("NUMBA_CACHE_DIR", NUMBA_CACHE_DIR)
+
+def configure_numba_cache():
+    """Sets numba's cache folder to NUMBA_CACHE_DIR if NUMBA_CACHE is set.
+    
+    The folder is set in numba's config, so that the process environment is
+    not modified. Numba reads the folder when a function is decorated, but it
+    resets its config from the environment whenever a NUMBA_* environment 
+    variable changes, so this must be called again before kernels are 
+    compiled lazily, see brownian.get_kernels."""
+    if NUMBA_CACHE:
+        import numba.core.config
+        numba.core.config.CACHE_DIR = NUMBA_CACHE_DIR
+
+configure_numba_cache()
     
 def is_module_installed(name):
     """Checks whether module with name 'name' is istalled or not"""
@@ -80,11 +100,18 @@ NUMBA_INSTALLED = is_module_installed("numba")
 MKL_FFT_INSTALLED = is_module_installed("mkl_fft")
 SCIPY_INSTALLED = is_module_installed("scipy")
 
+#: beam calibration modes of calibration.calibrate, the [calibration] mode 
+#: setting is an index into this tuple
+CALIBRATION_MODES = ("equipartition", "psd")
+
 class TweezerConfig(object):
     """Tweezer settings are here. You should use the set_* functions in the
     conf.py module to set these values"""
     def __init__(self):
         self.verbose = _readconfig(config.getint, "default", "verbose",0)
+        self.calibration_mode = _readconfig(config.getint, "calibration", "mode",0)
+        self.precision = _readconfig(config.get, "brownian", "precision","double")
+        self.target = _readconfig(config.get, "brownian", "target","cpu")
         
     def __getitem__(self, item):
         return self.__dict__[item]
@@ -107,5 +134,48 @@ def set_verbose(level):
     TweezerConfig.verbose = max(0,int(level))
     return out
 
+def set_precision(precision):
+    """Sets default floating point precision ("single" or "double") of 
+    the brownian simulation kernels."""
+    if precision not in ("single", "double"):
+        raise ValueError("Invalid precision {}".format(precision))
+    out = TweezerConfig.precision
+    TweezerConfig.precision = precision
+    return out
+
+def calibration_mode_index(mode):
+    """Returns the index of a beam calibration mode, given as an index (0-1)
+    or a name from CALIBRATION_MODES. Raises ValueError for invalid modes."""
+    if mode in CALIBRATION_MODES:
+        return CALIBRATION_MODES.index(mode)
+    try:
+        index = operator.index(mode)
+    except TypeError:
+        raise ValueError("Invalid calibration mode {}".format(mode))
+    if not 0 <= index < len(CALIBRATION_MODES):
+        raise ValueError("Invalid calibration mode {}".format(mode))
+    return index
+
+def set_calibration_mode(mode):
+    """Sets default beam calibration mode of calibration.calibrate, an index
+    (0-1) or a name from CALIBRATION_MODES."""
+    index = calibration_mode_index(mode)
+    out = TweezerConfig.calibration_mode
+    TweezerConfig.calibration_mode = index
+    return out
+
+def set_target(target):
+    """Sets default target ("cpu" or "parallel") of the brownian simulation 
+    kernels. Both targets give the same walks and frames after 
+    brownian.seed, "parallel" walks particles and renders frames on all 
+    threads. The default is "cpu", because the parallel target starts numba's
+    thread pool and process pools forked after that may hang, use the 
+    "spawn" start method with the parallel target."""
+    if target not in ("cpu", "parallel"):
+        raise ValueError("Invalid target {}".format(target))
+    out = TweezerConfig.target
+    TweezerConfig.target = target
+    return out
+
 
     
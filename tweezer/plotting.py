@@ -52,11 +52,7 @@ def trajectory_plot(time, data, averaging_time=1.):
 
     """
     data = np.array(data)
-    x, x_average, _ = cal.subtract_moving_average(time, data[:, 0], averaging_time)
-    y, y_average, time = cal.subtract_moving_average(time, data[:, 1], averaging_time)
-    
-    trajectory = np.stack((x, y), axis=1)
-    trajectory_averaged = np.stack((x_average, y_average), axis=1)
+    trajectory, trajectory_averaged, time = cal.subtract_moving_average(time, data[:, :2], averaging_time)
 
     fig = plt.figure()
     titles = ['x', 'y']
@@ -79,9 +75,8 @@ def calibration_plots(time, data, averaging_time=1., temp=293.):
 
     """
     data = np.array(data)
-    x = cal.subtract_moving_average(time, data[:, 0], averaging_time)[0]
-    y = cal.subtract_moving_average(time, data[:, 1], averaging_time)[0]
-    trajectory, phi, var = cal.center_and_rotate(x, y)
+    new_data = cal.subtract_moving_average(time, data[:, :2], averaging_time)[0]
+    trajectory, phi, var = cal.center_and_rotate(new_data[:, 0], new_data[:, 1])
     k = cal.KB*temp/var*1e12
 
     def scatter_plot(data, trajectory, phi):
@@ -0,0 +1,194 @@
+"""
+Streaming preprocessing of video frames
+
+Frames of real microscope videos have uneven illumination and slowly drifting
+backgrounds, and beads in traps occupy only small regions of a large sensor.
+The functions in this module work on iterators over blocks of frames, see
+tracking.frame_blocks, so they can be chained in front of the tracker without
+keeping the video in memory:
+
+* crop_rois cuts regions of interest (ROIs) around trap positions, so that
+  all further work scales with the ROI area instead of the frame area.
+* subtract_background subtracts a running mean or an approximate running
+  median background, updated at O(1) cost per pixel and frame.
+* locate_rois locates particles in the ROIs with tracking.locate_frames and
+  returns features in frame coordinates, ready for tracking.link.
+
+Examples
+--------
+>>> import tweezer.brownian as brownian
+>>> traps = [[64,64],[64,128]]
+>>> video = brownian.frame_grabber(1024, shape = (256,256), particles = 10)
+>>> rois = subtract_background(crop_rois(video, traps, (32,32)), rate = 0.01)
+>>> features = locate_rois(rois, roi_origins(traps, (32,32)), threshold = 10)
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import numba as nb
+
+from tweezer.conf import NUMBA_CACHE
+from tweezer.tracking import frame_blocks, locate_frames, fit_gaussians, roi_origins, check_rois, \
+    FEATURE_DTYPE, GAUSSIAN_DTYPE
+
+#: available background estimates, see subtract_background
+BACKGROUND_METHODS = ("mean", "median")
+
+@nb.njit(cache = NUMBA_CACHE)
+def _crop(frames, origins, out):
+    n, p, h, w = out.shape
+    for k in range(n):
+        for l in range(p):
+            i0, j0 = origins[l,0], origins[l,1]
+            for i in range(h):
+                for j in range(w):
+                    out[k,l,i,j] = frames[k,i0+i,j0+j]
+
+@nb.njit(cache = NUMBA_CACHE)
+def _running_mean(frames, background, rate, out):
+    """Subtracts an exponential moving average from frames of shape (n, m),
+    background of shape (m,) is updated after each frame."""
+    n, m = frames.shape
+    for k in range(n):
+        for j in range(m):
+            x = frames[k,j]
+            out[k,j] = x - background[j]
+            background[j] += rate*(x - background[j])
+
+@nb.njit(cache = NUMBA_CACHE)
+def _running_median(frames, background, rate, out):
+    """Subtracts an approximate median from frames of shape (n, m). The
+    estimate of shape (m,) is moved by rate towards each new value, so it
+    converges to the median of the pixel values."""
+    n, m = frames.shape
+    for k in range(n):
+        for j in range(m):
+            x = frames[k,j]
+            out[k,j] = x - background[j]
+            if x > background[j]:
+                background[j] += rate
+            elif x < background[j]:
+                background[j] -= rate
+
+def crop_rois(video, centers, shape, block = 256):
+    """Crops ROIs of a given shape around centers from frames of a video.
+
+    Parameters
+    ----------
+    video : iterable
+        Frames of a video, a 3D array, a video.VideoFile or an iterator of
+        2D frames, see tracking.frame_blocks
+    centers : array_like
+        ROI centers of shape (P,2), e.g. trap positions in pixels
+    shape : (int,int)
+        ROI shape
+    block : int
+        Number of frames in a block
+
+    Yields
+    ------
+    rois : ndarray
+        Block of ROIs of shape (n, P) + shape, of the video data type. ROI
+        top-left corners in the frame are given by roi_origins(centers, shape).
+    """
+    shape = tuple(int(n) for n in shape)
+    origins = roi_origins(centers, shape)
+    for frames in frame_blocks(video, block):
+        check_rois(origins, shape, frames.shape[1:])
+        rois = np.empty((len(frames), len(origins)) + shape, frames.dtype)
+        _crop(frames, origins, rois)
+        yield rois
+
+def subtract_background(blocks, method = "mean", rate = 0.01, background = None, dtype = "float32"):
+    """Subtracts a slowly varying background from blocks of frames or ROIs.
+
+    Each frame is subtracted the background estimate of all previous frames,
+    then the estimate is updated with the frame. Both methods cost O(1) per
+    pixel and frame and keep only the estimate in memory. A bead that stays at
+    the same position for about 1/rate frames ("mean") becomes part of the
+    background, so rate should be small compared to the bead motion.
+
+    Parameters
+    ----------
+    blocks : iterable
+        Blocks of frames of shape (n, height, width) or blocks of ROIs of
+        shape (n, P, height, width), see crop_rois
+    method : str
+        "mean" for an exponential moving average with weight rate, or "median"
+        for an approximate running median that moves by rate intensity units
+        towards each new value
+    rate : float
+        Update rate of the background estimate
+    background : ndarray, optional
+        Initial background estimate of the frame (or ROIs) shape, e.g. a frame
+        without beads. Defaults to the first frame.
+    dtype : dtype
+        Output data type
+
+    Yields
+    ------
+    frames : ndarray
+        Blocks of background-subtracted frames
+    """
+    if method not in BACKGROUND_METHODS:
+        raise ValueError("method must be one of {}".format(BACKGROUND_METHODS))
+    kernel = _running_mean if method == "mean" else _running_median
+    dtype = np.dtype(dtype)
+    if background is not None:
+        background = np.array(background, dtype)
+    for frames in blocks:
+        frames = np.ascontiguousarray(frames)
+        n = len(frames)
+        if background is None:
+            background = frames[0].astype(dtype)
+        if background.shape != frames.shape[1:]:
+            raise ValueError("Background must be of shape {}".format(frames.shape[1:]))
+        out = np.empty(frames.shape, dtype)
+        kernel(frames.reshape(n, -1), background.reshape(-1), dtype.type(rate), out.reshape(n, -1))
+        yield out
+
+def locate_rois(blocks, origins, threshold, radius = 3, fit = False):
+    """Locates particles in blocks of ROIs.
+
+    Parameters
+    ----------
+    blocks : iterable
+        Blocks of ROIs of shape (n, P, height, width), see crop_rois
+    origins : ndarray
+        ROI top-left corners in the frame of shape (P,2), see roi_origins
+    threshold : float
+        Intensity threshold, see tracking.locate_frames. For background-
+        subtracted ROIs it is a threshold above the background.
+    radius : int
+        Window radius, see tracking.locate_frames
+    fit : bool
+        If set, positions are refined with gaussian fits, see
+        tracking.fit_gaussians
+
+    Returns
+    -------
+    features : ndarray
+        Features in frame coordinates, sorted by frame, see tracking.locate_video
+    """
+    origins = np.asarray(origins)
+    features = []
+    start = 0
+    for rois in blocks:
+        n, p = rois.shape[:2]
+        if p != len(origins):
+            raise ValueError("Number of ROIs does not match the number of origins")
+        #each ROI is located as a separate frame of index frame*p + roi
+        frames = rois.reshape((n*p,) + rois.shape[2:])
+        f = locate_frames(frames, threshold, radius)
+        if fit:
+            f = fit_gaussians(frames, f, radius)
+        frame, roi = np.divmod(f["frame"], p)
+        f["frame"] = frame + start
+        f["x"] += origins[roi,0]
+        f["y"] += origins[roi,1]
+        features.append(f)
+        start += n
+    if features:
+        return np.concatenate(features)
+    return np.empty(0, GAUSSIAN_DTYPE if fit else FEATURE_DTYPE)
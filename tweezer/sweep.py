@@ -0,0 +1,165 @@
+"""
+Parameter sweeps of synthetic active trajectories
+
+Runs synth_active_trajectory.simulate over a grid of trap and bead parameters
+in a pool of worker processes. Every job gets its own reproducible random
+stream, derived from a master seed and the job index. Results of finished
+jobs can be stored in a folder, so that an interrupted sweep can be resumed.
+"""
+from __future__ import absolute_import, print_function, division
+
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import numba as nb
+
+import tweezer.synth_active_trajectory as sat
+
+#: default simulation parameters; values in the grid override these
+DEFAULT_PARAMETERS = dict(trap_kx=1e-6, trap_ky=1e-6, trap_xfreq=0., trap_yfreq=0., trap_xamp=0., trap_yamp=0.,
+                          bead_radius=0.5e-6, eta=9.7e-4, temp=293., motion_type=1)
+
+def parameter_grid(**values):
+    """Creates a list of parameter sets from all combinations of given values.
+
+    Parameters
+    ----------
+    values : sequences of floats
+        parameter values, keyword names are the parameter names of
+        synth_active_trajectory.simulate
+
+    Returns
+    -------
+    grid : list of dicts
+        one dict of parameters for each job
+
+    Examples
+    --------
+    >>> grid = parameter_grid(trap_kx=[1e-6, 2e-6], eta=[1e-3, 2e-3, 3e-3])
+    >>> len(grid)
+    6
+    """
+    names = list(values.keys())
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+def job_seeds(seed, njobs):
+    """Returns independent seeds, one for each job of the sweep."""
+    return [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(njobs)]
+
+def _job_file(out_dir, index):
+    return os.path.join(out_dir, "job_{:06d}.npz".format(index))
+
+def _load_job(file_name, parameters, seed, num_points, dt, integrator):
+    """Loads k estimates of a finished job, if the file exists and was
+    computed with the same parameters, seed, number of points, time step and
+    integrator. Returns None otherwise."""
+    if not os.path.exists(file_name):
+        return None
+    try:
+        with np.load(file_name) as f:
+            same = (int(f["seed"]) == seed and int(f["num_points"]) == num_points and float(f["dt"]) == float(dt)
+                    and str(f["integrator"]) == integrator
+                    and all(float(f[name]) == float(value) for name, value in parameters.items()))
+            if same:
+                return float(f["kx_estimate"]), float(f["ky_estimate"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+def _init_worker():
+    #each process runs a single thread, parallelism comes from the pool
+    nb.set_num_threads(1)
+    sat.warmup()
+
+def run_job(job):
+    """Runs a single simulation job.
+
+    Parameters
+    ----------
+    job : tuple
+        (index, parameters, seed, num_points, dt, integrator, out_dir,
+        save_trajectories) tuple, as created by run_sweep
+
+    Returns
+    -------
+    kx_estimate, ky_estimate : float
+        estimated trap stiffnesses
+    """
+    index, parameters, seed, num_points, dt, integrator, out_dir, save_trajectories = job
+
+    if out_dir is not None:
+        file_name = _job_file(out_dir, index)
+        result = _load_job(file_name, parameters, seed, num_points, dt, integrator)
+        if result is not None:
+            return result
+
+    kwargs = dict(DEFAULT_PARAMETERS)
+    kwargs.update(parameters)
+    time, poz, trap_poz = sat.simulate(num_points, dt, seed=seed, integrator=integrator, **kwargs)
+    kx_estimate, ky_estimate = sat.estimate_stiffness(poz, kwargs["temp"])
+
+    if out_dir is not None:
+        data = dict(parameters, seed=seed, num_points=num_points, dt=dt, integrator=integrator,
+                    kx_estimate=kx_estimate, ky_estimate=ky_estimate)
+        if save_trajectories:
+            data.update(time=time, poz=poz, trap_poz=trap_poz)
+        #write to a temporary file first, so that an interrupted write is never mistaken for a finished job
+        tmp_name = file_name + ".tmp.npz"
+        np.savez(tmp_name, **data)
+        os.replace(tmp_name, file_name)
+    return kx_estimate, ky_estimate
+
+def run_sweep(grid, num_points, dt, seed=0, out_dir=None, max_workers=None, integrator="exact", save_trajectories=False):
+    """Runs simulations for all parameter sets of the grid in parallel.
+
+    Parameters
+    ----------
+    grid : list of dicts
+        parameter sets, see parameter_grid
+    num_points : int
+        # of data points to generate in each job
+    dt : float
+        time interval between two consecutive points [s]
+    seed : int
+        master seed; job i uses the i-th seed of job_seeds(seed, len(grid))
+    out_dir : string, optional
+        folder for job results. Jobs with results already in this folder,
+        computed with the same parameters, seed, num_points, dt and
+        integrator, are not computed again.
+    max_workers : int, optional
+        number of worker processes, defaults to the number of processors
+    integrator : str
+        integrator used by the simulation, see synth_active_trajectory.simulate
+    save_trajectories : bool
+        if True, simulated time, bead and trap positions are stored in
+        job files as well
+
+    Returns
+    -------
+    table : ndarray
+        structured array with one row per job; fields are the job index,
+        parameter names, seed, kx_estimate and ky_estimate
+    """
+    if out_dir is not None and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    seeds = job_seeds(seed, len(grid))
+    jobs = [(i, parameters, s, num_points, dt, integrator, out_dir, save_trajectories)
+            for i, (parameters, s) in enumerate(zip(grid, seeds))]
+
+    #numba threading layers are not fork-safe, so workers are always spawned
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker) as executor:
+        results = list(executor.map(run_job, jobs))
+
+    names = sorted(set(name for parameters in grid for name in parameters))
+    dtype = [("job", int)] + [(name, float) for name in names] + [("seed", np.int64), ("kx_estimate", float), ("ky_estimate", float)]
+    table = np.zeros(len(grid), dtype=dtype)
+    table["job"] = np.arange(len(grid))
+    for name in names:
+        table[name] = [parameters.get(name, DEFAULT_PARAMETERS[name]) for parameters in grid]
+    table["seed"] = seeds
+    table["kx_estimate"], table["ky_estimate"] = np.array(results).reshape(-1, 2).T
+    return table
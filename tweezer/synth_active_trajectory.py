@@ -1,11 +1,29 @@
+import cmath
 import math
 import random
 import statistics
 
 import numpy as np
+import numba as nb
 import scipy.constants as constants
 
-def SAT1(file_name, num_points, dt, trap_k, trap_frequency, trap_amplitude, bead_radius, eta):
+from tweezer.conf import NUMBA_CACHE
+
+#: internal time step of the SAT2 simulation [s]
+DT_INTERNAL = 0.0001
+
+#: maximum number of beads that are advanced together by the ensemble kernels
+ENSEMBLE_GROUP = 256
+
+#: number of internal steps of the Euler ensemble kernel with random numbers
+#: drawn at a time; the random stream of each bead is reseeded from itself
+#: after each chunk
+NOISE_CHUNK = 2048
+
+#: SAT2 output line; columns are read back by plotting.read_file
+SAT2_LINE_FORMAT = "%3.5f\t\t\t%3.3f\t%3.3f\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t%3.4f\t%3.4f\t\n"
+
+def SAT1(file_name, num_points, dt, trap_k, trap_frequency, trap_amplitude, bead_radius, eta, seed=None):
     """Simulates the Brownian motion of a colloidal bead trapped in an optical trap oscillating in the x direction.
     
     Originally implemented in MATLAB by Natan Osterman, advised by Andrej Vilfan, 23.3.2012.
@@ -29,6 +47,9 @@ def SAT1(file_name, num_points, dt, trap_k, trap_frequency, trap_amplitude, bead
         radius of trapped particle [m]
     eta : float
         viscosity of medium [Pa s]
+    seed : int, optional
+        if given, a private random generator seeded with this value is used
+        instead of the global random module
 
     Note
     ----
@@ -46,6 +67,7 @@ def SAT1(file_name, num_points, dt, trap_k, trap_frequency, trap_amplitude, bead
     
     print("Calculating ...")
     fout = open(file_name, "w")
+    rand = random.random if seed is None else random.Random(seed).random
 
     kBT = constants.Boltzmann*300  # assumption: T=300K
     a = bead_radius
@@ -73,7 +95,7 @@ def SAT1(file_name, num_points, dt, trap_k, trap_frequency, trap_amplitude, bead
             time[i-1] = t
         t += dt_internal
         last_sample_interval += dt_internal
-        noise = [(2*random.random()-1)*math.sqrt(3),(2*random.random()-1)*math.sqrt(3)]
+        noise = [(2*rand()-1)*math.sqrt(3),(2*rand()-1)*math.sqrt(3)]
         trap_x = [trap_amplitude*math.sin(2*math.pi*trap_frequency*t),0]
         dx = ((-trap_k*dt_internal)/(6*math.pi*eta*a))*(np.array(x)-np.array(trap_x))+(math.sqrt(2*kBT/(6*math.pi*eta*a))*math.sqrt(dt_internal))*np.array(noise)
         x += dx
@@ -90,7 +112,7 @@ def SAT1(file_name, num_points, dt, trap_k, trap_frequency, trap_amplitude, bead
 
     return kx_calculated*1e6, ky_calculated*1e6
 
-def SAT2(file_name, num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp, bead_radius, eta, temp=293, motion_type=1):
+def SAT2(file_name, num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp, bead_radius, eta, temp=293, motion_type=1, seed=None):
     """Simulates the Brownian motion of a colloidal bead trapped in an optical trap oscillating in x and y directions.
 
     Parameters
@@ -123,6 +145,9 @@ def SAT2(file_name, num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, tr
         governs trap motions and can take values 1 or 2.
         1: sinusoidal motion in x,y (default)
         2: linear motion in x,y; in this case, frequency parameters are ignored and the amplitudes become velocities in [m/s]
+    seed : int, optional
+        if given, a private random generator seeded with this value is used
+        instead of the global random module
 
     Note
     ----
@@ -142,13 +167,14 @@ def SAT2(file_name, num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, tr
     ValueError
         if times between consecutive output points are less than timestep of simulation
     """
-    dt_internal=0.0001   #   internal time step used for simulation [s]
+    dt_internal=DT_INTERNAL   #   internal time step used for simulation [s]
 
     if (dt <= dt_internal):
         raise ValueError("dt must be longer than time step of simulation")
 
     print("\nCalculating ...")
     fout = open(file_name, "w")
+    rand = random.random if seed is None else random.Random(seed).random
 
     kBT = constants.Boltzmann*temp   #   assumption: T=300K
     a = bead_radius
@@ -170,14 +196,14 @@ def SAT2(file_name, num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, tr
         if last_sample_interval > dt:
             last_sample_interval -= dt
             i += 1
-            fout.write("%3.5f\t\t\t%3.3f\t%3.3f\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t\t%3.4f\t%3.4f\t\n" % (t,trap_x[0]*1e6,trap_x[1]*1e6,x[0]*1e6,x[1]*1e6))
+            fout.write(SAT2_LINE_FORMAT % (t,trap_x[0]*1e6,trap_x[1]*1e6,x[0]*1e6,x[1]*1e6))
             poz[i-1,:] = x
             trap_poz[i-1,:] = trap_x
             time[i-1] = t
         t += dt_internal
         last_sample_interval += dt_internal
-        noise[0] = (2*random.random()-1)*math.sqrt(3)
-        noise[1] = (2*random.random()-1)*math.sqrt(3)
+        noise[0] = (2*rand()-1)*math.sqrt(3)
+        noise[1] = (2*rand()-1)*math.sqrt(3)
 
         if (motion_type == 1):
             trap_x[0] = trap_xamp*math.sin(2*math.pi*trap_xfreq*t)
@@ -200,3 +226,599 @@ def SAT2(file_name, num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, tr
     ky_estimate=kBT/statistics.mean(k_estimate[:,1])*1e6
 
     return kx_estimate, ky_estimate
+
+
+@nb.njit(cache=NUMBA_CACHE)
+def _uniform_noise(noise, seeds):
+    """Fills noise[:,m] with uniform random numbers of bead m. If seeds is not
+    empty, the generator is seeded with seeds[m] before bead m and seeds[m] is
+    replaced by a seed drawn from the stream of bead m, so that the stream can
+    be continued in the next call."""
+    for m in range(noise.shape[1]):
+        if len(seeds) > 0:
+            np.random.seed(seeds[m])
+        for c in range(noise.shape[0]):
+            noise[c,m,0] = np.random.random()
+            noise[c,m,1] = np.random.random()
+        if len(seeds) > 0:
+            seeds[m] = np.random.randint(0, 2**31)
+
+@nb.njit(cache=NUMBA_CACHE)
+def _normal_noise(noise, seeds):
+    """Fills noise[m] with normal random numbers of bead m. If seeds is not
+    empty, the generator is seeded with seeds[m] before bead m."""
+    for m in range(noise.shape[0]):
+        if len(seeds) > 0:
+            np.random.seed(seeds[m])
+        for i in range(noise.shape[1]):
+            for j in range(2):
+                noise[m,i,j] = np.random.randn()
+
+@nb.njit(cache=NUMBA_CACHE)
+def _sat2_kernel(state, time, poz, trap_poz, path, dt, dt_internal, trap_k, trap_freq, trap_amp, gamma, kBT, motion_type, seeds, noise):
+    """Compiled SAT2 integration loop for M beads with the same sample times.
+    Fills time and (M,n,2) arrays poz and trap_poz and updates the (M,6) state
+    with rows [t, last_sample_interval, x, y, trap_x, trap_y] in place, so
+    that the simulation can be continued with another call. For motion_type 3,
+    the trap of bead m is at path[m,i] from sample i to sample i+1.
+
+    All beads are advanced together one internal step at a time, so the trap
+    motion is computed once for consecutive beads with equal frequencies.
+    Random numbers are drawn to the (chunk,M,2) noise buffer chunk steps at
+    a time, see _uniform_noise."""
+    beads = len(state)
+    t, last_sample_interval = state[0,0], state[0,1]
+    x = state[:,2:4].copy()
+    trap = state[:,4:6].copy()
+    drift = dt_internal/gamma
+    scale = np.sqrt(2*kBT/gamma)*math.sqrt(dt_internal)*math.sqrt(3)
+
+    chunk = len(noise)
+    c = chunk
+    sx, sy = 0., 0.
+    i = 0
+    num_points = len(time)
+    while i < num_points:
+        if last_sample_interval > dt:
+            last_sample_interval -= dt
+            time[i] = t
+            for m in range(beads):
+                if motion_type == 3:
+                    trap[m,0], trap[m,1] = path[m,i,0], path[m,i,1]
+                poz[m,i,0], poz[m,i,1] = x[m,0], x[m,1]
+                trap_poz[m,i,0], trap_poz[m,i,1] = trap[m,0], trap[m,1]
+            i += 1
+            if i == num_points:
+                break
+        t += dt_internal
+        last_sample_interval += dt_internal
+        if c == chunk:
+            _uniform_noise(noise, seeds)
+            c = 0
+
+        for m in range(beads):
+            if motion_type == 1:
+                if m == 0 or trap_freq[m,0] != trap_freq[m-1,0]:
+                    sx = math.sin(2*math.pi*trap_freq[m,0]*t)
+                if m == 0 or trap_freq[m,1] != trap_freq[m-1,1]:
+                    sy = math.cos(2*math.pi*trap_freq[m,1]*t)
+                trap[m,0] = trap_amp[m,0]*sx
+                trap[m,1] = trap_amp[m,1]*sy
+            elif motion_type == 2:
+                trap[m,0] = trap_amp[m,0]*t
+                trap[m,1] = trap_amp[m,1]*t
+            for j in range(2):
+                x[m,j] += drift[m]*trap_k[m,j]*(trap[m,j] - x[m,j]) + scale[m]*(2*noise[c,m,j] - 1)
+        c += 1
+
+    state[:,0], state[:,1] = t, last_sample_interval
+    state[:,2:4] = x
+    state[:,4:6] = trap
+
+@nb.njit(cache=NUMBA_CACHE)
+def _ou_coefficients(lam, D, dt):
+    """Returns decay factor E = exp(-lam*dt) and standard deviation
+    of the exact OU transition over time dt."""
+    if lam > 0.:
+        return math.exp(-lam*dt), math.sqrt(-D*math.expm1(-2*lam*dt)/lam)
+    return 1., math.sqrt(2*D*dt)
+
+@nb.njit(cache=NUMBA_CACHE)
+def _sat_exact_kernel(state, time, poz, trap_poz, path, dt, trap_k, trap_freq, trap_amp, gamma, kBT, motion_type, seeds):
+    """Compiled exact Ornstein-Uhlenbeck propagator for M beads. Advances
+    directly from sample to sample; arrays and the state layout are the same
+    as in _sat2_kernel. Random numbers of all samples are first drawn to poz,
+    see _normal_noise, then beads are advanced together, so the trap motion
+    is computed once for consecutive beads with equal frequencies.
+
+    The trap term lam*int_t^{t+dt} exp(-lam*(t+dt-s))*trap(s) ds is integrated
+    analytically. For a sinusoidal trap amp*sin(w*t + phase) it equals
+    Im(K*exp(1j*(w*t + phase))) with K = amp*lam/(lam + 1j*w)*(exp(1j*w*dt) - E).
+    For a trap path, which is constant between samples, it equals (1 - E)*path[i]."""
+    beads = len(state)
+    t = state[0,0]
+    x = state[:,2:4].copy()
+    phase = np.array([0., math.pi/2]) #sine in x, cosine in y
+    w = 2*math.pi*trap_freq
+    lam = np.empty((beads,2))
+    E = np.empty((beads,2))
+    std = np.empty((beads,2))
+    K = np.zeros((beads,2), dtype=np.complex128)
+    for m in range(beads):
+        for j in range(2):
+            lam[m,j] = trap_k[m,j]/gamma[m]
+            E[m,j], std[m,j] = _ou_coefficients(lam[m,j], kBT[m]/gamma[m], dt)
+            if lam[m,j] > 0.:
+                K[m,j] = trap_amp[m,j]*lam[m,j]/(lam[m,j] + 1j*w[m,j])*(cmath.exp(1j*w[m,j]*dt) - E[m,j])
+
+    _normal_noise(poz, seeds)
+    c = np.zeros(2)
+    s = np.zeros(2)
+    for i in range(len(time)):
+        time[i] = t
+        for m in range(beads):
+            for j in range(2):
+                noise = poz[m,i,j]
+                poz[m,i,j] = x[m,j]
+                if motion_type == 1:
+                    if m == 0 or w[m,j] != w[m-1,j]:
+                        c[j], s[j] = math.cos(w[m,j]*t + phase[j]), math.sin(w[m,j]*t + phase[j])
+                    trap_poz[m,i,j] = trap_amp[m,j]*s[j]
+                    trap_term = K[m,j].imag*c[j] + K[m,j].real*s[j]
+                elif motion_type == 3:
+                    trap_poz[m,i,j] = path[m,i,j]
+                    trap_term = (1 - E[m,j])*path[m,i,j]
+                else:
+                    trap_poz[m,i,j] = trap_amp[m,j]*t
+                    trap_term = trap_amp[m,j]*((t + dt) - t*E[m,j] - (1 - E[m,j])/lam[m,j]) if lam[m,j] > 0. else 0.
+                x[m,j] = E[m,j]*x[m,j] + trap_term + std[m,j]*noise
+        t += dt
+    state[:,0] = t
+    state[:,2:4] = x
+    state[:,4] = trap_poz[:,-1,0]
+    state[:,5] = trap_poz[:,-1,1]
+
+@nb.njit(parallel=True, cache=NUMBA_CACHE)
+def _ensemble_kernel(state, time, poz, trap_poz, path, dt, trap_k, trap_freq, trap_amp, gamma, kBT, motion_type, exact, seeds, groups):
+    """Runs the Euler or exact kernel for M beads, split into groups of
+    consecutive beads that are simulated in parallel. Parameter arrays have
+    shape (M,2) or (M,), state has shape (M,6) and output position arrays and
+    trap path have shape (M,n,2). If seeds is not empty, random numbers of
+    bead m are drawn from a stream seeded with seeds[m], so results depend
+    neither on the number of threads nor on the number of groups."""
+    beads = len(state)
+    for g in nb.prange(groups):
+        start, stop = g*beads//groups, (g + 1)*beads//groups
+        #sample times are the same for all beads, only the first group writes them
+        t = time if g == 0 else np.empty_like(time)
+        s = seeds[start:stop] if len(seeds) > 0 else seeds
+        if exact:
+            _sat_exact_kernel(state[start:stop], t, poz[start:stop], trap_poz[start:stop], path[start:stop], dt,
+                              trap_k[start:stop], trap_freq[start:stop], trap_amp[start:stop], gamma[start:stop], kBT[start:stop],
+                              motion_type, s)
+        else:
+            noise = np.empty((NOISE_CHUNK, stop - start, 2))
+            _sat2_kernel(state[start:stop], t, poz[start:stop], trap_poz[start:stop], path[start:stop], dt, DT_INTERNAL,
+                         trap_k[start:stop], trap_freq[start:stop], trap_amp[start:stop], gamma[start:stop], kBT[start:stop],
+                         motion_type, s, noise)
+
+def _ensemble_groups(beads):
+    """Returns the number of bead groups of the _ensemble_kernel, at least one
+    for each thread and at most ENSEMBLE_GROUP beads in a group."""
+    return max(1, min(beads, max(nb.get_num_threads(), -(-beads//ENSEMBLE_GROUP))))
+
+def bead_seeds(seed, beads):
+    """Returns independent seeds for the random streams of each bead.
+
+    Parameters
+    ----------
+    seed : int or None
+        master seed; if None, an empty array is returned and the random
+        generator is not reseeded
+    beads : int
+        number of beads
+
+    Returns
+    -------
+    seeds : ndarray
+        array of seeds of shape (beads,)
+    """
+    if seed is None:
+        return np.zeros(0, dtype=np.uint32)
+    return np.random.SeedSequence(seed).generate_state(beads)
+
+#: available integrators of the simulate function
+INTEGRATORS = ("euler", "exact")
+
+def simulate_ensemble(num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp, bead_radius, eta, temp=293, motion_type=1, seed=None, integrator="euler", trap_path=None):
+    """Simulates M independent beads, each in its own oscillating optical trap.
+
+    Trap and bead parameters can be scalars or arrays of shape (M,) and are
+    broadcasted against each other. All beads are simulated in a single
+    call of the compiled kernel. Groups of up to ENSEMBLE_GROUP beads are
+    advanced together, one step at a time, and groups are distributed over all
+    available threads. Trap motion and sample times are computed once per
+    group for beads with equal trap frequencies. Drawing the random numbers
+    is not shared, so on a single core, time per trace of 10000 points drops
+    from about 1.2 ms (M=1) to 0.9 ms (M=100) with the exact integrator and
+    of 2000 points from about 4.7 ms to 1.9 ms with the Euler integrator.
+    See simulate for a description of the parameters. Each bead gets its own
+    random stream derived from seed, so results do not depend on the number
+    of threads or groups. A trap_path array or the result of a
+    trap_path callable can have shape (n,2), which is used for all beads,
+    or (M,n,2).
+
+    Returns
+    -------
+    time : ndarray
+        sample times [s], same for all beads
+    poz : ndarray
+        M-by-n-by-2 array of bead positions [m]
+    trap_poz : ndarray
+        M-by-n-by-2 array of trap positions [m]
+
+    Raises
+    ------
+    ValueError
+        if times between consecutive output points are less than timestep of simulation
+        or if integrator is unknown
+
+    Examples
+    --------
+    >>> time, poz, trap_poz = simulate_ensemble(1000, 0.005, [1e-6, 2e-6, 3e-6], 1e-6, 2, 1, 1e-6, 1e-6, 0.5e-6, 9.7e-4)
+    >>> poz.shape
+    (3, 1000, 2)
+    """
+    beads, parameters = _ensemble_parameters(dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp,
+                                             bead_radius, eta, temp, motion_type, integrator, trap_path)
+    time = np.empty(num_points)
+    poz = np.empty((beads, num_points, 2))
+    trap_poz = np.empty((beads, num_points, 2))
+    state = _initial_state(beads, dt)
+    path = _trap_path(trap_path, beads, 0, num_points, dt)
+
+    _ensemble_kernel(state, time, poz, trap_poz, path, dt, *parameters, bead_seeds(seed, beads), _ensemble_groups(beads))
+    return time, poz, trap_poz
+
+def simulate_ensemble_chunks(num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp, bead_radius, eta, temp=293, motion_type=1, seed=None, integrator="euler", trap_path=None, chunk_size=65536):
+    """Returns an iterator over chunks of an ensemble simulation.
+
+    Same as simulate_ensemble, but the simulation is done chunk_size points
+    at a time, so memory requirements do not depend on num_points.
+    The random generator of each chunk is seeded separately, so results
+    are reproducible, but differ from simulate_ensemble for num_points > chunk_size.
+    A trap_path callable is evaluated for each chunk separately.
+
+    Yields
+    ------
+    time : ndarray
+        sample times [s] of the chunk
+    poz : ndarray
+        M-by-chunk_size-by-2 array of bead positions [m]
+    trap_poz : ndarray
+        M-by-chunk_size-by-2 array of trap positions [m]
+    """
+    beads, parameters = _ensemble_parameters(dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp,
+                                             bead_radius, eta, temp, motion_type, integrator, trap_path)
+    state = _initial_state(beads, dt)
+    for i, start in enumerate(range(0, num_points, chunk_size)):
+        n = min(chunk_size, num_points - start)
+        time = np.empty(n)
+        poz = np.empty((beads, n, 2))
+        trap_poz = np.empty((beads, n, 2))
+        path = _trap_path(trap_path, beads, start, n, dt)
+        chunk_seed = seed if (i == 0 or seed is None) else [seed, i]
+        _ensemble_kernel(state, time, poz, trap_poz, path, dt, *parameters, bead_seeds(chunk_seed, beads), _ensemble_groups(beads))
+        yield time, poz, trap_poz
+
+def _initial_state(beads, dt):
+    """Returns the initial kernel state; all beads and traps start at the origin."""
+    state = np.zeros((beads, 6))
+    state[:,1] = dt + 1e-10
+    return state
+
+def _trap_path(trap_path, beads, start, n, dt):
+    """Returns trap positions of samples start to start+n as a (beads,n,2) array.
+    If trap_path is None, an empty array is returned."""
+    if trap_path is None:
+        return np.zeros((beads, 0, 2))
+    if callable(trap_path):
+        path = np.asarray(trap_path((start + np.arange(n))*dt), dtype=float)
+    else:
+        path = np.asarray(trap_path, dtype=float)[..., start:start+n, :]
+    if path.shape[-2:] != (n, 2):
+        raise ValueError("Trap path must have shape (num_points, 2) or (M, num_points, 2)")
+    return np.ascontiguousarray(np.broadcast_to(path, (beads, n, 2)))
+
+def _ensemble_parameters(dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp, bead_radius, eta, temp, motion_type, integrator, trap_path=None):
+    """Checks and broadcasts parameters of an ensemble simulation. Returns the
+    number of beads and a tuple of parameters for the _ensemble_kernel."""
+    if integrator not in INTEGRATORS:
+        raise ValueError("integrator must be one of {}".format(INTEGRATORS))
+    if (integrator == "euler" and dt <= DT_INTERNAL):
+        raise ValueError("dt must be longer than time step of simulation")
+    if trap_path is not None:
+        motion_type = 3
+    elif motion_type not in (1, 2):
+        raise ValueError("motion_type must be 1 or 2")
+
+    params = np.broadcast_arrays(*[np.atleast_1d(np.asarray(p, dtype=float)) for p in
+                                   (trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp, bead_radius, eta, temp)])
+    trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp, bead_radius, eta, temp = params
+    if trap_kx.ndim != 1:
+        raise ValueError("Parameters must be scalars or arrays of shape (M,)")
+
+    kBT = constants.Boltzmann*temp
+    gamma = 6*math.pi*eta*bead_radius
+    trap_k = np.stack((trap_kx, trap_ky), axis=1)
+    trap_freq = np.stack((trap_xfreq, trap_yfreq), axis=1)
+    trap_amp = np.stack((trap_xamp, trap_yamp), axis=1)
+    return len(trap_kx), (trap_k, trap_freq, trap_amp, gamma, kBT, motion_type, integrator == "exact")
+
+def simulate(num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp, bead_radius, eta, temp=293, motion_type=1, seed=None, integrator="euler", trap_path=None):
+    """Simulates the Brownian motion of a colloidal bead trapped in an optical trap oscillating in x and y directions.
+
+    This is a compiled version of SAT2. It uses the same physics and trap
+    motions, but the integration loop runs without Python calls and nothing
+    is written to disk. Use write_file to store the result in SAT2 format.
+
+    Parameters
+    ----------
+    num_points : int
+        # of data points to generate
+    dt : float
+        time interval between two consecutive points [s]
+    trap_kx, trap_ky : float
+        trap stiffness in x- and y-direction [N/m]
+    trap_xfreq, trap_yfreq : float
+        trap oscillation frequency in x- and y-direction [Hz]
+    trap_xamp, trap_yamp : float
+        amplitude of oscillation in x- and y-direction [m]
+    bead_radius : float
+        radius of trapped particle [m]
+    eta : float
+        viscosity of medium [Pa s]
+    temp : float
+        system temperature [K]
+    motion_type : int
+        1: sinusoidal motion in x,y (default)
+        2: linear motion in x,y; amplitudes become velocities in [m/s]
+    seed : int, optional
+        seed for the random generator of the compiled kernels
+    integrator : str
+        "euler": SAT2 Euler scheme with DT_INTERNAL steps between samples (default)
+        "exact": exact Ornstein-Uhlenbeck propagator that advances directly from
+        sample to sample, with the trap motion integrated analytically.
+        Samples are at exact multiples of dt and dt is not limited by DT_INTERNAL.
+    trap_path : ndarray or callable, optional
+        arbitrary trap motion; if given, motion_type, frequencies and amplitudes
+        are ignored. Either an n-by-2 array of trap positions [m] at the
+        samples, or a vectorized function that takes an array of sample
+        times i*dt [s] and returns an n-by-2 array of trap positions [m].
+        The function is evaluated once and the trap is held at the given
+        position from one sample to the next.
+
+    Returns
+    -------
+    time : ndarray
+        sample times [s]
+    poz : ndarray
+        n-by-2 array of bead positions [m]
+    trap_poz : ndarray
+        n-by-2 array of trap positions [m]
+
+    Raises
+    ------
+    ValueError
+        if times between consecutive output points are less than timestep of simulation
+        or if integrator is unknown
+
+    Examples
+    --------
+    Replay a recorded trap trajectory (positions in file are in micrometers)
+
+    >>> time, traps, trajectories = plotting.read_file("test.dat", 1)
+    >>> dt = time[1] - time[0]
+    >>> result = simulate(len(time), dt, 1e-6, 1e-6, 0, 0, 0, 0, 0.5e-6, 9.7e-4, trap_path=traps[:, 0:2]*1e-6)
+
+    Step protocol, the trap jumps by 1um in x-direction after 1s
+
+    >>> step = lambda t: np.stack((np.where(t < 1., 0., 1e-6), np.zeros_like(t)), axis=1)
+    >>> result = simulate(1000, 0.005, 1e-6, 1e-6, 0, 0, 0, 0, 0.5e-6, 9.7e-4, trap_path=step)
+    """
+    time, poz, trap_poz = simulate_ensemble(num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp,
+                                            bead_radius, eta, temp, motion_type, seed, integrator, trap_path)
+    return time, poz[0], trap_poz[0]
+
+def warmup():
+    """Compiles the simulation kernels, or loads them from the on-disk cache
+    (see conf.NUMBA_CACHE), so that later simulations start without delay.
+    Useful in worker processes before timing-sensitive work."""
+    for integrator in INTEGRATORS:
+        simulate(2, 1e-3, 1e-6, 1e-6, 0, 0, 0, 0, 0.5e-6, 1e-3, seed=0, integrator=integrator)
+        simulate(2, 1e-3, 1e-6, 1e-6, 0, 0, 0, 0, 0.5e-6, 1e-3, seed=0, integrator=integrator, trap_path=np.zeros((2, 2)))
+
+def estimate_stiffness(poz, temp=293):
+    """Estimates trap stiffness from bead positions as it is done in SAT2.
+
+    Parameters
+    ----------
+    poz : ndarray
+        n-by-2 array of bead positions [m] or M-by-n-by-2 array for M beads
+    temp : float or array_like
+        system temperature [K]
+
+    Returns
+    -------
+    kx_estimate : float or ndarray
+        estimated trap stiffness in x-direction
+    ky_estimate : float or ndarray
+        estimated trap stiffness in y-direction
+    """
+    kBT = constants.Boltzmann*np.asarray(temp)
+    mean_square = np.mean(np.asarray(poz)**2, axis=-2)
+    return kBT/mean_square[...,0]*1e6, kBT/mean_square[...,1]*1e6
+
+def write_file(file_name, time, poz, trap_poz, fmt="text", dtype=np.float64):
+    """Writes simulated data in SAT2 format.
+
+    Parameters
+    ----------
+    file_name : string
+        generated data will be stored here
+    time : ndarray
+        sample times [s]
+    poz : ndarray
+        n-by-2 array of bead positions [m]
+    trap_poz : ndarray
+        n-by-2 array of trap positions [m]
+    fmt : str
+        output format, see TrajectoryWriter
+    dtype : dtype
+        data type of binary formats
+
+    Note
+    ----
+    Position values in output file are in micrometers!
+    """
+    with TrajectoryWriter(file_name, len(time), fmt, dtype) as writer:
+        writer.write(time, poz, trap_poz)
+
+#: output formats of TrajectoryWriter
+FORMATS = ("text", "npy", "raw")
+
+class TrajectoryWriter(object):
+    """Writes simulated data to file chunk by chunk.
+
+    Each sample is stored as a row of 5 columns: time [s], x-, y-coords of
+    trap and x-, y-coords of bead [um], which is the column order of SAT2.
+
+    Parameters
+    ----------
+    file_name : string
+        generated data will be stored here
+    num_points : int
+        total # of data points that will be written; needed for the "npy" header
+    fmt : str
+        "text": tab-separated SAT2 layout that plotting.read_file expects (default)
+        "npy": numpy .npy file of shape (num_points, 5), can be opened with np.load(file_name, mmap_mode="r")
+        "raw": raw binary data of given dtype, see load_binary
+    dtype : dtype
+        data type of binary formats, float32 or float64
+
+    Examples
+    --------
+    >>> with TrajectoryWriter("test.npy", 1000, fmt="npy") as writer:
+    ...     for time, poz, trap_poz in simulate_chunks(1000, 0.005, 1e-6, 1e-6, 2, 1, 1e-6, 1e-6, 0.5e-6, 9.7e-4):
+    ...         writer.write(time, poz, trap_poz)
+    """
+    def __init__(self, file_name, num_points=None, fmt="text", dtype=np.float64):
+        if fmt not in FORMATS:
+            raise ValueError("fmt must be one of {}".format(FORMATS))
+        if fmt == "npy" and num_points is None:
+            raise ValueError("num_points must be given for npy format")
+        self.fmt = fmt
+        self.dtype = np.dtype(dtype)
+        self.num_points = num_points
+        self.count = 0
+        self.fout = open(file_name, "w" if fmt == "text" else "wb")
+        if fmt == "npy":
+            header = {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (num_points, 5)}
+            np.lib.format.write_array_header_1_0(self.fout, header)
+
+    def write(self, time, poz, trap_poz):
+        """Writes a chunk of data."""
+        data = np.empty((len(time), 5))
+        data[:,0] = time
+        data[:,1:3] = np.asarray(trap_poz)*1e6
+        data[:,3:5] = np.asarray(poz)*1e6
+        if self.fmt == "text":
+            self.fout.write("".join([SAT2_LINE_FORMAT % tuple(row) for row in data]))
+        else:
+            if self.num_points is not None and self.count + len(data) > self.num_points:
+                raise ValueError("Too many data points.")
+            self.fout.write(data.astype(self.dtype).tobytes())
+        self.count += len(data)
+
+    def close(self):
+        """Closes the file."""
+        self.fout.close()
+        if self.fmt == "npy" and self.count != self.num_points:
+            raise ValueError("Expected {} data points, {} were written.".format(self.num_points, self.count))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.fout.close()
+
+def load_binary(file_name, dtype=np.float64):
+    """Loads data written by TrajectoryWriter in "npy" or "raw" format.
+
+    Data is memory-mapped, so files larger than memory can be opened.
+
+    Parameters
+    ----------
+    file_name : string
+        name of the file
+    dtype : dtype
+        data type of "raw" files; ignored for "npy" files
+
+    Returns
+    -------
+    data : ndarray
+        n-by-5 array, columns are time [s], x-, y-coords of trap and
+        x-, y-coords of bead [um]
+    """
+    if file_name.endswith(".npy"):
+        return np.load(file_name, mmap_mode="r")
+    return np.memmap(file_name, dtype=dtype, mode="r").reshape(-1, 5)
+
+def simulate_chunks(num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp, bead_radius, eta, temp=293, motion_type=1, seed=None, integrator="euler", trap_path=None, chunk_size=65536):
+    """Returns an iterator over chunks of a single-bead simulation.
+
+    See simulate for a description of the parameters and
+    simulate_ensemble_chunks for details on chunking.
+
+    Yields
+    ------
+    time : ndarray
+        sample times [s] of the chunk
+    poz : ndarray
+        n-by-2 array of bead positions [m]
+    trap_poz : ndarray
+        n-by-2 array of trap positions [m]
+    """
+    for time, poz, trap_poz in simulate_ensemble_chunks(num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp,
+                                                        bead_radius, eta, temp, motion_type, seed, integrator, trap_path, chunk_size):
+        yield time, poz[0], trap_poz[0]
+
+def simulate_to_file(file_name, num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp, bead_radius, eta, temp=293, motion_type=1, seed=None, integrator="euler", trap_path=None, fmt="text", dtype=np.float64, chunk_size=65536):
+    """Simulates a trapped bead and streams the result to file.
+
+    Only one chunk of chunk_size points is kept in memory, so simulations
+    longer than available memory are possible. See simulate for a
+    description of the simulation parameters and TrajectoryWriter for
+    a description of the formats.
+
+    Returns
+    -------
+    kx_estimate : float
+        estimated trap stiffness in x-direction
+    ky_estimate : float
+        estimated trap stiffness in y-direction
+    file
+        file called file_name with columns: time, x-,y-coords of trap, x-,y-coords of bead
+    """
+    kBT = constants.Boltzmann*temp
+    square_sum = np.zeros(2)
+    with TrajectoryWriter(file_name, num_points, fmt, dtype) as writer:
+        for time, poz, trap_poz in simulate_chunks(num_points, dt, trap_kx, trap_ky, trap_xfreq, trap_yfreq, trap_xamp, trap_yamp,
+                                                   bead_radius, eta, temp, motion_type, seed, integrator, trap_path, chunk_size):
+            writer.write(time, poz, trap_poz)
+            square_sum += np.sum(poz**2, axis=0)
+    k_estimate = kBT/(square_sum/num_points)*1e6
+    return k_estimate[0], k_estimate[1]
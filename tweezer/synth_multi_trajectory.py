@@ -0,0 +1,362 @@
+"""
+Simulator of several beads, each trapped in its own (moving) optical trap.
+
+Beads move in the focal plane and can interact through hard-sphere
+exclusion and hydrodynamic coupling. Hydrodynamic interactions are
+described by the Oseen or Rotne-Prager-Yamakawa mobility tensor, truncated
+at a cutoff distance. Neighbouring beads are found with a cell list, so the
+cost of a step grows linearly with the number of beads. Correlated Brownian
+noise is computed with Fixman's Chebyshev approximation of the square root
+of the mobility matrix, which only needs products of the mobility matrix
+with a vector.
+
+The output can be written in the column layout of plotting.read_file.
+"""
+from __future__ import absolute_import, print_function, division
+
+import math
+
+import numpy as np
+import numba as nb
+import scipy.constants as constants
+
+from tweezer.conf import NUMBA_CACHE
+
+#: default internal time step of the simulation [s]
+DT_INTERNAL = 0.0001
+
+#: number of traps in the read_file column layout
+FILE_TRAPS = 4
+
+#: hydrodynamic models
+HYDRODYNAMICS = (None, "oseen", "rpy")
+
+@nb.njit(cache=NUMBA_CACHE)
+def _neighbour_pairs(x, rlist):
+    """Returns a P-by-2 array of all pairs of beads closer than rlist.
+    Pairs are found with a cell list of cell size rlist."""
+    n = len(x)
+    xmin, ymin = x[:,0].min(), x[:,1].min()
+    nx = int((x[:,0].max() - xmin)/rlist) + 1
+    ny = int((x[:,1].max() - ymin)/rlist) + 1
+    if nx*ny > 4*n: #sparse system, limit number of cells by hashing
+        nx = min(nx, 2*int(math.sqrt(n)) + 1)
+        ny = min(ny, 2*int(math.sqrt(n)) + 1)
+    head = np.full(nx*ny, -1, dtype=np.int64)
+    nxt = np.empty(n, dtype=np.int64)
+    cx = np.empty(n, dtype=np.int64)
+    cy = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        cx[i] = int((x[i,0] - xmin)/rlist) % nx
+        cy[i] = int((x[i,1] - ymin)/rlist) % ny
+        c = cx[i]*ny + cy[i]
+        nxt[i] = head[c]
+        head[c] = i
+
+    pairs = np.empty((max(16, 4*n), 2), dtype=np.int64)
+    count = 0
+    r2 = rlist*rlist
+    cells = np.empty(9, dtype=np.int64)
+    for i in range(n):
+        #neighbouring cells; with few cells, some of them wrap onto the same cell
+        ncells = 0
+        for dx in range(-1, 2):
+            for dy in range(-1, 2):
+                c = ((cx[i] + dx) % nx)*ny + (cy[i] + dy) % ny
+                if c not in cells[:ncells]:
+                    cells[ncells] = c
+                    ncells += 1
+        for k in range(ncells):
+            j = head[cells[k]]
+            while j != -1:
+                if j > i:
+                    d0 = x[j,0] - x[i,0]
+                    d1 = x[j,1] - x[i,1]
+                    if d0*d0 + d1*d1 < r2:
+                        if count == len(pairs):
+                            pairs = np.concatenate((pairs, np.empty_like(pairs)))
+                        pairs[count,0] = i
+                        pairs[count,1] = j
+                        count += 1
+                j = nxt[j]
+    return pairs[:count]
+
+@nb.njit(cache=NUMBA_CACHE)
+def _pair_mobility(d0, d1, a, mu_pair, rpy):
+    """Returns components (xx, xy, yy) of the pair mobility tensor for
+    separation (d0, d1); mu_pair = 1/(8*pi*eta)."""
+    r = math.sqrt(d0*d0 + d1*d1)
+    e0, e1 = d0/r, d1/r
+    if not rpy:
+        c = mu_pair/r
+        return c*(1 + e0*e0), c*e0*e1, c*(1 + e1*e1)
+    if r >= 2*a:
+        c = mu_pair/r
+        s = 2*a*a/(3*r*r)
+        return c*(1 + s + (1 - 3*s)*e0*e0), c*(1 - 3*s)*e0*e1, c*(1 + s + (1 - 3*s)*e1*e1)
+    #overlapping beads
+    mu0 = mu_pair*8/(6*a)
+    s = r/(32*a)
+    return mu0*(1 - 9*s + 3*s*e0*e0), mu0*3*s*e0*e1, mu0*(1 - 9*s + 3*s*e1*e1)
+
+@nb.njit(cache=NUMBA_CACHE)
+def _mobility_dot(x, pairs, f, mu0, a, mu_pair, cutoff, rpy, out):
+    """Computes out = M.f for the truncated mobility matrix M."""
+    out[:,:] = mu0*f
+    for p in range(len(pairs)):
+        i, j = pairs[p,0], pairs[p,1]
+        d0 = x[j,0] - x[i,0]
+        d1 = x[j,1] - x[i,1]
+        if d0*d0 + d1*d1 >= cutoff*cutoff:
+            continue
+        mxx, mxy, myy = _pair_mobility(d0, d1, a, mu_pair, rpy)
+        out[i,0] += mxx*f[j,0] + mxy*f[j,1]
+        out[i,1] += mxy*f[j,0] + myy*f[j,1]
+        out[j,0] += mxx*f[i,0] + mxy*f[i,1]
+        out[j,1] += mxy*f[i,0] + myy*f[i,1]
+
+@nb.njit(cache=NUMBA_CACHE)
+def _gershgorin_radius(x, pairs, a, mu_pair, cutoff, rpy):
+    """Returns the largest Gershgorin radius of the truncated mobility matrix."""
+    radius = np.zeros(x.shape)
+    for p in range(len(pairs)):
+        i, j = pairs[p,0], pairs[p,1]
+        d0 = x[j,0] - x[i,0]
+        d1 = x[j,1] - x[i,1]
+        if d0*d0 + d1*d1 >= cutoff*cutoff:
+            continue
+        mxx, mxy, myy = _pair_mobility(d0, d1, a, mu_pair, rpy)
+        radius[i,0] += abs(mxx) + abs(mxy)
+        radius[i,1] += abs(mxy) + abs(myy)
+        radius[j,0] += abs(mxx) + abs(mxy)
+        radius[j,1] += abs(mxy) + abs(myy)
+    return radius.max()
+
+@nb.njit(cache=NUMBA_CACHE)
+def _chebyshev_sqrt_dot(x, pairs, z, mu0, a, mu_pair, cutoff, rpy, terms):
+    """Returns an approximation of sqrt(M).z (Fixman's method). Spectral
+    bounds of M are estimated from Gershgorin circles."""
+    radius = _gershgorin_radius(x, pairs, a, mu_pair, cutoff, rpy)
+    lmax = mu0 + radius
+    #truncation can make M slightly indefinite; keep the lower bound positive
+    lmin = max(mu0 - radius, 0.05*mu0)
+    half_width = 0.5*(lmax - lmin)
+    center = 0.5*(lmax + lmin)
+    if half_width <= 1e-9*center: #no coupling, M = mu0*I
+        return math.sqrt(mu0)*z
+
+    c = np.zeros(terms)
+    for k in range(terms):
+        for j in range(terms):
+            theta = math.pi*(j + 0.5)/terms
+            c[k] += math.sqrt(max(center + half_width*math.cos(theta), 0.))*math.cos(k*theta)
+        c[k] *= 2./terms
+    c[0] *= 0.5
+
+    t_prev = z.copy()
+    t = np.empty_like(z)
+    _mobility_dot(x, pairs, z, mu0, a, mu_pair, cutoff, rpy, t)
+    t = (t - center*z)/half_width
+    result = c[0]*t_prev + c[1]*t
+    tmp = np.empty_like(z)
+    for k in range(2, terms):
+        _mobility_dot(x, pairs, t, mu0, a, mu_pair, cutoff, rpy, tmp)
+        t_next = 2*(tmp - center*t)/half_width - t_prev
+        result += c[k]*t_next
+        t_prev = t
+        t = t_next
+    return result
+
+@nb.njit(cache=NUMBA_CACHE)
+def _resolve_overlaps(x, pairs, a):
+    """Moves overlapping beads apart along the line connecting their centers."""
+    for p in range(len(pairs)):
+        i, j = pairs[p,0], pairs[p,1]
+        d0 = x[j,0] - x[i,0]
+        d1 = x[j,1] - x[i,1]
+        r = math.sqrt(d0*d0 + d1*d1)
+        if r < 2*a:
+            if r == 0.:
+                d0, d1, r = 1., 0., 1.
+            shift = 0.5*(2*a - r)/r
+            x[i,0] -= shift*d0
+            x[i,1] -= shift*d1
+            x[j,0] += shift*d0
+            x[j,1] += shift*d1
+
+@nb.njit(cache=NUMBA_CACHE)
+def _multi_kernel(x, time, poz, trap_poz, path, dt, substeps, trap_k, a, eta, kBT, hydrodynamics, exclusion, cutoff, terms):
+    """Compiled multi-bead Brownian dynamics (Ermak-McCammon) integrator.
+
+    x : (N,2) bead positions, updated in place
+    path : (n,N,2) trap positions, held constant between samples
+    hydrodynamics : 0 none, 1 Oseen, 2 Rotne-Prager-Yamakawa"""
+    h = dt/substeps
+    mu0 = 1./(6*math.pi*eta*a)
+    mu_pair = 1./(8*math.pi*eta)
+    noise_scale = math.sqrt(2*kBT*h)
+    rlist = max(cutoff, 3*a) if hydrodynamics else 3*a
+    force = np.empty_like(x)
+    drift = np.empty_like(x)
+    pairs = np.empty((0, 2), dtype=np.int64)
+
+    for i in range(len(time)):
+        time[i] = i*dt
+        poz[i] = x
+        trap_poz[i] = path[i]
+        for step in range(substeps):
+            if hydrodynamics or exclusion:
+                pairs = _neighbour_pairs(x, rlist)
+            force[:,:] = trap_k*(path[i] - x)
+            z = np.empty_like(x)
+            for m in range(len(x)):
+                z[m,0] = np.random.randn()
+                z[m,1] = np.random.randn()
+            if hydrodynamics:
+                _mobility_dot(x, pairs, force, mu0, a, mu_pair, cutoff, hydrodynamics == 2, drift)
+                noise = _chebyshev_sqrt_dot(x, pairs, z, mu0, a, mu_pair, cutoff, hydrodynamics == 2, terms)
+                x += drift*h + noise_scale*noise
+            else:
+                x += mu0*force*h + noise_scale*math.sqrt(mu0)*z
+            if exclusion:
+                _resolve_overlaps(x, pairs, a)
+
+def _trap_path(trap_positions, num_points, dt, beads=None):
+    """Returns trap positions at all samples as an (num_points,N,2) array."""
+    if callable(trap_positions):
+        path = np.asarray(trap_positions(np.arange(num_points)*dt), dtype=float)
+    else:
+        path = np.asarray(trap_positions, dtype=float)
+        if path.ndim == 2:
+            path = np.broadcast_to(path, (num_points,) + path.shape)
+    if path.ndim != 3 or path.shape[0] != num_points or path.shape[2] != 2:
+        raise ValueError("Trap positions must have shape (N, 2) or (num_points, N, 2)")
+    return np.ascontiguousarray(path)
+
+def simulate_multi(num_points, dt, trap_positions, trap_k, bead_radius, eta, temp=293, hydrodynamics=None, exclusion=True, cutoff=None, dt_internal=DT_INTERNAL, seed=None, chebyshev_terms=20):
+    """Simulates N beads in N optical traps; bead i is trapped in trap i.
+
+    Parameters
+    ----------
+    num_points : int
+        # of data points to generate
+    dt : float
+        time interval between two consecutive points [s]
+    trap_positions : ndarray or callable
+        an N-by-2 array of static trap positions [m], an n-by-N-by-2 array
+        of trap positions at the samples, or a vectorized function that takes
+        an array of sample times [s] and returns an n-by-N-by-2 array.
+        Traps are held at the given positions from one sample to the next.
+    trap_k : float or ndarray
+        trap stiffness [N/m], a scalar, an array of shape (N,) or (N,2)
+    bead_radius : float
+        radius of trapped particles [m]
+    eta : float
+        viscosity of medium [Pa s]
+    temp : float
+        system temperature [K]
+    hydrodynamics : str, optional
+        None (default): no hydrodynamic coupling
+        "oseen": Oseen tensor
+        "rpy": Rotne-Prager-Yamakawa tensor
+    exclusion : bool
+        if True, beads are not allowed to overlap (hard spheres)
+    cutoff : float, optional
+        hydrodynamic interactions between beads further apart than cutoff [m]
+        are neglected; defaults to 20 bead radii
+    dt_internal : float
+        internal time step used for simulation [s], rounded so that dt is
+        a multiple of it
+    seed : int, optional
+        seed for the random generator of the compiled kernel
+    chebyshev_terms : int
+        number of terms of the Chebyshev approximation of the correlated noise
+
+    Returns
+    -------
+    time : ndarray
+        sample times [s]
+    poz : ndarray
+        n-by-N-by-2 array of bead positions [m]
+    trap_poz : ndarray
+        n-by-N-by-2 array of trap positions [m]
+
+    Raises
+    ------
+    ValueError
+        if parameters are not valid
+    """
+    if hydrodynamics not in HYDRODYNAMICS:
+        raise ValueError("hydrodynamics must be one of {}".format(HYDRODYNAMICS))
+    if chebyshev_terms < 2:
+        raise ValueError("At least two Chebyshev terms are needed.")
+    if dt < dt_internal:
+        raise ValueError("dt must be longer than time step of simulation")
+    path = _trap_path(trap_positions, num_points, dt)
+    beads = path.shape[1]
+    trap_k = np.asarray(trap_k, dtype=float)
+    if trap_k.ndim == 1:
+        trap_k = trap_k[:,None]
+    trap_k = np.ascontiguousarray(np.broadcast_to(trap_k, (beads, 2)))
+    if cutoff is None:
+        cutoff = 20*bead_radius
+    if seed is not None:
+        _seed(seed)
+
+    substeps = int(round(dt/dt_internal))
+    time = np.empty(num_points)
+    poz = np.empty((num_points, beads, 2))
+    trap_poz = np.empty((num_points, beads, 2))
+    x = path[0].copy()
+    if exclusion and beads > 1:
+        _resolve_overlaps(x, _neighbour_pairs(x, 3*bead_radius), bead_radius)
+    _multi_kernel(x, time, poz, trap_poz, path, dt, substeps, trap_k, bead_radius, eta, constants.Boltzmann*temp,
+                  HYDRODYNAMICS.index(hydrodynamics), exclusion, cutoff, chebyshev_terms)
+    return time, poz, trap_poz
+
+@nb.njit(cache=NUMBA_CACHE)
+def _seed(seed):
+    np.random.seed(seed)
+
+def warmup():
+    """Compiles the simulation kernels, or loads them from the on-disk cache
+    (see conf.NUMBA_CACHE), so that later simulations start without delay."""
+    simulate_multi(2, 1e-3, [[0., 0.], [2e-6, 0.]], 1e-6, 0.5e-6, 1e-3, hydrodynamics="rpy", seed=0)
+
+def write_file(file_name, time, poz, trap_poz):
+    """Writes simulated data in the column layout of plotting.read_file.
+
+    Columns are: time, an empty column, x, y and an empty column for each of
+    the first 4 traps, followed by x- and y-coordinates of all beads.
+    Empty columns are written as nan.
+
+    Parameters
+    ----------
+    file_name : string
+        generated data will be stored here
+    time : ndarray
+        sample times [s]
+    poz : ndarray
+        n-by-N-by-2 array of bead positions [m]
+    trap_poz : ndarray
+        n-by-N-by-2 array of trap positions [m]
+
+    Note
+    ----
+    Position values in output file are in micrometers!
+    Only the first 4 traps fit in the layout; all beads are written.
+
+    Examples
+    --------
+    >>> time, poz, trap_poz = simulate_multi(1000, 0.005, [[0, 0], [3e-6, 0]], 1e-6, 0.5e-6, 9.7e-4, hydrodynamics="rpy")
+    >>> write_file("test.dat", time, poz, trap_poz)
+    >>> time, traps, trajectories = plotting.read_file("test.dat", 2)
+    """
+    n, beads = poz.shape[:2]
+    data = np.full((n, 2 + 3*FILE_TRAPS + 2*beads), np.nan)
+    data[:,0] = time
+    for i in range(min(beads, FILE_TRAPS)):
+        data[:,2+3*i:4+3*i] = trap_poz[:,i]*1e6
+    data[:,2+3*FILE_TRAPS:] = poz.reshape(n, 2*beads)*1e6
+    fmt = ["%3.5f"] + ["%3.3f"]*(1 + 3*FILE_TRAPS) + ["%3.4f"]*(2*beads)
+    np.savetxt(file_name, data, fmt=fmt, delimiter="\t")
@@ -0,0 +1,204 @@
+"""Unit tests for the brownian motion video simulator"""
+
+import unittest
+import os
+import subprocess
+import sys
+import tempfile
+import shutil
+
+import numpy as np
+
+import tweezer.brownian as brownian
+import tweezer.conf as conf
+import tweezer.calibration as calibration
+
+class TestBrownianWalk(unittest.TestCase):
+
+    def setUp(self):
+        self.x0 = np.random.rand(20, 2)*64
+
+    def test_blocks(self):
+        blocks = list(brownian.brownian_walk_blocks(self.x0, 100, shape=(64, 64), block=32))
+        self.assertEqual([len(b) for b in blocks], [32, 32, 32, 4])
+        x = np.concatenate(blocks)
+        self.assertTrue(np.array_equal(x[0], self.x0))
+        self.assertTrue(np.all(x >= 0) and np.all(x < 64))
+
+    def test_walk_matches_blocks(self):
+        brownian.seed(3)
+        x1 = np.array(list(brownian.brownian_walk(self.x0, 100, shape=(64, 64), velocity=0.5, block=7)))
+        brownian.seed(3)
+        x2 = np.concatenate(list(brownian.brownian_walk_blocks(self.x0, 100, shape=(64, 64), velocity=0.5, block=100)))
+        self.assertEqual(x1.shape, (100, 20, 2))
+        self.assertTrue(np.array_equal(x1, x2))
+
+    def test_step_variance(self):
+        x0 = np.zeros((2000, 2)) + 5000.
+        x = np.concatenate(list(brownian.brownian_walk_blocks(x0, 11, shape=(10000, 10000), delta=2, dt=0.25)))
+        dx = x[-1] - x[0]
+        self.assertAlmostEqual(dx.var()/10, 4*0.25, delta=0.1)
+
+class TestTrappedBeads(unittest.TestCase):
+
+    def test_stiffness(self):
+        dt, n = 1e-3, 20000
+        positions = np.concatenate(list(brownian.trapped_beads_blocks(n, dt, [[64, 64]], [[1e-6, 4e-6]], pixel_size=0.1e-6)))
+        self.assertEqual(positions.shape, (n, 1, 2))
+        ks = calibration.calibrate(np.arange(n)*dt, positions[:, 0]*0.1, averaging_time=1.)[0]
+        self.assertTrue(np.allclose(ks, [1e-6, 4e-6], rtol=0.15))
+
+    def test_moving_traps(self):
+        traps = np.zeros((500, 2, 2))
+        traps[:, :, 0] = np.linspace(20, 40, 500)[:, None]
+        traps[:, 1, 1] = 30
+        positions = np.concatenate(list(brownian.trapped_beads_blocks(500, 1e-2, traps, 1e-5, block=64)))
+        self.assertLess(np.abs(positions - traps).max(), 5)
+
+    def test_video(self):
+        brownian.seed(0)
+        np.random.seed(0)
+        blocks = list(brownian.trapped_beads_video(10, 1e-3, [[10, 10], [30, 40]], 1e-6, shape=(48, 64), block=4))
+        self.assertEqual([len(frames) for frames, positions in blocks], [4, 4, 2])
+        for frames, positions in blocks:
+            self.assertEqual(positions.shape[1:], (2, 2))
+            self.assertTrue(np.array_equal(frames, brownian.render_frames(positions, (48, 64), intensity=30, sigma=2)))
+
+class TestKernels(unittest.TestCase):
+
+    def test_cached(self):
+        self.assertIs(brownian.get_kernels(np.float32, "cpu"), brownian.get_kernels("float32", "cpu"))
+        self.assertIsNot(brownian.get_kernels(np.float32, "cpu"), brownian.get_kernels(np.float64, "cpu"))
+        self.assertRaises(ValueError, brownian.get_kernels, np.int32)
+        self.assertRaises(ValueError, brownian.get_kernels, None, "gpu")
+
+    def test_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+            code = "import tweezer.brownian as b; print(sum(b.warmup()[0].draw_psf.stats.cache_hits.values()))"
+            hits = [int(subprocess.check_output([sys.executable, "-c", code], env=env).strip()) for i in range(2)]
+            files = [f for root, dirs, fs in os.walk(cache_dir) for f in fs]
+            self.assertTrue(any(f.startswith("brownian._draw_psf_") for f in files))
+            self.assertEqual(hits[0], 0)
+            self.assertGreater(hits[1], 0)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_cache_environ(self):
+        env = dict(os.environ)
+        env.pop("NUMBA_CACHE_DIR", None)
+        code = "import os, numba, tweezer.conf as c; print('NUMBA_CACHE_DIR' in os.environ, numba.config.CACHE_DIR == c.NUMBA_CACHE_DIR)"
+        out = subprocess.check_output([sys.executable, "-c", code], env=env)
+        self.assertEqual(out.split(), [b"False", b"True"])
+        #numba resets its config when a NUMBA_* variable changes, lazily built kernels must still use the folder
+        code = ("import os, numba, tweezer.conf as c, tweezer.brownian as b; os.environ['NUMBA_OPT'] = '2'; "
+                "numba.core.config.reload_config(); "
+                "print(b.get_kernels('float32', 'cpu').draw_psf._cache._cache_path.startswith(c.NUMBA_CACHE_DIR))")
+        out = subprocess.check_output([sys.executable, "-c", code], env=env)
+        self.assertEqual(out.strip(), b"True")
+
+    def test_precision(self):
+        x0 = np.random.rand(10, 2).astype("float32")*64
+        x = np.concatenate(list(brownian.brownian_walk_blocks(x0, 10, shape=(64, 64))))
+        self.assertEqual(x.dtype, np.float32)
+        frames = brownian.render_frames(x, (64, 64), sigma=1.)
+        self.assertTrue(np.array_equal(frames, brownian.render_frames(x.astype("float64"), (64, 64), sigma=1.)))
+        old = conf.set_precision("single")
+        try:
+            x = next(brownian.brownian_particles(2, particles=3))
+            self.assertEqual(x.dtype, np.float32)
+        finally:
+            conf.set_precision(old)
+
+    def test_parallel_target(self):
+        points = np.random.rand(8, 100, 2)*64
+        frames = brownian.render_frames(points, (64, 64), sigma=1.5, target="parallel")
+        self.assertTrue(np.array_equal(frames, brownian.render_frames(points, (64, 64), sigma=1.5, target="cpu")))
+        x = next(brownian.brownian_walk_blocks(points[0], 10, shape=(64, 64), target="parallel"))
+        self.assertTrue(np.all(x >= 0) and np.all(x < 64))
+
+    def test_parallel_seed(self):
+        x0 = np.random.rand(50, 2)*64
+        results = []
+        for target in ("cpu", "parallel", "parallel"):
+            brownian.seed(5)
+            np.random.seed(5)
+            x = np.concatenate(list(brownian.brownian_walk_blocks(x0, 100, shape=(64, 64), block=32, target=target)))
+            traps = next(brownian.trapped_beads_blocks(100, 1e-3, x0, 1e-6, target=target))
+            frames = brownian.render_frames(x[:16], (64, 64), sigma=1.5, background=50, shot_noise=True,
+                                            read_noise=2., frame_dtype="uint16", target=target)
+            #generator state after rendering does not depend on the target
+            results.append((x, traps, frames, next(brownian.brownian_walk_blocks(x0, 2, target=target))))
+        for result in results[1:]:
+            for a, b in zip(results[0], result):
+                self.assertTrue(np.array_equal(a, b))
+
+class TestDrawPSF(unittest.TestCase):
+
+    def test_draw_psf(self):
+        points = np.array([[10.3, 20.7], [0.5, 63.2], [40., 40.]])
+        sigma, intensity = 2., 100
+        im = brownian.draw_psf(np.zeros((64, 64), "uint8"), points, intensity, sigma)
+        size = int(round(3*sigma))
+        expected = np.zeros((64, 64), "uint8")
+        for h0, w0 in points:
+            for i in range(int(h0) - size, int(h0) + size + 1):
+                for j in range(int(w0) - size, int(w0) + size + 1):
+                    expected[i % 64, j % 64] += brownian.psf_gauss(i, h0, j, w0, sigma, intensity)
+        #outer product of profiles may be truncated to a value that differs by one from psf_gauss
+        self.assertLessEqual(np.abs(im.astype(int) - expected).max(), 1)
+        self.assertEqual(im[40, 40], 100)
+
+    def test_render_frames(self):
+        points = np.random.rand(3, 5, 2)*64
+        points[0, 0] = [1.2, 62.6] #psf wraps around the edges
+        sigma, size = 1.5, 4
+        frames = brownian.render_frames(points, (64, 64), background=5, intensity=20, sigma=sigma)
+        self.assertEqual(frames.shape, (3, 64, 64))
+        #analytic gaussians within 3*sigma of the particle pixel
+        expected = np.full((3, 64, 64), 5.)
+        for k in range(3):
+            for h0, w0 in points[k]:
+                i = np.arange(int(h0) - size, int(h0) + size + 1)
+                j = np.arange(int(w0) - size, int(w0) + size + 1)
+                psf = 20*np.exp(-((i[:, None] - h0)**2 + (j[None, :] - w0)**2)/(2*sigma**2))
+                expected[k][np.ix_(i % 64, j % 64)] += psf
+        expected = np.clip(np.floor(expected + 0.5), 0, 255)
+        #values close to a rounding boundary may round either way
+        self.assertLessEqual(np.abs(frames - expected).max(), 1)
+        self.assertGreater((frames == expected).mean(), 0.99)
+        #points are added to the pixels they are in
+        frames = brownian.render_frames(points, (64, 64), background=5, intensity=20)
+        expected = np.full((3, 64, 64), 5)
+        for k in range(3):
+            np.add.at(expected[k], (points[k, :, 0].astype(int), points[k, :, 1].astype(int)), 20)
+        self.assertTrue(np.array_equal(frames, expected))
+
+    def test_saturation(self):
+        points = np.array([[[10., 10.]]*20])
+        frames = brownian.render_frames(points, (32, 32), intensity=30, sigma=1.)
+        self.assertEqual(frames[0, 10, 10], 255)
+        frames = brownian.render_frames(points, (32, 32), intensity=30, sigma=1., frame_dtype="uint16")
+        self.assertEqual(frames.dtype, np.uint16)
+        self.assertEqual(frames[0, 10, 10], 600)
+        frames = brownian.render_frames(points, (32, 32), intensity=5000, frame_dtype="uint16")
+        self.assertEqual(frames[0, 10, 10], 65535)
+
+    def test_noise(self):
+        points = np.zeros((4, 0, 2))
+        brownian.seed(0)
+        frames = brownian.render_frames(points, (64, 64), background=100, shot_noise=True, frame_dtype="uint16")
+        self.assertAlmostEqual(frames.mean(), 100, delta=1)
+        self.assertAlmostEqual(frames.var(), 100, delta=10)
+        frames = brownian.render_frames(points, (64, 64), background=100, shot_noise=True, read_noise=10., gain=4.,
+                                        frame_dtype="uint16")
+        self.assertAlmostEqual(frames.var(), 4*100 + 100, delta=50)
+
+    def test_frame_grabber(self):
+        frames = list(brownian.frame_grabber(10, shape=(32, 48), particles=5, block=4))
+        self.assertEqual(len(frames), 10)
+        self.assertEqual(frames[0].shape, (32, 48))
+
+if __name__ == "__main__":
+    unittest.main()
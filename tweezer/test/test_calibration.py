@@ -5,6 +5,8 @@ import unittest
 import numpy as np
 import tweezer.calibration as cal
 import tweezer.calibration_generate_data as gen
+import tweezer.brownian as brownian
+import tweezer.conf as conf
 
 class TestCalibration(unittest.TestCase):
     
@@ -27,6 +29,18 @@ class TestCalibration(unittest.TestCase):
         y, _, _ = cal.subtract_moving_average(t, trajectory[:, 1], 1)
         self.assertTrue(np.allclose(np.mean(x), 0, atol = 1e-4) and np.allclose(np.mean(y), 0, atol = 1e-4))
         
+    def test_moving_average_convolve(self):
+        t = np.arange(10000)*1e-3
+        data = np.cumsum(np.random.randn(10000, 3), axis=0) + 100
+        new_data, average, new_t = cal.subtract_moving_average(t, data, 0.5)
+        n = 250
+        for i in range(3):
+            expected = np.convolve(data[:, i], np.ones(2*n)/(2*n), mode='valid')
+            self.assertTrue(np.allclose(average[:, i], expected, rtol=0, atol=1e-9))
+            self.assertTrue(np.allclose(new_data[:, i], data[n:-n+1, i] - expected, rtol=0, atol=1e-9))
+        self.assertTrue(np.array_equal(new_t, t[n:-n+1]))
+        self.assertTrue(np.allclose(cal.subtract_moving_average(t, data[:, 0], 0.5)[0], new_data[:, 0]))
+
     def test_calibrate(self):
         trajectory = gen.generate([self.kx, self.ky], phi = self.phi)
         t = gen.generate_time()
@@ -34,6 +48,65 @@ class TestCalibration(unittest.TestCase):
         self.assertTrue(np.allclose(result[0], self.expected_result[0], atol=1e-6) and
                 np.allclose(-result[1], self.expected_result[1], atol=0.1))
         
+    def test_welch_psd(self):
+        data = np.random.randn(10000, 2)
+        f, psd = cal.welch_psd(data, 1e-3, 256, chunk_size=7*256)
+        self.assertEqual(psd.shape, (129, 2))
+        # white noise of unit variance has one-sided density 2*dt
+        self.assertTrue(np.allclose(psd[1:-1].mean(axis=0), 2e-3, rtol=0.05))
+        f1, psd1 = cal.welch_psd(data[:, 1], 1e-3, 256)
+        self.assertTrue(np.allclose(psd1, psd[:, 1]) and np.allclose(f1, f))
+        # chunks smaller than one segment of all columns
+        self.assertTrue(np.allclose(cal.welch_psd(data, 1e-3, 256, chunk_size=100)[1], psd))
+        self.assertRaises(ValueError, cal.welch_psd, data[:100], 1e-3, 256)
+
+    def test_fit_psd(self):
+        f = np.fft.rfftfreq(1024, 1e-3)
+        psd = cal.aliased_lorentzian(f, 50., 0.01, 1e-3)
+        fc, variance = cal.fit_psd(f, psd, 1e-3)
+        self.assertTrue(np.allclose([fc, variance], [50., 0.01]))
+        # integral of the spectrum is the variance
+        self.assertTrue(np.allclose(psd.sum()*f[1], 0.01, rtol=0.01))
+
+    def test_calibrate_psd(self):
+        dt, n = 1e-3, 100000
+        positions = np.concatenate(list(brownian.trapped_beads_blocks(n, dt, [[64, 64]], [[1e-6, 4e-6]], pixel_size=0.1e-6)))
+        t = np.arange(n)*dt
+        for mode in cal.CALIBRATION_MODES:
+            ks = cal.calibrate(t, positions[:, 0]*0.1, mode=mode)[0]
+            self.assertTrue(np.allclose(ks, [1e-6, 4e-6], rtol=0.1))
+        # mode from the configuration
+        old = conf.set_calibration_mode("psd")
+        try:
+            self.assertTrue(np.allclose(cal.calibrate(t, positions[:, 0]*0.1)[0], [1e-6, 4e-6], rtol=0.1))
+        finally:
+            conf.set_calibration_mode(old)
+        self.assertRaises(ValueError, cal.calibrate, t, positions[:, 0], mode=2)
+        self.assertRaises(ValueError, conf.set_calibration_mode, "variance")
+        self.assertRaises(ValueError, conf.set_calibration_mode, 1.0)
+        self.assertRaises(ValueError, cal.calibrate, t, positions[:, 0], mode=1.0)
+        self.assertRaises(ValueError, cal.calibrate, t, positions[:, 0], mode=-1)
+        self.assertEqual([conf.calibration_mode_index(m) for m in ("psd", 1, np.int64(0))], [1, 1, 0])
+
+    def test_calibrate_many(self):
+        dt, n = 1e-3, 20000
+        k = [[1e-6, 4e-6], [2e-6, 3e-6], [5e-6, 5.5e-6]]
+        positions = np.concatenate(list(brownian.trapped_beads_blocks(n, dt, [[20, 20], [40, 40], [60, 20]], k, 
+                                                                      pixel_size=0.1e-6)))
+        data = positions.reshape(n, -1)*0.1
+        t = np.arange(n)*dt
+        for mode in ("equipartition", "psd"):
+            ks, phi, drift = cal.calibrate_many(t, data, mode=mode)
+            self.assertEqual(ks.shape, (3, 2))
+            self.assertEqual(phi.shape, (3,))
+            self.assertEqual(drift.shape[:2], (3, 2))
+            for i in range(3):
+                ks1, phi1, drift1 = cal.calibrate(t, data[:, 2*i:2*i+2], mode=mode)
+                self.assertTrue(np.allclose(ks[i], ks1))
+                self.assertTrue(np.allclose(phi[i], phi1))
+                self.assertTrue(np.allclose(drift[i], drift1))
+        self.assertRaises(ValueError, cal.calibrate_many, t, data[:, :3])
+
 
 if __name__ == "__main__":
     unittest.main()
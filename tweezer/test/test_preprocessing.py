@@ -0,0 +1,61 @@
+"""Unit tests for the preprocessing module"""
+
+import unittest
+
+import numpy as np
+
+import tweezer.preprocessing as preprocessing
+import tweezer.tracking as tracking
+import tweezer.brownian as brownian
+
+class TestPreprocessing(unittest.TestCase):
+
+    def setUp(self):
+        self.traps = np.array([[40., 40.], [40., 90.], [90., 60.]])
+        video = brownian.trapped_beads_video(64, 1e-3, self.traps, 1e-6, shape=(128, 128), intensity=100, sigma=2,
+                                             frame_dtype="uint16")
+        self.frames, self.positions = next(video)
+
+    def test_crop_rois(self):
+        origins = preprocessing.roi_origins(self.traps, (16, 16))
+        rois = np.concatenate(list(preprocessing.crop_rois(iter(self.frames), self.traps, (16, 16), block=10)))
+        self.assertEqual(rois.shape, (64, 3, 16, 16))
+        self.assertEqual(rois.dtype, self.frames.dtype)
+        i, j = origins[2]
+        self.assertTrue(np.array_equal(rois[:, 2], self.frames[:, i:i+16, j:j+16]))
+        self.assertRaises(ValueError, list, preprocessing.crop_rois(self.frames, [[4., 64.]], (16, 16)))
+
+    def test_background(self):
+        rng = np.random.RandomState(0)
+        #linear background drift with noise
+        frames = np.linspace(100, 110, 500)[:, None, None] + rng.normal(0, 1, (500, 4, 4))
+        blocks = np.array_split(frames, 7)
+        for method, rate in (("mean", 0.05), ("median", 0.2)):
+            out = np.concatenate(list(preprocessing.subtract_background(blocks, method, rate, dtype="float64")))
+            self.assertEqual(out.shape, frames.shape)
+            self.assertLess(abs(out[250:].mean()), 0.5)
+        out = next(preprocessing.subtract_background(blocks, background=np.full((4, 4), 100.)))
+        self.assertEqual(out.dtype, np.float32)
+        self.assertTrue(np.allclose(out[0], frames[0] - 100, atol=1e-4))
+        self.assertRaises(ValueError, next, preprocessing.subtract_background(blocks, "mode"))
+        self.assertRaises(ValueError, next, preprocessing.subtract_background(blocks, background=np.zeros(3)))
+
+    def test_locate_rois(self):
+        #uneven illumination is removed by a background measured without beads
+        illumination = np.linspace(0, 40, 128)[None, :, None].astype("uint16")
+        frames = self.frames + illumination
+        background = np.repeat(illumination, 128, axis=2)[0]
+        origins = preprocessing.roi_origins(self.traps, (16, 16))
+        rois = preprocessing.crop_rois(frames, self.traps, (16, 16), block=20)
+        background = next(preprocessing.crop_rois(background[None], self.traps, (16, 16)))[0]
+        rois = preprocessing.subtract_background(rois, rate=0., background=background)
+        features = preprocessing.locate_rois(rois, origins, threshold=50, radius=4)
+        self.assertEqual(len(features), 64*3)
+        self.assertTrue(np.all(np.diff(features["frame"]) >= 0))
+        located = np.stack((features["x"], features["y"]), axis=-1).reshape(64, 3, 2)
+        self.assertLess(np.abs(located - self.positions).max(), 0.2)
+
+    def test_track_rois(self):
+        tracker = tracking.CorrelationTracker(tracking.gaussian_reference((16, 16), 2), self.traps)
+        rois = next(preprocessing.crop_rois(self.frames, self.traps, (16, 16)))
+        self.assertTrue(np.allclose(tracker.track_rois(rois), tracker.track(self.frames)))
@@ -0,0 +1,170 @@
+"""Unit tests for the compiled trajectory simulation"""
+
+import unittest
+import os
+
+import numpy as np
+
+import scipy.constants as constants
+
+import tweezer.synth_active_trajectory as sat
+import tweezer.synth_multi_trajectory as smt
+import tweezer.plotting as plt
+
+class TestSimulate(unittest.TestCase):
+
+    def setUp(self):
+        self.parameters = dict(dt=0.005, trap_kx=2.5e-6, trap_ky=0.5e-6, trap_xfreq=2, trap_yfreq=1,
+                               trap_xamp=1e-6, trap_yamp=1e-6, bead_radius=0.5e-6, eta=9.7e-4, temp=300)
+
+    def test_shapes_and_time(self):
+        time, poz, trap_poz = sat.simulate(1000, seed=0, **self.parameters)
+        self.assertEqual(poz.shape, (1000, 2))
+        self.assertEqual(trap_poz.shape, (1000, 2))
+        self.assertTrue(np.allclose(np.diff(time), self.parameters["dt"], atol=sat.DT_INTERNAL))
+
+    def test_seed(self):
+        result1 = sat.simulate(100, seed=1, **self.parameters)
+        result2 = sat.simulate(100, seed=1, **self.parameters)
+        self.assertTrue(np.array_equal(result1[1], result2[1]))
+
+    def test_stiffness(self):
+        self.parameters.update(trap_xamp=0., trap_yamp=0.)
+        time, poz, trap_poz = sat.simulate(20000, seed=0, **self.parameters)
+        kx, ky = sat.estimate_stiffness(poz, self.parameters["temp"])
+        self.assertTrue(np.allclose((kx, ky), (2.5, 0.5), rtol=0.1))
+
+    def test_exact_integrator(self):
+        for motion_type in (1, 2):
+            results = []
+            for integrator in ("euler", "exact"):
+                time, poz, trap_poz = sat.simulate(20000, seed=0, motion_type=motion_type,
+                                                   integrator=integrator, **self.parameters)
+                results.append(poz - trap_poz)
+            self.assertTrue(np.allclose(results[0].std(axis=0), results[1].std(axis=0), rtol=0.05))
+            self.assertTrue(np.allclose(results[0].mean(axis=0), results[1].mean(axis=0), atol=5e-9))
+
+    def test_exact_time(self):
+        time = sat.simulate(100, integrator="exact", **self.parameters)[0]
+        self.assertTrue(np.allclose(time, np.arange(100)*self.parameters["dt"]))
+
+    def test_ensemble(self):
+        self.parameters.update(trap_kx=[1e-6, 2e-6, 4e-6], trap_xamp=0., trap_yamp=0.)
+        for integrator in sat.INTEGRATORS:
+            time, poz, trap_poz = sat.simulate_ensemble(10000, seed=0, integrator=integrator, **self.parameters)
+            self.assertEqual(poz.shape, (3, 10000, 2))
+            kx, ky = sat.estimate_stiffness(poz, self.parameters["temp"])
+            self.assertTrue(np.allclose(kx, (1., 2., 4.), rtol=0.15))
+            self.assertTrue(np.allclose(ky, 0.5, rtol=0.15))
+
+    def test_ensemble_first_bead(self):
+        single = sat.simulate(100, seed=2, **self.parameters)[1]
+        self.parameters.update(trap_kx=[2.5e-6, 1e-6])
+        ensemble = sat.simulate_ensemble(100, seed=2, **self.parameters)[1]
+        self.assertTrue(np.array_equal(single, ensemble[0]))
+
+    def test_ensemble_groups(self):
+        self.parameters.update(trap_kx=np.linspace(1e-6, 3e-6, 5), trap_xfreq=[2, 2, 3, 3, 2])
+        for integrator in sat.INTEGRATORS:
+            expected = sat.simulate_ensemble(500, seed=3, integrator=integrator, **self.parameters)
+            group = sat.ENSEMBLE_GROUP
+            sat.ENSEMBLE_GROUP = 2
+            try:
+                result = sat.simulate_ensemble(500, seed=3, integrator=integrator, **self.parameters)
+            finally:
+                sat.ENSEMBLE_GROUP = group
+            for a, b in zip(expected, result):
+                self.assertTrue(np.array_equal(a, b))
+
+    def test_write_file(self):
+        time, poz, trap_poz = sat.simulate(100, seed=0, **self.parameters)
+        sat.write_file("unit_test_simulate.dat", time, poz, trap_poz)
+        try:
+            t, traps, trajectories = plt.read_file("unit_test_simulate.dat", 1)
+        finally:
+            os.remove("unit_test_simulate.dat")
+        self.assertTrue(np.allclose(t, time, atol=1e-5))
+        self.assertTrue(np.allclose(traps[:, 0:2], trap_poz*1e6, atol=1e-3))
+        self.assertTrue(np.allclose(trajectories, poz*1e6, atol=1e-4))
+
+    def test_trap_path(self):
+        self.parameters.update(trap_xamp=0., trap_yamp=0.)
+        step = lambda t: np.stack((np.where(t < 10., 0., 1e-6), np.full_like(t, -1e-6)), axis=1)
+        time = np.arange(4000)*self.parameters["dt"]
+        for integrator in sat.INTEGRATORS:
+            result = sat.simulate(4000, seed=0, integrator=integrator, trap_path=step, **self.parameters)
+            self.assertTrue(np.array_equal(result[2], step(time)))
+            poz = result[1]
+            self.assertTrue(np.allclose(poz[200:2000].mean(axis=0), (0., -1e-6), atol=0.1e-6))
+            self.assertTrue(np.allclose(poz[2200:].mean(axis=0), (1e-6, -1e-6), atol=0.1e-6))
+            path_result = sat.simulate(4000, seed=0, integrator=integrator, trap_path=step(time), **self.parameters)
+            self.assertTrue(np.array_equal(result[1], path_result[1]))
+            chunks = list(sat.simulate_chunks(4000, seed=0, integrator=integrator, trap_path=step, chunk_size=1000, **self.parameters))
+            self.assertTrue(np.array_equal(np.concatenate([c[2] for c in chunks]), step(time)))
+
+    def test_chunks(self):
+        time, poz, trap_poz = sat.simulate(1000, seed=3, **self.parameters)
+        chunks = list(sat.simulate_chunks(1000, seed=3, chunk_size=1000, **self.parameters))
+        self.assertTrue(np.array_equal(chunks[0][1], poz))
+        chunks = list(sat.simulate_chunks(1000, seed=3, chunk_size=300, **self.parameters))
+        self.assertEqual([len(c[0]) for c in chunks], [300, 300, 300, 100])
+        self.assertTrue(np.array_equal(np.concatenate([c[0] for c in chunks]), time))
+        self.assertTrue(np.array_equal(np.concatenate([c[1] for c in chunks])[:300], poz[:300]))
+
+    def test_simulate_to_file(self):
+        for fmt, file_name in (("npy", "unit_test_simulate.npy"), ("raw", "unit_test_simulate.raw")):
+            k_estimate = sat.simulate_to_file(file_name, 1000, seed=4, fmt=fmt, dtype=np.float32, chunk_size=128, **self.parameters)
+            try:
+                data = np.array(sat.load_binary(file_name, np.float32))
+            finally:
+                os.remove(file_name)
+            self.assertEqual(data.shape, (1000, 5))
+            self.assertEqual(data.dtype, np.float32)
+            self.assertTrue(np.allclose(sat.estimate_stiffness(data[:, 3:5]*1e-6, self.parameters["temp"]), k_estimate, rtol=1e-4))
+
+        sat.simulate_to_file("unit_test_simulate.dat", 1000, seed=4, chunk_size=128, **self.parameters)
+        try:
+            time, traps, trajectories = plt.read_file("unit_test_simulate.dat", 1)
+        finally:
+            os.remove("unit_test_simulate.dat")
+        self.assertTrue(np.allclose(trajectories, data[:, 3:5], atol=1e-3))
+
+class TestSimulateMulti(unittest.TestCase):
+
+    def setUp(self):
+        self.traps = np.array([[0., 0.], [1.5e-6, 0.], [3e-6, 0.]])
+        self.parameters = dict(trap_k=1e-6, bead_radius=0.5e-6, eta=1e-3, temp=293)
+
+    def test_neighbour_pairs(self):
+        x = np.random.RandomState(0).rand(500, 2)*np.array([1e-4, 3e-5])
+        pairs = smt._neighbour_pairs(x, 3e-6)
+        distance = np.sqrt(((x[:, None] - x[None, :])**2).sum(axis=-1))
+        i, j = np.nonzero(np.triu(distance < 3e-6, 1))
+        self.assertEqual(set(zip(i, j)), set(map(tuple, np.sort(pairs, axis=1))))
+        self.assertEqual(len(pairs), len(i))
+
+    def test_equilibrium(self):
+        kBT = constants.Boltzmann*self.parameters["temp"]
+        for hydrodynamics in smt.HYDRODYNAMICS:
+            time, poz, trap_poz = smt.simulate_multi(4000, 2e-3, self.traps, hydrodynamics=hydrodynamics, seed=1, **self.parameters)
+            self.assertEqual(poz.shape, (4000, 3, 2))
+            self.assertTrue(np.allclose((poz - trap_poz).var(axis=0), kBT/self.parameters["trap_k"], rtol=0.25))
+
+    def test_exclusion(self):
+        time, poz, trap_poz = smt.simulate_multi(1000, 2e-3, np.zeros((2, 2)), seed=1, **self.parameters)
+        distance = np.sqrt(((poz[:, 0] - poz[:, 1])**2).sum(axis=-1))
+        self.assertTrue(np.all(distance >= 2*self.parameters["bead_radius"]*(1 - 1e-9)))
+
+    def test_write_file(self):
+        time, poz, trap_poz = smt.simulate_multi(100, 2e-3, self.traps, seed=1, **self.parameters)
+        smt.write_file("unit_test_multi.dat", time, poz, trap_poz)
+        try:
+            t, traps, trajectories = plt.read_file("unit_test_multi.dat", 3)
+        finally:
+            os.remove("unit_test_multi.dat")
+        self.assertTrue(np.allclose(t, time, atol=1e-5))
+        self.assertTrue(np.allclose(traps[:, 3:5], trap_poz[:, 1]*1e6, atol=1e-3))
+        self.assertTrue(np.allclose(trajectories, poz.reshape(100, 6)*1e6, atol=1e-4))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Unit tests for the parameter sweep runner"""
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import tweezer.sweep as sweep
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = sweep.parameter_grid(trap_kx=[1e-6, 4e-6], eta=[1e-3, 2e-3])
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_parameter_grid(self):
+        self.assertEqual(len(self.grid), 4)
+        self.assertEqual(self.grid[1], dict(trap_kx=1e-6, eta=2e-3))
+
+    def test_reproducible(self):
+        table1 = sweep.run_sweep(self.grid, 2000, 1e-3, seed=5, max_workers=2)
+        table2 = sweep.run_sweep(self.grid, 2000, 1e-3, seed=5, max_workers=1)
+        self.assertTrue(np.array_equal(table1, table2))
+        self.assertEqual(len(set(table1["seed"])), 4)
+        self.assertTrue(np.allclose(table1["kx_estimate"], table1["trap_kx"]*1e6, rtol=0.3))
+
+    def test_resume(self):
+        table1 = sweep.run_sweep(self.grid, 2000, 1e-3, out_dir=self.out_dir)
+        self.assertEqual(len(os.listdir(self.out_dir)), 4)
+        mtimes = [os.path.getmtime(os.path.join(self.out_dir, f)) for f in sorted(os.listdir(self.out_dir))]
+        os.remove(os.path.join(self.out_dir, "job_000002.npz"))
+        table2 = sweep.run_sweep(self.grid, 2000, 1e-3, out_dir=self.out_dir)
+        self.assertTrue(np.array_equal(table1, table2))
+        new_mtimes = [os.path.getmtime(os.path.join(self.out_dir, f)) for f in sorted(os.listdir(self.out_dir))]
+        self.assertEqual(mtimes[:2] + mtimes[3:], new_mtimes[:2] + new_mtimes[3:])
+
+    def test_resume_changed_settings(self):
+        table1 = sweep.run_sweep(self.grid[:1], 2000, 1e-3, out_dir=self.out_dir)
+        file_name = os.path.join(self.out_dir, "job_000000.npz")
+        mtime = os.path.getmtime(file_name)
+        #jobs with a different number of points are computed again
+        table2 = sweep.run_sweep(self.grid[:1], 3000, 1e-3, out_dir=self.out_dir)
+        self.assertFalse(np.array_equal(table1, table2))
+        with np.load(file_name) as f:
+            self.assertEqual(int(f["num_points"]), 3000)
+        self.assertGreaterEqual(os.path.getmtime(file_name), mtime)
+        table3 = sweep.run_sweep(self.grid[:1], 3000, 1e-3, out_dir=self.out_dir, integrator="euler")
+        with np.load(file_name) as f:
+            self.assertEqual(str(f["integrator"]), "euler")
+        self.assertFalse(np.array_equal(table2, table3))
+
+
+if __name__ == "__main__":
+    unittest.main()
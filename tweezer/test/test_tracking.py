@@ -0,0 +1,210 @@
+"""Unit tests for the tracking module"""
+
+import unittest
+import multiprocessing
+
+import numpy as np
+
+import tweezer.tracking as tracking
+import tweezer.brownian as brownian
+
+class TestLocate(unittest.TestCase):
+
+    def setUp(self):
+        #particles on a grid with random sub-pixel offsets
+        grid = np.stack(np.meshgrid(np.arange(16, 128, 16), np.arange(16, 128, 16), indexing="ij"), axis=-1).reshape(-1, 2)
+        self.points = grid[None] + np.random.rand(8, len(grid), 2) - 0.5
+        self.frames = brownian.render_frames(self.points, (128, 128), intensity=200, sigma=1.5, frame_dtype="uint16")
+
+    def distances(self, features, nframes):
+        d = []
+        for k in range(nframes):
+            f = features[features["frame"] == k]
+            self.assertEqual(len(f), self.points.shape[1])
+            located = np.stack((f["x"], f["y"]), axis=-1)
+            d.append(np.sqrt(((located[:, None] - self.points[k][None])**2).sum(-1)).min(0))
+        return np.concatenate(d)
+
+    def assert_positions(self, features, nframes, tolerance=0.1):
+        self.assertLess(self.distances(features, nframes).max(), tolerance)
+
+    def test_locate(self):
+        features = tracking.locate(self.frames[0], 50, radius=4)
+        self.assertEqual(features.dtype, tracking.FEATURE_DTYPE)
+        self.assertTrue(np.all(features["frame"] == 0))
+        self.assert_positions(features, 1)
+
+    def test_locate_video(self):
+        features = tracking.locate_video(self.frames, 50, radius=4, block=3)
+        self.assert_positions(features, len(self.points))
+        self.assertTrue(np.all(np.diff(features["frame"]) >= 0))
+        features2 = tracking.locate_video(iter(self.frames), 50, radius=4, block=3)
+        self.assertTrue(np.array_equal(features, features2))
+
+    def test_locate_parallel(self):
+        features = tracking.locate_video(self.frames, 50, radius=4, block=3)
+        #more blocks than slots, so slots are reused
+        parallel = tracking.locate_video_parallel(iter(self.frames), 50, radius=4, block=2, workers=2, slots=2)
+        self.assertTrue(np.array_equal(features, parallel))
+        blocks = list(tracking.locate_blocks_parallel(self.frames, 50, radius=4, block=3, workers=1, fit=True))
+        self.assertEqual(len(blocks), 3)
+        fitted = np.concatenate(blocks)
+        self.assertEqual(fitted.dtype, tracking.GAUSSIAN_DTYPE)
+        self.assertTrue(np.all(np.diff(fitted["frame"]) >= 0))
+        self.assert_positions(fitted, len(self.points))
+        self.assertEqual(len(tracking.locate_video_parallel(iter([]), 50, workers=1)), 0)
+
+    def test_parallel_memory(self):
+        frames = np.repeat(self.frames, 4, axis=0)
+        pulled = []
+
+        def source():
+            for i, frame in enumerate(frames):
+                pulled.append(i)
+                yield frame
+
+        returned = 0
+        for features in tracking.locate_blocks_parallel(source(), 50, radius=4, block=2, workers=2, slots=3):
+            returned += 2
+            #slots blocks in workers or waiting, plus the block being read
+            self.assertLessEqual(len(pulled) - returned, 3*2 + 2)
+        self.assertEqual(returned, len(frames))
+
+    def test_parallel_worker_died(self):
+        blocks = tracking.locate_blocks_parallel(np.repeat(self.frames, 4, axis=0), 50, radius=4, block=2, 
+                                                 workers=1, slots=2)
+        next(blocks)
+        for p in multiprocessing.active_children():
+            p.terminate()
+        with self.assertRaises(RuntimeError):
+            list(blocks)
+
+    def test_locate_background(self):
+        #a uniform background must not pull centroids towards the window center
+        frames = brownian.render_frames(self.points[:1], (128, 128), background=100, intensity=200, sigma=1.5,
+                                        frame_dtype="uint16")
+        features = tracking.locate(frames[0], 150, radius=4)
+        self.assert_positions(features, 1)
+        self.assertTrue(np.allclose(features["mass"], tracking.locate(self.frames[0], 50, radius=4)["mass"], rtol=0.05))
+
+    def test_plateau_and_edges(self):
+        frame = np.zeros((20, 20), "uint8")
+        frame[9:11, 9:11] = 100
+        frame[0, 0] = 100
+        features = tracking.locate(frame, 50, radius=2)
+        self.assertEqual(len(features), 1)
+        self.assertAlmostEqual(features["x"][0], 9.5)
+        self.assertAlmostEqual(features["mass"][0], 400)
+
+    def test_many_features(self):
+        frame = np.zeros((100, 100))
+        frame[2:-2:3, 2:-2:3] = 1.
+        features = tracking.locate(frame, 0.5, radius=1)
+        self.assertEqual(len(features), 32*32)
+
+    def test_fit_gaussians(self):
+        frames = brownian.render_frames(self.points, (128, 128), background=100, intensity=2000, sigma=1.5,
+                                        frame_dtype="uint16")
+        features = tracking.locate_video(frames, 500, radius=4)
+        fits = tracking.fit_gaussians(frames, features, radius=4)
+        self.assertEqual(fits.dtype, tracking.GAUSSIAN_DTYPE)
+        self.assertTrue(np.all(fits["converged"]))
+        self.assert_positions(fits, len(self.points), 0.02)
+        self.assertTrue(np.allclose(fits["sigma"], 1.5, atol=0.03))
+        self.assertTrue(np.allclose(fits["amplitude"], 2000, rtol=0.02))
+        self.assertTrue(np.array_equal(fits, tracking.locate_video(frames, 500, radius=4, fit=True)))
+
+    def test_fit_errors(self):
+        brownian.seed(1)
+        frames = brownian.render_frames(self.points, (128, 128), background=20, intensity=200, sigma=1.5,
+                                        shot_noise=True, frame_dtype="uint16")
+        fits = tracking.locate_video(frames, 60, radius=4, fit=True)
+        rms = np.sqrt((self.distances(fits, len(self.points))**2).mean()/2)
+        self.assertTrue(0.5 < rms/np.median(fits["x_error"]) < 2)
+
+    def test_fit_outside(self):
+        frame = np.zeros((1, 20, 20))
+        features = np.zeros(2, tracking.FEATURE_DTYPE)
+        features["x"] = [1., 10.]
+        features["y"] = [10., 10.]
+        frame[0, 8:13, 8:13] = 1.
+        fits = tracking.fit_gaussians(frame, features, radius=3)
+        self.assertFalse(fits["converged"][0])
+        self.assertTrue(np.isnan(fits["x"][0]))
+        self.assertRaises(ValueError, tracking.fit_gaussians, frame, features, start=1)
+
+class TestCorrelationTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.traps = np.array([[40., 40.], [40., 90.], [90., 60.]])
+        video = brownian.trapped_beads_video(64, 1e-3, self.traps, 1e-6, shape=(128, 128), intensity=100, sigma=2,
+                                             frame_dtype="uint16")
+        self.frames, self.positions = next(video)
+
+    def test_track(self):
+        tracker = tracking.CorrelationTracker(tracking.gaussian_reference((16, 16), 2), self.traps)
+        data = tracker.track_video(iter(self.frames), block=20)
+        self.assertEqual(data.shape, (64, 6))
+        self.assertLess(np.abs(data.reshape(64, 3, 2) - self.positions).max(), 0.05)
+        self.assertTrue(np.allclose(tracker.track(self.frames[10]), data[10]))
+
+    def test_reference_center(self):
+        #beads are located relative to the bead position in the reference image
+        reference = tracking.gaussian_reference((16, 16), 2)
+        shifted = tracking.CorrelationTracker(np.roll(reference, 2, axis=0), self.traps, reference_center=(9.5, 7.5))
+        data = shifted.track(self.frames[0]).reshape(3, 2)
+        self.assertLess(np.abs(data - self.positions[0]).max(), 0.1)
+
+    def test_outside(self):
+        tracker = tracking.CorrelationTracker(tracking.gaussian_reference((16, 16), 2), [[4., 64.]])
+        self.assertRaises(ValueError, tracker.track, self.frames[0])
+
+class TestLink(unittest.TestCase):
+
+    def features(self, x, keep):
+        frame, particle = np.nonzero(keep)
+        features = np.zeros(len(frame), tracking.FEATURE_DTYPE)
+        features["frame"], features["x"], features["y"] = frame, x[frame, particle, 0], x[frame, particle, 1]
+        return features, particle
+
+    def test_link(self):
+        rng = np.random.RandomState(0)
+        x = np.cumsum(rng.normal(0, 0.5, (50, 300, 2)), axis=0) + rng.rand(1, 300, 2)*1000
+        keep = rng.rand(50, 300) > 0.05
+        features, particle = self.features(x, keep)
+        #shuffled input order must not matter
+        order = rng.permutation(len(features))
+        linked = tracking.link(features[order], 3, memory=2)
+        self.assertTrue(np.array_equal(linked["x"], features["x"][order]))
+        ids = linked["particle"]
+        truth = particle[order]
+        #fraction of features linked to the majority particle of their trajectory; 
+        #particles that cross paths can be swapped
+        correct = sum(np.bincount(truth[ids == i]).max() for i in np.unique(ids))
+        self.assertGreater(correct/len(ids), 0.99)
+        self.assertLessEqual(len(np.unique(ids)), 305)
+
+    def test_gap_closing(self):
+        x = np.zeros((10, 2, 2))
+        x[:, 0] = np.arange(10)[:, None]*0.5
+        x[:, 1] = 50 + np.arange(10)[:, None]*0.5
+        keep = np.ones((10, 2), bool)
+        keep[4:6, 0] = False
+        features = self.features(x, keep)[0]
+        self.assertEqual(len(np.unique(tracking.link(features, 3, memory=2)["particle"])), 2)
+        self.assertEqual(len(np.unique(tracking.link(features, 3, memory=1)["particle"])), 3)
+
+    def test_trajectories(self):
+        x = np.repeat(np.random.rand(1, 3, 2)*100, 5, axis=0)
+        keep = np.ones((5, 3), bool)
+        keep[2, 1] = False
+        linked = tracking.link(self.features(x, keep)[0], 1e-3, memory=1)
+        time, data, particles = tracking.trajectories(linked, dt=0.5, pixel_size=0.1)
+        self.assertTrue(np.allclose(time, np.arange(5)*0.5))
+        self.assertEqual(data.shape, (5, 6))
+        self.assertTrue(np.allclose(data[:, 0:2], x[:, 0]*0.1))
+        self.assertTrue(np.isnan(data[2, 2]))
+        self.assertEqual(tracking.trajectories(linked, min_length=5)[1].shape, (5, 4))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Unit tests for the memory-mapped video storage"""
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import tweezer.video as video
+import tweezer.brownian as brownian
+
+class TestVideo(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.frames = (np.random.rand(10, 16, 24)*1000).astype("uint16")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_formats(self):
+        for name in ("video.npy", "video.raw"):
+            file_name = os.path.join(self.dir, name)
+            v = video.write_video(file_name, iter(self.frames), 10, (16, 24), "uint16")
+            self.assertEqual(len(v), 10)
+            self.assertEqual(v.shape, (10, 16, 24))
+            self.assertTrue(np.array_equal(v[3], self.frames[3]))
+            self.assertTrue(np.array_equal(v[2:8:2], self.frames[2:8:2]))
+            self.assertTrue(np.array_equal(list(v), list(self.frames)))
+            self.assertIsInstance(v[1:3], np.memmap)
+            v.close()
+        self.assertTrue(np.array_equal(np.load(os.path.join(self.dir, "video.npy")), self.frames))
+
+    def test_write_blocks(self):
+        file_name = os.path.join(self.dir, "video.raw")
+        with video.create_video(file_name, 10, (16, 24), "uint16") as v:
+            v.write(self.frames[:4])
+            v.write(self.frames[4])
+            v.write(self.frames[5:])
+            self.assertRaises(ValueError, v.write, self.frames[0])
+        v = video.open_video(file_name, "r+")
+        v[0] = 0
+        v.close()
+        self.assertTrue(np.array_equal(video.open_video(file_name)[1:], self.frames[1:]))
+        self.assertEqual(video.open_video(file_name)[0].max(), 0)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, video.create_video, os.path.join(self.dir, "video.npy"), 2, (4, 4), "float32")
+        file_name = os.path.join(self.dir, "video.raw")
+        with open(file_name, "wb") as f:
+            f.write(b"not a video")
+        self.assertRaises(ValueError, video.open_video, file_name)
+
+    def test_particles_video_file(self):
+        file_name = os.path.join(self.dir, "video.npy")
+        np.random.seed(0)
+        brownian.seed(0)
+        v = brownian.particles_video_file(file_name, 20, shape=(32, 32), particles=5, block=8)
+        np.random.seed(0)
+        brownian.seed(0)
+        expected = list(brownian.frame_grabber(20, shape=(32, 32), particles=5, block=8))
+        self.assertEqual(len(v), 20)
+        self.assertTrue(np.array_equal(v[:], expected))
+
+if __name__ == "__main__":
+    unittest.main()
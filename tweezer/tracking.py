@@ -1,5 +1,940 @@
 """
 Particle tracking routines
+
+Particles are located in video frames as local intensity maxima above a
+threshold. Positions are refined to sub-pixel precision with intensity-weighted
+centroids. Frames can be given as a single 2D array, a 3D array of frames,
+a memory-mapped video (see video.VideoFile) or any iterator of 2D frames, such
+as brownian.frame_grabber. Frames can be cropped to regions of interest and
+background-subtracted before tracking, see preprocessing.
+
+Located features are linked into trajectories of individual particles with
+link, and converted to the (time, x, y) layout of calibration.calibrate with
+trajectories.
+
+Single beads in optical traps can also be tracked with CorrelationTracker,
+which cross-correlates a region of interest around each trap with a reference
+bead image. FFTs are computed with mkl_fft if it is installed, with scipy.fft
+otherwise, see FFT_BACKEND.
+
+Coordinates follow the convention of brownian.py: x is the coordinate along
+the first axis (rows) and y along the second axis (columns) of the frame,
+with pixel centers at integer coordinates.
 """
 
-from __future__ import absolute_import, print_function, division
\ No newline at end of file
+from __future__ import absolute_import, print_function, division
+
+import math
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+import numba as nb
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from tweezer.conf import NUMBA_CACHE, MKL_FFT_INSTALLED
+
+if MKL_FFT_INSTALLED:
+    import mkl_fft as _fft
+    #: FFT implementation used by CorrelationTracker
+    FFT_BACKEND = "mkl_fft"
+else:
+    import scipy.fft as _fft
+    FFT_BACKEND = "scipy"
+
+def _fft2(a):
+    """FFT over the last two axes, input array may be overwritten."""
+    return _fft.fft2(a, axes = (-2,-1), overwrite_x = True)
+
+def _ifft2(a):
+    """Inverse FFT over the last two axes, input array may be overwritten."""
+    return _fft.ifft2(a, axes = (-2,-1), overwrite_x = True)
+
+#: dtype of located features: frame index, sub-pixel position and total intensity above the local background
+FEATURE_DTYPE = np.dtype([("frame", np.int64), ("x", np.float64), ("y", np.float64), ("mass", np.float64)])
+
+#: dtype of features refined with gaussian fits, see fit_gaussians
+GAUSSIAN_DTYPE = np.dtype(FEATURE_DTYPE.descr + [("sigma", np.float64), ("amplitude", np.float64),
+                                                 ("background", np.float64), ("x_error", np.float64),
+                                                 ("y_error", np.float64), ("sigma_error", np.float64),
+                                                 ("converged", np.bool_)])
+
+#: initial number of features per frame that is reserved in the output buffers
+MAX_FEATURES = 256
+
+#: fitted parameters of the gaussian model, in this order
+GAUSSIAN_PARAMETERS = ("x", "y", "amplitude", "sigma", "background")
+
+#: seconds to wait for a result of a worker process before checking that all workers are alive
+WORKER_POLL_TIMEOUT = 1.
+
+@nb.njit(cache = NUMBA_CACHE)
+def _is_local_max(frame, i, j, radius):
+    """Checks whether pixel i,j is the maximum of the (2*radius+1)^2 window.
+    Ties are resolved in raster order, so a plateau gives a single maximum."""
+    value = frame[i,j]
+    for k in range(i - radius, i + radius + 1):
+        for l in range(j - radius, j + radius + 1):
+            other = frame[k,l]
+            if other > value:
+                return False
+            if other == value and (k < i or (k == i and l < j)):
+                return False
+    return True
+
+@nb.njit(cache = NUMBA_CACHE)
+def _edge_mean(frame, i, j, radius):
+    """Mean of the pixels on the edge of the (2*radius+1)^2 window around i,j."""
+    if radius == 0:
+        return 0.
+    s = 0.
+    for k in range(-radius, radius + 1):
+        s += float(frame[i+k,j-radius]) + float(frame[i+k,j+radius])
+    for l in range(-radius + 1, radius):
+        s += float(frame[i-radius,j+l]) + float(frame[i+radius,j+l])
+    return s/(8*radius)
+
+@nb.njit(cache = NUMBA_CACHE)
+def _locate_frame(frame, threshold, radius, out):
+    """Finds local maxima above threshold and computes their centroids.
+
+    The local background, the mean of the pixels on the window edge, is
+    subtracted before weighting and negative weights are clipped to zero, so 
+    a background does not pull centroids towards the window center.
+
+    Features are written to rows of out as (x, y, mass). Returns the number of
+    features found, which can be larger than len(out); in that case only the
+    first len(out) features are written."""
+    height, width = frame.shape
+    count = 0
+    for i in range(radius, height - radius):
+        for j in range(radius, width - radius):
+            if frame[i,j] > threshold and _is_local_max(frame, i, j, radius):
+                if count < len(out):
+                    background = _edge_mean(frame, i, j, radius)
+                    mass = 0.
+                    x = 0.
+                    y = 0.
+                    for k in range(i - radius, i + radius + 1):
+                        for l in range(j - radius, j + radius + 1):
+                            value = max(float(frame[k,l]) - background, 0.)
+                            mass += value
+                            x += value*k
+                            y += value*l
+                    if mass > 0:
+                        out[count,0] = x/mass
+                        out[count,1] = y/mass
+                    else:
+                        #flat window
+                        out[count,0] = i
+                        out[count,1] = j
+                    out[count,2] = mass
+                count += 1
+    return count
+
+@nb.njit(parallel = True, cache = NUMBA_CACHE)
+def _locate_frames(frames, threshold, radius, out, counts):
+    """Runs _locate_frame for all frames in parallel; features of frame k are
+    written to out[k] and their number to counts[k]."""
+    for k in nb.prange(len(frames)):
+        counts[k] = _locate_frame(frames[k], threshold, radius, out[k])
+
+def _to_features(out, counts, start):
+    """Packs located features into a structured array."""
+    counts = np.minimum(counts, out.shape[1])
+    features = np.empty(counts.sum(), FEATURE_DTYPE)
+    frame = np.repeat(np.arange(len(counts)), counts)
+    index = np.arange(out.shape[1])[None,:] < counts[:,None]
+    features["frame"] = frame + start
+    features["x"], features["y"], features["mass"] = out[index].T
+    return features
+
+@nb.njit(cache = NUMBA_CACHE)
+def _solve(a, b, out):
+    """Solves a small linear system a.out = b with gaussian elimination and 
+    partial pivoting. a and b are overwritten. Returns False if a is singular."""
+    n = len(b)
+    for i in range(n):
+        p = i
+        for k in range(i + 1, n):
+            if abs(a[k,i]) > abs(a[p,i]):
+                p = k
+        if a[p,i] == 0.:
+            return False
+        if p != i:
+            for l in range(n):
+                a[i,l], a[p,l] = a[p,l], a[i,l]
+            b[i], b[p] = b[p], b[i]
+        for k in range(i + 1, n):
+            f = a[k,i]/a[i,i]
+            for l in range(i, n):
+                a[k,l] -= f*a[i,l]
+            b[k] -= f*b[i]
+    for i in range(n - 1, -1, -1):
+        value = b[i]
+        for l in range(i + 1, n):
+            value -= a[i,l]*out[l]
+        out[i] = value/a[i,i]
+    return True
+
+@nb.njit(cache = NUMBA_CACHE)
+def _gaussian_normal_equations(roi, i0, j0, p, hessian, gradient):
+    """Computes the Gauss-Newton hessian approximation J^T.J and gradient J^T.r
+    of the gaussian model with parameters p for a roi with the top-left pixel 
+    at (i0, j0). Returns the sum of squared residuals."""
+    x, y, amplitude, sigma, background = p[0], p[1], p[2], p[3], p[4]
+    hessian[...] = 0.
+    gradient[...] = 0.
+    g = np.empty(5)
+    cost = 0.
+    for k in range(roi.shape[0]):
+        dx = i0 + k - x
+        for l in range(roi.shape[1]):
+            dy = j0 + l - y
+            r2 = dx*dx + dy*dy
+            e = math.exp(-0.5*r2/(sigma*sigma))
+            residual = roi[k,l] - (amplitude*e + background)
+            g[0] = amplitude*e*dx/(sigma*sigma)
+            g[1] = amplitude*e*dy/(sigma*sigma)
+            g[2] = e
+            g[3] = amplitude*e*r2/(sigma*sigma*sigma)
+            g[4] = 1.
+            for m in range(5):
+                gradient[m] += g[m]*residual
+                for n in range(m, 5):
+                    hessian[m,n] += g[m]*g[n]
+            cost += residual*residual
+    for m in range(5):
+        for n in range(m):
+            hessian[m,n] = hessian[n,m]
+    return cost
+
+@nb.njit(cache = NUMBA_CACHE)
+def _fit_gaussian(roi, i0, j0, p, error, max_iterations, tolerance):
+    """Fits a symmetric 2D gaussian to roi with the Levenberg-Marquardt method.
+    
+    p holds the initial (x, y, amplitude, sigma, background) parameters and is
+    overwritten with the fitted values; standard errors of the parameters are
+    written to error. Returns True if the fit converged."""
+    hessian = np.empty((5,5))
+    gradient = np.empty(5)
+    a = np.empty((5,5))
+    b = np.empty(5)
+    step = np.empty(5)
+    trial = np.empty(5)
+    lam = 1e-3
+    cost = _gaussian_normal_equations(roi, i0, j0, p, hessian, gradient)
+    converged = False
+    for iteration in range(max_iterations):
+        a[...] = hessian
+        for m in range(5):
+            a[m,m] += lam*hessian[m,m]
+        b[...] = gradient
+        if not _solve(a, b, step):
+            break
+        trial[...] = p + step
+        trial[3] = abs(trial[3])
+        if trial[3] == 0.:
+            lam *= 10.
+            continue
+        trial_cost = _gaussian_normal_equations(roi, i0, j0, trial, a, b)
+        if trial_cost <= cost:
+            p[...] = trial
+            hessian[...] = a
+            gradient[...] = b
+            small = abs(step[0]) < tolerance and abs(step[1]) < tolerance
+            cost, old_cost = trial_cost, cost
+            lam = max(lam/10., 1e-10)
+            if small or old_cost - cost <= 1e-12*old_cost:
+                converged = True
+                break
+        else:
+            lam *= 10.
+            if lam > 1e10:
+                break
+    #standard errors from the diagonal of the covariance matrix cost/(n-5)*inv(J^T.J)
+    dof = roi.size - 5
+    scale = cost/dof if dof > 0 else np.nan
+    for m in range(5):
+        a[...] = hessian
+        b[...] = 0.
+        b[m] = 1.
+        if _solve(a, b, step):
+            error[m] = math.sqrt(abs(step[m])*scale)
+        else:
+            error[m] = np.nan
+    return converged
+
+@nb.njit(parallel = True, cache = NUMBA_CACHE)
+def _fit_gaussians(frames, index, positions, radius, sigma0, max_iterations, tolerance, params, errors, converged):
+    """Fits gaussians to rois of all features in parallel. Feature k is in 
+    frames[index[k]] at initial position positions[k]."""
+    height, width = frames.shape[1], frames.shape[2]
+    size = 2*radius + 1
+    for k in nb.prange(len(index)):
+        i0 = int(round(positions[k,0])) - radius
+        j0 = int(round(positions[k,1])) - radius
+        if i0 < 0 or j0 < 0 or i0 + size > height or j0 + size > width:
+            params[k,:] = np.nan
+            errors[k,:] = np.nan
+            converged[k] = False
+            continue
+        roi = np.empty((size, size))
+        for i in range(size):
+            for j in range(size):
+                roi[i,j] = frames[index[k], i0 + i, j0 + j]
+        background = roi.min()
+        amplitude = roi.max() - background
+        if sigma0 > 0:
+            sigma = sigma0
+        else:
+            #initial width from the second moment of the roi
+            mass = 0.
+            moment = 0.
+            for i in range(size):
+                for j in range(size):
+                    w = roi[i,j] - background
+                    mass += w
+                    moment += w*((i0 + i - positions[k,0])**2 + (j0 + j - positions[k,1])**2)
+            sigma = math.sqrt(0.5*moment/mass) if mass > 0 else 1.
+            sigma = min(max(sigma, 0.5), radius)
+        p = params[k]
+        p[0] = positions[k,0]
+        p[1] = positions[k,1]
+        p[2] = amplitude
+        p[3] = sigma
+        p[4] = background
+        converged[k] = _fit_gaussian(roi, i0, j0, p, errors[k], max_iterations, tolerance)
+
+def fit_gaussians(frames, features, radius = 3, start = 0, sigma = None, max_iterations = 50, tolerance = 1e-6):
+    """Refines feature positions with symmetric 2D gaussian fits.
+    
+    The model amplitude*exp(-r^2/(2*sigma^2)) + background is fitted to the 
+    (2*radius+1)^2 roi around each feature with the Levenberg-Marquardt method.
+    All rois are fitted in a single compiled call, in parallel.
+    
+    Parameters
+    ----------
+    frames : ndarray
+        Frames of shape (n, height, width)
+    features : ndarray
+        Structured array of features with frame, x and y fields, for instance
+        the output of locate_frames
+    radius : int
+        Radius of the roi [pixels]
+    start : int
+        Frame index of the first frame, feature of frame i is in frames[i-start]
+    sigma : float, optional
+        Initial gaussian width [pixels]. If not given, it is estimated from 
+        the second moment of the roi.
+    max_iterations : int
+        Maximum number of iterations
+    tolerance : float
+        Fit is converged when position updates are smaller than this [pixels]
+    
+    Returns
+    -------
+    features : ndarray
+        Structured array of GAUSSIAN_DTYPE. Mass is the integrated intensity of
+        the gaussian, x_error, y_error and sigma_error are standard errors of 
+        the fitted parameters. Features with rois outside of the frame have nan
+        values and converged set to False.
+    """
+    frames = np.asarray(frames)
+    if frames.ndim != 3:
+        raise ValueError("Frames must be a 3D array")
+    index = np.asarray(features["frame"] - start, np.int64)
+    if len(index) and (index.min() < 0 or index.max() >= len(frames)):
+        raise ValueError("Features outside of the given frames")
+    positions = np.stack((features["x"], features["y"]), axis = -1).astype(float)
+    params = np.empty((len(index), 5))
+    errors = np.empty((len(index), 5))
+    converged = np.empty(len(index), np.bool_)
+    _fit_gaussians(frames, index, positions, int(radius), 0. if sigma is None else float(sigma), 
+                   int(max_iterations), float(tolerance), params, errors, converged)
+    
+    out = np.empty(len(index), GAUSSIAN_DTYPE)
+    out["frame"] = features["frame"]
+    for i, name in enumerate(GAUSSIAN_PARAMETERS):
+        out[name] = params[:,i]
+    with np.errstate(over = "ignore"):
+        #fits that did not converge may have very large parameters
+        out["mass"] = 2*np.pi*out["amplitude"]*out["sigma"]**2
+    out["x_error"], out["y_error"], out["sigma_error"] = errors[:,0], errors[:,1], errors[:,3]
+    out["converged"] = converged
+    return out
+
+def locate_frames(frames, threshold, radius = 3, start = 0):
+    """Locates particles in a block of frames.
+
+    Parameters
+    ----------
+    frames : ndarray
+        Frames of shape (n, height, width)
+    threshold : float
+        Only local maxima brighter than threshold are considered
+    radius : int
+        Radius of the window [pixels]. A feature must be the brightest pixel
+        in the (2*radius+1)^2 window around it and its centroid and mass are
+        computed in this window, above the mean intensity of the window 
+        edge. Features closer than radius to the frame edge are ignored.
+    start : int
+        Frame index of the first frame
+
+    Returns
+    -------
+    features : ndarray
+        Structured array of FEATURE_DTYPE, sorted by frame
+    """
+    frames = np.asarray(frames)
+    if frames.ndim != 3:
+        raise ValueError("Frames must be a 3D array")
+    counts = np.zeros(len(frames), np.int64)
+    max_features = MAX_FEATURES
+    while True:
+        out = np.empty((len(frames), max_features, 3))
+        _locate_frames(frames, threshold, int(radius), out, counts)
+        if counts.max(initial = 0) <= max_features:
+            return _to_features(out, counts, start)
+        max_features = int(counts.max())
+
+def locate(frame, threshold, radius = 3):
+    """Locates particles in a single frame. See locate_frames."""
+    return locate_frames(np.asarray(frame)[None], threshold, radius)
+
+def frame_blocks(video, block = 256):
+    """Returns an iterator over blocks of frames of shape (n, height, width).
+
+    Array-like videos (arrays, video.VideoFile) are sliced without copying,
+    frames of other iterables are collected into a buffer of block frames. The
+    buffer is reused, so each block must be processed before the next one is
+    requested.
+    """
+    try:
+        nframes = len(video)
+        video[0:0]
+    except TypeError:
+        buffer = None
+        n = 0
+        for frame in video:
+            if buffer is None:
+                buffer = np.empty((block,) + np.shape(frame), np.asarray(frame).dtype)
+            buffer[n] = frame
+            n += 1
+            if n == block:
+                yield buffer
+                n = 0
+        if n > 0:
+            yield buffer[:n]
+    else:
+        for i in range(0, nframes, block):
+            yield np.asarray(video[i:i+block])
+
+def locate_video(video, threshold, radius = 3, block = 256, fit = False):
+    """Locates particles in all frames of a video.
+
+    Parameters
+    ----------
+    video : iterable
+        Frames of a video, a 3D array, a video.VideoFile or an iterator of
+        2D frames
+    threshold : float
+        Intensity threshold, see locate_frames
+    radius : int
+        Window radius, see locate_frames
+    block : int
+        Frames are processed in blocks of this size, in parallel
+    fit : bool
+        If set, positions are refined with gaussian fits, see fit_gaussians
+
+    Returns
+    -------
+    features : ndarray
+        Structured array of FEATURE_DTYPE (GAUSSIAN_DTYPE if fit is set), 
+        sorted by frame
+
+    Examples
+    --------
+    >>> import tweezer.brownian as brownian
+    >>> video = brownian.frame_grabber(1024, particles = 10, sigma = 2, intensity = 30)
+    >>> features = locate_video(video, threshold = 15)
+    """
+    features = []
+    start = 0
+    for frames in frame_blocks(video, block):
+        f = locate_frames(frames, threshold, radius, start)
+        if fit:
+            f = fit_gaussians(frames, f, radius, start)
+        features.append(f)
+        start += len(frames)
+    if features:
+        return np.concatenate(features)
+    return np.empty(0, GAUSSIAN_DTYPE if fit else FEATURE_DTYPE)
+
+def _locate_worker(name, shape, dtype, tasks, results, threshold, radius, fit):
+    """Worker process of locate_blocks_parallel. Locates particles in blocks
+    of frames in the shared memory ring buffer."""
+    #each process runs a single thread, parallelism comes from the workers
+    nb.set_num_threads(1)
+    shm = shared_memory.SharedMemory(name = name)
+    ring = np.ndarray(shape, dtype, buffer = shm.buf)
+    try:
+        for slot, start, n in iter(tasks.get, None):
+            try:
+                frames = ring[slot,:n]
+                features = locate_frames(frames, threshold, radius, start)
+                if fit:
+                    features = fit_gaussians(frames, features, radius, start)
+                results.put((slot, start, n, features))
+            except Exception as e:
+                results.put((slot, start, n, e))
+    finally:
+        #views of the shared memory must be released before it is closed
+        frames = ring = None
+        shm.close()
+
+def locate_blocks_parallel(video, threshold, radius = 3, block = 64, workers = None, slots = None, fit = False):
+    """Locates particles in a video with multiple worker processes.
+    
+    Frames are copied into a ring buffer of slots blocks in shared memory, so 
+    they are not pickled. Worker processes locate particles in the blocks and 
+    the results are returned in frame order. At most slots blocks of frames
+    and results are held in memory at a time: a new block is not submitted
+    while blocks in the workers and results waiting to be returned in order
+    fill all the slots.
+    
+    Raises RuntimeError if a worker process dies.
+    
+    Parameters
+    ----------
+    video : iterable
+        Frames of a video, a 3D array, a video.VideoFile or an iterator of
+        2D frames, such as brownian.frame_grabber
+    threshold : float
+        Intensity threshold, see locate_frames
+    radius : int
+        Window radius, see locate_frames
+    block : int
+        Number of frames in a block
+    workers : int, optional
+        Number of worker processes, defaults to the number of processors
+    slots : int, optional
+        Number of blocks in the ring buffer, defaults to 2*workers
+    fit : bool
+        If set, positions are refined with gaussian fits, see fit_gaussians
+        
+    Yields
+    ------
+    features : ndarray
+        Located features of each block of frames, in frame order
+    """
+    workers = multiprocessing.cpu_count() if workers is None else workers
+    slots = 2*workers if slots is None else slots
+    blocks = frame_blocks(video, block)
+    try:
+        first = next(blocks)
+    except StopIteration:
+        return
+    shape = (slots, block) + first.shape[1:]
+    shm = shared_memory.SharedMemory(create = True, size = max(1, int(np.prod(shape))*first.dtype.itemsize))
+    #numba threading layers are not fork-safe, so workers are always spawned
+    context = multiprocessing.get_context("spawn")
+    tasks, results = context.Queue(), context.Queue()
+    processes = [context.Process(target = _locate_worker, args = (shm.name, shape, first.dtype, tasks, results, threshold, radius, fit), 
+                                 daemon = True) for i in range(workers)]
+    try:
+        for p in processes:
+            p.start()
+        ring = np.ndarray(shape, first.dtype, buffer = shm.buf)
+        free = list(range(slots))
+        done = {}
+        start = 0
+        next_start = 0
+        
+        def receive():
+            while True:
+                try:
+                    slot, start, n, features = results.get(timeout = WORKER_POLL_TIMEOUT)
+                    break
+                except queue.Empty:
+                    #workers only exit when they are told to, so an exit is a crash
+                    for p in processes:
+                        if not p.is_alive():
+                            raise RuntimeError("Worker process died with exit code {}".format(p.exitcode))
+            if isinstance(features, Exception):
+                raise features
+            free.append(slot)
+            done[start] = n, features
+            
+        for frames in _chain(first, blocks):
+            #blocks in workers and results waiting for their turn share the slots budget
+            while len(free) <= len(done):
+                if next_start in done:
+                    n, features = done.pop(next_start)
+                    next_start += n
+                    yield features
+                else:
+                    receive()
+            slot = free.pop()
+            ring[slot,:len(frames)] = frames
+            tasks.put((slot, start, len(frames)))
+            start += len(frames)
+            #yield results in frame order, blocks done out of order wait in done
+            while next_start in done:
+                n, features = done.pop(next_start)
+                next_start += n
+                yield features
+        while next_start < start:
+            while next_start not in done:
+                receive()
+            n, features = done.pop(next_start)
+            next_start += n
+            yield features
+    finally:
+        for p in processes:
+            if p.is_alive():
+                tasks.put(None)
+        for p in processes:
+            if p.pid is not None:
+                p.join(timeout = 10)
+                if p.is_alive():
+                    p.terminate()
+        ring = None
+        shm.close()
+        shm.unlink()
+
+def _chain(first, blocks):
+    yield first
+    for frames in blocks:
+        yield frames
+
+def locate_video_parallel(video, threshold, radius = 3, block = 64, workers = None, slots = None, fit = False):
+    """Locates particles in all frames of a video with multiple worker processes. 
+    See locate_blocks_parallel for parameters and locate_video for the output."""
+    features = list(locate_blocks_parallel(video, threshold, radius, block, workers, slots, fit))
+    if features:
+        return np.concatenate(features)
+    return np.empty(0, GAUSSIAN_DTYPE if fit else FEATURE_DTYPE)
+
+def _link_frame(track_positions, positions, max_displacement):
+    """Links tracks to detections of a single frame.
+    
+    Candidate pairs closer than max_displacement are found with kd-trees. The 
+    bipartite graph of candidate pairs is split into connected subproblems; 
+    pairs that are alone in their subproblem are linked directly, others are 
+    solved as a linear assignment problem that minimizes the sum of squared 
+    displacements, where leaving a track or a detection unlinked costs 
+    max_displacement**2.
+    
+    Returns indices of linked tracks and detections."""
+    ntracks, ndetections = len(track_positions), len(positions)
+    pairs = cKDTree(track_positions).sparse_distance_matrix(cKDTree(positions), max_displacement, output_type = "ndarray")
+    if len(pairs) == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    i, j, distance = pairs["i"], pairs["j"], pairs["v"]
+    graph = coo_matrix((np.ones(len(i)), (i, j + ntracks)), shape = (ntracks + ndetections,)*2)
+    labels = connected_components(graph, directed = False)[1]
+    label = labels[i]
+    edges = np.bincount(label, minlength = labels.max() + 1)
+    simple = edges[label] == 1
+    tracks, detections = [i[simple]], [j[simple]]
+    
+    #larger subproblems, pairs sorted by subproblem
+    order = np.argsort(label[~simple], kind = "stable")
+    i, j, cost, label = i[~simple][order], j[~simple][order], distance[~simple][order]**2, label[~simple][order]
+    bounds = np.flatnonzero(np.diff(label)) + 1
+    nonlink = max_displacement**2
+    for si, sj, scost in zip(np.split(i, bounds), np.split(j, bounds), np.split(cost, bounds)):
+        ti, a = np.unique(si, return_inverse = True)
+        dj, b = np.unique(sj, return_inverse = True)
+        na, nb_ = len(ti), len(dj)
+        #augmented cost matrix, with an unlinked option for each track and detection
+        big = 2*nonlink*(na + nb_) + 1.
+        matrix = np.full((na + nb_, nb_ + na), big)
+        matrix[a, b] = scost
+        matrix[np.arange(na), nb_ + np.arange(na)] = nonlink
+        matrix[na + np.arange(nb_), np.arange(nb_)] = nonlink
+        matrix[na:, nb_:] = 0.
+        rows, cols = linear_sum_assignment(matrix)
+        linked = (rows < na) & (cols < nb_)
+        tracks.append(ti[rows[linked]])
+        detections.append(dj[cols[linked]])
+    return np.concatenate(tracks), np.concatenate(detections)
+
+def link(features, max_displacement, memory = 0):
+    """Links features of consecutive frames into particle trajectories.
+    
+    Parameters
+    ----------
+    features : ndarray
+        Structured array with frame, x and y fields, for instance the output of
+        locate_video
+    max_displacement : float
+        Maximum displacement of a particle between two frames [pixels]
+    memory : int
+        Maximum number of consecutive frames in which a particle may be missing
+        (gap closing). The particle is searched for around its last known
+        position.
+        
+    Returns
+    -------
+    features : ndarray
+        Copy of features with an additional particle field that holds the
+        trajectory index of each feature
+    
+    Examples
+    --------
+    >>> features = locate_video(video, threshold = 15)
+    >>> linked = link(features, max_displacement = 5, memory = 2)
+    >>> time, data, particles = trajectories(linked, dt = 1e-3, pixel_size = 0.1)
+    """
+    out = np.empty(len(features), features.dtype.descr + [("particle", np.int64)])
+    for name in features.dtype.names:
+        out[name] = features[name]
+    order = np.argsort(features["frame"], kind = "stable")
+    frames = features["frame"][order]
+    positions = np.stack((features["x"], features["y"]), axis = -1)[order].astype(float)
+    particle = np.empty(len(features), np.int64)
+    
+    track_ids = np.empty(0, np.int64)
+    track_positions = np.empty((0,2))
+    track_frames = np.empty(0, np.int64)
+    next_id = 0
+    bounds = np.flatnonzero(np.diff(frames)) + 1
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(frames)]):
+        frame = frames[start]
+        current = positions[start:stop]
+        #forget tracks that have been missing for more than memory frames
+        alive = track_frames >= frame - 1 - memory
+        track_ids, track_positions, track_frames = track_ids[alive], track_positions[alive], track_frames[alive]
+        
+        ids = np.full(len(current), -1, np.int64)
+        if len(track_ids):
+            tracks, detections = _link_frame(track_positions, current, max_displacement)
+            ids[detections] = track_ids[tracks]
+            track_positions[tracks] = current[detections]
+            track_frames[tracks] = frame
+        new = ids == -1
+        ids[new] = next_id + np.arange(new.sum())
+        next_id += new.sum()
+        track_ids = np.r_[track_ids, ids[new]]
+        track_positions = np.r_[track_positions, current[new]]
+        track_frames = np.r_[track_frames, np.full(new.sum(), frame)]
+        particle[start:stop] = ids
+    out["particle"][order] = particle
+    return out
+
+def trajectories(linked, dt = 1., pixel_size = 1., min_length = 1):
+    """Converts linked features to the (time, x, y) layout of 
+    calibration.calibrate and force_calc.force_calculation.
+    
+    Parameters
+    ----------
+    linked : ndarray
+        Linked features, see link
+    dt : float
+        Time between frames
+    pixel_size : float
+        Positions are multiplied by this factor, e.g. pixel size in micrometers
+    min_length : int
+        Trajectories with fewer features are discarded
+    
+    Returns
+    -------
+    time : ndarray
+        Times of all frames from frame 0 to the last frame
+    data : ndarray
+        Array of shape (frames, 2*P) of x and y coordinates of P particles:
+        columns 2*i and 2*i+1 are x and y of the i-th particle. Frames in which
+        a particle was not found are nan.
+    particles : ndarray
+        Particle indices of the columns
+    """
+    ids, inverse, counts = np.unique(linked["particle"], return_inverse = True, return_counts = True)
+    keep = counts >= min_length
+    column = (np.cumsum(keep) - 1)[inverse]
+    valid = keep[inverse]
+    nframes = int(linked["frame"].max()) + 1 if len(linked) else 0
+    data = np.full((nframes, 2*keep.sum()), np.nan)
+    frame = linked["frame"][valid]
+    data[frame, 2*column[valid]] = linked["x"][valid]*pixel_size
+    data[frame, 2*column[valid] + 1] = linked["y"][valid]*pixel_size
+    return np.arange(nframes)*dt, data, ids[keep]
+
+@nb.njit(cache = NUMBA_CACHE)
+def _copy_rois(frames, origins, out):
+    """Copies ROIs of a block of frames to out, with mean subtracted."""
+    n, p, h, w = out.shape
+    for k in range(n):
+        for l in range(p):
+            i0, j0 = origins[l,0], origins[l,1]
+            s = 0.
+            for i in range(h):
+                for j in range(w):
+                    s += frames[k,i0+i,j0+j]
+            mean = s/(h*w)
+            for i in range(h):
+                for j in range(w):
+                    out[k,l,i,j] = frames[k,i0+i,j0+j] - mean
+
+@nb.njit(cache = NUMBA_CACHE)
+def _subpixel(cm, c0, cp):
+    #vertex of a parabola through three points around the peak
+    d = cm - 2*c0 + cp
+    if d < 0:
+        return 0.5*(cm - cp)/d
+    return 0.
+
+@nb.njit(cache = NUMBA_CACHE)
+def _correlation_peaks(c, offsets, out):
+    """Locates correlation peaks of shape (n, p, h, w) and writes positions, 
+    relative to offsets, to out of shape (n, 2*p)."""
+    n, p, h, w = c.shape
+    for k in range(n):
+        for l in range(p):
+            i0, j0 = 0, 0
+            for i in range(h):
+                for j in range(w):
+                    if c[k,l,i,j].real > c[k,l,i0,j0].real:
+                        i0, j0 = i, j
+            c0 = c[k,l,i0,j0].real
+            x = _subpixel(c[k,l,(i0-1) % h,j0].real, c0, c[k,l,(i0+1) % h,j0].real)
+            y = _subpixel(c[k,l,i0,(j0-1) % w].real, c0, c[k,l,i0,(j0+1) % w].real)
+            #peaks past half of the ROI are negative shifts
+            if i0 > h//2:
+                i0 -= h
+            if j0 > w//2:
+                j0 -= w
+            out[k,2*l] = offsets[l,0] + i0 + x
+            out[k,2*l+1] = offsets[l,1] + j0 + y
+
+def roi_origins(centers, shape, center = None):
+    """Returns top-left corners of ROIs of a given shape around centers, an 
+    integer array of shape (P,2). The center of a ROI is at position center 
+    in the ROI, by default in the middle of the ROI."""
+    if center is None:
+        center = (np.array(shape) - 1)/2.
+    return np.round(np.array(centers, np.float64).reshape(-1, 2) - center).astype(int)
+
+def check_rois(origins, shape, frame_shape):
+    """Raises ValueError if any of the ROIs is not inside the frame."""
+    if np.any(origins < 0) or np.any(origins + shape > np.asarray(frame_shape)):
+        raise ValueError("ROIs must be inside the frame")
+
+def gaussian_reference(shape, sigma):
+    """Returns a reference image of a gaussian bead of width sigma in the 
+    center of an image of a given shape, see CorrelationTracker."""
+    x = np.arange(shape[0]) - (shape[0] - 1)/2.
+    y = np.arange(shape[1]) - (shape[1] - 1)/2.
+    return np.exp(-x[:,None]**2/(2*sigma**2) - y[None,:]**2/(2*sigma**2))
+
+class CorrelationTracker(object):
+    """Tracks single beads in fixed regions of interest (ROIs) by FFT 
+    cross-correlation with a reference bead image.
+    
+    A ROI of the reference image shape is cut from the frame around each 
+    center. The bead position is the position of the correlation peak, 
+    refined to sub-pixel precision by parabolic interpolation, so beads may 
+    move from the ROI center by up to half the ROI size. The reference 
+    spectrum and the FFT buffers are computed once and reused for all frames;
+    all ROIs of a block of frames are transformed in a single FFT call.
+    
+    Parameters
+    ----------
+    reference : ndarray
+        Reference image of a bead, e.g. a crop of a frame or gaussian_reference
+    centers : array_like
+        ROI centers of shape (P,2), e.g. trap positions in pixels
+    reference_center : (float,float), optional
+        Position of the bead in the reference image, defaults to the center
+        of the image
+        
+    Examples
+    --------
+    >>> tracker = CorrelationTracker(gaussian_reference((16,16), 2), [[64,64],[64,128]])
+    >>> data = tracker.track_video(frames)
+    """
+    def __init__(self, reference, centers, reference_center = None):
+        reference = np.asarray(reference, np.float64)
+        if reference.ndim != 2:
+            raise ValueError("Reference must be a 2D image")
+        self.shape = reference.shape
+        self.centers = np.array(centers, np.float64).reshape(-1, 2)
+        if reference_center is None:
+            reference_center = (np.array(self.shape) - 1)/2.
+        self.reference_center = np.asarray(reference_center, np.float64)
+        #: top-left corners of ROIs in the frame
+        self.origins = roi_origins(self.centers, self.shape, self.reference_center)
+        self._offsets = self.origins + self.reference_center
+        self._spectrum = np.conj(_fft2((reference - reference.mean()).astype(np.complex128)))
+        self._frame_shape = None
+        self._buffers = {}
+    
+    def _buffer(self, n):
+        """Returns a complex buffer for n frames, buffers are reused."""
+        buffer = self._buffers.get(n)
+        if buffer is None:
+            buffer = np.empty((n, len(self.centers)) + self.shape, np.complex128)
+            self._buffers[n] = buffer
+        return buffer
+    
+    def track(self, frames):
+        """Tracks beads in a frame or a block of frames.
+        
+        Parameters
+        ----------
+        frames : ndarray
+            A frame of shape (height, width) or a block of frames of shape
+            (n, height, width)
+            
+        Returns
+        -------
+        data : ndarray
+            Bead positions of shape (2*P,) for a single frame or (n, 2*P) for 
+            a block of frames: columns 2*i and 2*i+1 are x and y of the i-th
+            bead, as in trajectories.
+        """
+        frames = np.asarray(frames)
+        single = frames.ndim == 2
+        if single:
+            frames = frames[None]
+        if frames.shape[1:] != self._frame_shape:
+            check_rois(self.origins, self.shape, frames.shape[1:])
+            self._frame_shape = frames.shape[1:]
+        buffer = self._buffer(len(frames))
+        _copy_rois(frames, self.origins, buffer)
+        data = self._correlate(buffer)
+        return data[0] if single else data
+    
+    def track_rois(self, rois):
+        """Tracks beads in a block of ROIs of shape (n, P) + reference shape, 
+        cropped at self.origins, e.g. with preprocessing.crop_rois. Returns 
+        positions in frame coordinates, see track."""
+        rois = np.asarray(rois)
+        if rois.shape[1:] != (len(self.centers),) + self.shape:
+            raise ValueError("ROIs must be of shape (n, {}, {}, {})".format(len(self.centers), *self.shape))
+        buffer = self._buffer(len(rois))
+        buffer[...] = rois
+        buffer -= buffer.mean(axis = (-2,-1), keepdims = True)
+        return self._correlate(buffer)
+    
+    def _correlate(self, buffer):
+        """Correlates ROIs in buffer with the reference and returns positions."""
+        spectrum = _fft2(buffer)
+        spectrum *= self._spectrum
+        data = np.empty((len(buffer), 2*len(self.centers)))
+        _correlation_peaks(_ifft2(spectrum), self._offsets, data)
+        return data
+    
+    def track_video(self, video, block = 256):
+        """Tracks beads in all frames of a video, an array, a video.VideoFile 
+        or an iterator of frames, see frame_blocks. Returns an array of shape 
+        (frames, 2*P), see track."""
+        data = [self.track(frames) for frames in frame_blocks(video, block)]
+        if data:
+            return np.concatenate(data)
+        return np.empty((0, 2*len(self.centers)))
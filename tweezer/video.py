@@ -0,0 +1,240 @@
+"""
+Memory-mapped video storage
+
+Videos are stored as a stack of frames of shape (frames, height, width) in
+a memory-mapped file, so that videos larger than memory can be written frame
+by frame and read back with random access. Two file formats are supported:
+
+* "npy" - standard numpy file, can also be opened with np.load
+* "raw" - raw frame data preceded by a small fixed-size header, see RAW_HEADER
+
+Indexing and slicing a VideoFile returns views of the memory-mapped data, so no
+frames are copied until they are used.
+"""
+from __future__ import absolute_import, print_function, division
+
+import struct
+
+import numpy as np
+
+FORMATS = ("npy", "raw")
+
+#: supported frame data types
+DTYPES = (np.dtype("uint8"), np.dtype("uint16"))
+
+#: magic string that starts raw video files
+RAW_MAGIC = b"TWZVIDEO"
+
+#: raw header layout: magic, dtype string, frames, height, width
+RAW_HEADER = struct.Struct("<8s8sQQQ")
+
+#: size of the raw header in bytes, frame data starts at this offset
+RAW_HEADER_SIZE = 64
+
+def _check_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype not in DTYPES:
+        raise ValueError("Unsupported frame dtype {}".format(dtype))
+    return dtype
+
+def _read_raw_header(file_name):
+    """Reads header of a raw video file and returns dtype and shape."""
+    with open(file_name, "rb") as f:
+        data = f.read(RAW_HEADER.size)
+    if len(data) < RAW_HEADER.size or not data.startswith(RAW_MAGIC):
+        raise ValueError("{} is not a raw video file".format(file_name))
+    magic, dtype, frames, height, width = RAW_HEADER.unpack(data)
+    return np.dtype(dtype.rstrip(b"\0").decode()), (frames, height, width)
+
+def _write_raw_header(file_name, dtype, shape):
+    """Creates a raw video file of given dtype and shape, filled with zeros."""
+    header = RAW_HEADER.pack(RAW_MAGIC, dtype.str.encode(), *shape)
+    with open(file_name, "wb") as f:
+        f.write(header.ljust(RAW_HEADER_SIZE, b"\0"))
+        f.truncate(RAW_HEADER_SIZE + int(np.prod(shape))*dtype.itemsize)
+
+def _format(file_name, fmt = None):
+    """Determines file format from the file extension if not given."""
+    if fmt is None:
+        fmt = "npy" if file_name.endswith(".npy") else "raw"
+    if fmt not in FORMATS:
+        raise ValueError("fmt must be one of {}".format(FORMATS))
+    return fmt
+
+class VideoFile(object):
+    """A memory-mapped video. Use create_video or open_video to create it.
+
+    It is a list-like object of frames; len(video) is the number of frames,
+    video[i] is the i-th frame and video[i:j] is a (j-i, height, width) array.
+    Returned arrays are views of the memory-mapped data.
+
+    Video that is opened for writing can also be written sequentially with
+    the write method.
+
+    Parameters
+    ----------
+    data : memmap
+        Memory-mapped frame data of shape (frames, height, width)
+    file_name : str
+        Name of the file
+    fmt : str
+        File format, "npy" or "raw"
+    """
+    def __init__(self, data, file_name, fmt):
+        self.data = data
+        self.file_name = file_name
+        self.fmt = fmt
+        #: number of frames written with the write method
+        self.count = 0
+
+    @property
+    def shape(self):
+        """Shape of the video (frames, height, width)"""
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        """Frame data type"""
+        return self.data.dtype
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+    def __setitem__(self, item, value):
+        self.data[item] = value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.data[i]
+
+    def write(self, frames):
+        """Writes a frame of shape (height, width) or a block of frames of
+        shape (n, height, width) after the last written frame."""
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[None]
+        n = len(frames)
+        if self.count + n > len(self):
+            raise ValueError("Too many frames written")
+        self.data[self.count:self.count + n] = frames
+        self.count += n
+
+    def flush(self):
+        """Writes changes to disk."""
+        if self.data.mode != "r":
+            self.data.flush()
+
+    def close(self):
+        """Flushes the data and releases the memory map."""
+        if self.data is not None:
+            self.flush()
+            self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "VideoFile({!r}, shape = {}, dtype = {})".format(self.file_name, self.shape, self.dtype)
+
+def create_video(file_name, nframes, shape, dtype = "uint8", fmt = None):
+    """Creates a new memory-mapped video file.
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the file. An existing file is overwritten.
+    nframes : int
+        Number of frames
+    shape : (int,int)
+        Frame shape
+    dtype : dtype
+        Frame data type, uint8 or uint16
+    fmt : str, optional
+        File format, "npy" or "raw". By default it is determined from the file
+        extension: files ending with .npy are written in "npy" format.
+
+    Returns
+    -------
+    video : VideoFile
+        Video opened for writing
+
+    Examples
+    --------
+    >>> with create_video("video.npy", 100, (64,64)) as video:
+    ...     for frame in frames:
+    ...         video.write(frame)
+    """
+    fmt = _format(file_name, fmt)
+    dtype = _check_dtype(dtype)
+    shape = (int(nframes),) + tuple(int(n) for n in shape)
+    if fmt == "npy":
+        data = np.lib.format.open_memmap(file_name, mode = "w+", dtype = dtype, shape = shape)
+    else:
+        _write_raw_header(file_name, dtype, shape)
+        data = np.memmap(file_name, dtype = dtype, mode = "r+", offset = RAW_HEADER_SIZE, shape = shape)
+    return VideoFile(data, file_name, fmt)
+
+def open_video(file_name, mode = "r", fmt = None):
+    """Opens a memory-mapped video file.
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the file
+    mode : str
+        "r" for read-only access or "r+" for reading and writing
+    fmt : str, optional
+        File format, "npy" or "raw", determined from the file extension if not
+        given.
+
+    Returns
+    -------
+    video : VideoFile
+        Memory-mapped video
+    """
+    fmt = _format(file_name, fmt)
+    if fmt == "npy":
+        data = np.load(file_name, mmap_mode = mode)
+        if data.ndim != 3:
+            raise ValueError("Video must be a 3D array")
+        _check_dtype(data.dtype)
+    else:
+        dtype, shape = _read_raw_header(file_name)
+        data = np.memmap(file_name, dtype = dtype, mode = mode, offset = RAW_HEADER_SIZE, shape = shape)
+    return VideoFile(data, file_name, fmt)
+
+def write_video(file_name, video, nframes, shape, dtype = "uint8", fmt = None):
+    """Writes frames, or blocks of frames, from an iterator to a new video file.
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the file
+    video : iterable
+        Frames of shape (height, width) or blocks of frames of shape
+        (n, height, width)
+    nframes : int
+        Number of frames to write
+    shape : (int,int)
+        Frame shape
+    dtype : dtype
+        Frame data type, uint8 or uint16
+    fmt : str, optional
+        File format, see create_video
+
+    Returns
+    -------
+    video : VideoFile
+        Written video, opened for reading
+    """
+    with create_video(file_name, nframes, shape, dtype, fmt) as out:
+        for frames in video:
+            out.write(frames)
+        fmt = out.fmt
+    return open_video(file_name, fmt = fmt)
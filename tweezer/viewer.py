@@ -1,5 +1,5 @@
-"""A simple matlotlib-based video viewer. Video can be a list-like object or an
-iterator that yields 2D array."""
+"""A simple matlotlib-based video viewer. Video can be a list-like object, 
+such as a memory-mapped video.VideoFile, or an iterator that yields 2D array."""
 from __future__ import absolute_import, print_function, division 
 
 import numpy as np
@@ -13,8 +13,8 @@ class VideoViewer(object):
     Parameters
     ----------
     video : list-like, iterator
-        A list of 2D arrays or a generator of 2D arrays. If an iterator is
-        provided, you must set nframes as well. 
+        A list of 2D arrays, a 3D array, a video.VideoFile or a generator of 
+        2D arrays. If an iterator is provided, you must set nframes as well. 
     nframes: int, optional
         How many frames to show.
     """